@@ -0,0 +1,338 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import main as log_sorter
+
+
+BENCH_FORMAT_VERSION = 2
+URLS = [f"/api/v1/resource_{i}" for i in range(200)]
+USER_AGENTS = [
+    "Mozilla/5.0 (X11; Linux x86_64)",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    "curl/8.5.0",
+    "python-requests/2.31.0",
+]
+METHODS = ["GET"] * 8 + ["POST", "PUT"]
+STAGES = ("parse_log_files", "filter_log_entries_by_date", "analyze_url_metrics", "print_url_metrics_table")
+
+
+def make_urls(count):
+    if count <= len(URLS):
+        return URLS[:count]
+    return [f"/api/v1/resource_{i % 200}/{i // 200}" for i in range(count)]
+
+
+def generate_log_file(filepath, size_mb, seed=0, urls=len(URLS), days=30, malformed_ratio=0.0,
+                      start_date=datetime.date(2025, 6, 1)):
+    rng = random.Random(seed)
+    url_pool = make_urls(urls)
+    # Популярность URL убывает как 1/ранг: как в реальных логах, немногие URL дают большую часть запросов.
+    weights = [1 / (rank + 1) for rank in range(len(url_pool))]
+    start = datetime.datetime.combine(start_date, datetime.time(), datetime.timezone.utc)
+    spread = max(1, days) * 86400
+    target_size = int(size_mb * 1024 * 1024)
+    written = 0
+    batch = 4096
+    with open(filepath, 'w', encoding='utf-8') as f:
+        while written < target_size:
+            chosen_urls = rng.choices(url_pool, weights, k=batch)
+            lines = []
+            for url in chosen_urls:
+                timestamp = start + datetime.timedelta(seconds=rng.randrange(spread))
+                line = json.dumps({
+                    "@timestamp": timestamp.isoformat(),
+                    "status": 200 if rng.random() < 0.97 else 500,
+                    "url": url,
+                    "request_method": rng.choice(METHODS),
+                    "response_time": round(rng.expovariate(10), 3),
+                    "http_user_agent": rng.choice(USER_AGENTS)
+                })
+                if malformed_ratio and rng.random() < malformed_ratio:
+                    line = line[:rng.randrange(1, len(line) - 1)]
+                lines.append(line + "\n")
+            chunk = "".join(lines)
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def text_reader(filepath):
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def text_lines(filepath):
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield line.strip()
+
+
+def mmap_lines(filepath):
+    with open(filepath, 'rb') as f:
+        yield from log_sorter.iter_mmap_lines(f)
+
+
+def mmap_reader(filepath):
+    return log_sorter.iter_log_entries([filepath])
+
+
+def decoder_name():
+    return "orjson" if log_sorter.orjson is not None else "json"
+
+
+READERS = [
+    ("text lines (strip)", text_lines),
+    ("mmap lines", mmap_lines),
+    ("text + json.loads", text_reader),
+    ("mmap + " + decoder_name(), mmap_reader),
+]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(reader, filepath):
+    size = os.path.getsize(filepath)
+    start = time.perf_counter()
+    lines = 0
+    with contextlib.redirect_stderr(io.StringIO()):
+        for _ in reader(filepath):
+            lines += 1
+    elapsed = time.perf_counter() - start
+    return {
+        'lines': lines,
+        'seconds': elapsed,
+        'mb_per_s': size / (1024 * 1024) / elapsed if elapsed else 0.0,
+    }
+
+
+def timed_stage(stage, items, size, func, *args):
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    rss_after = peak_rss_mb()
+    return result, {
+        'stage': stage,
+        'lines': items,
+        'seconds': elapsed,
+        'lines_per_s': items / elapsed if elapsed else 0.0,
+        'mb_per_s': size / (1024 * 1024) / elapsed if elapsed and size else None,
+        # ru_maxrss - пик всего процесса с момента запуска, а не отдельного этапа: прирост показывает,
+        # насколько этап поднял этот пик (0, если этап уложился в память, занятую до него).
+        'cumulative_peak_rss_mb': rss_after,
+        'peak_rss_growth_mb': rss_after - rss_before if rss_after is not None else None,
+    }
+
+
+def measure_stages(filepath, specific_date):
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        total_lines = sum(1 for _ in f)
+    with contextlib.redirect_stderr(io.StringIO()):
+        entries, parse = timed_stage(STAGES[0], total_lines, size, log_sorter.parse_log_files, [filepath])
+    filtered, filtering = timed_stage(STAGES[1], len(entries), 0, log_sorter.filter_log_entries_by_date,
+                                      entries, specific_date)
+    metrics, analysis = timed_stage(STAGES[2], len(filtered), 0, log_sorter.analyze_url_metrics, filtered)
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, printing = timed_stage(STAGES[3], len(metrics), 0, log_sorter.print_url_metrics_table, metrics)
+    parse['malformed'] = total_lines - len(entries)
+    return [parse, filtering, analysis, printing]
+
+
+def generate_records(rows, seed=0):
+    rng = random.Random(seed)
+    return [{"url": rng.choice(URLS), "response_time": round(rng.random(), 3)} for _ in range(rows)]
+
+
+def measure_aggregation(records, backend):
+    decoder = log_sorter.make_record_decoder('json')
+    options = log_sorter.MetricsOptions(backend=backend)
+    start = time.perf_counter()
+    log_sorter.accumulate_url_records(records, decoder, options=options)
+    elapsed = time.perf_counter() - start
+    return {
+        'rows': len(records),
+        'seconds': elapsed,
+        'seconds_per_million': elapsed * 1_000_000 / len(records) if records else 0.0,
+    }
+
+
+def compare_results(results, baseline, tolerance):
+    previous = {stage['stage']: stage for stage in baseline.get('stages', [])}
+    regressions = []
+    for stage in results['stages']:
+        before = previous.get(stage['stage'])
+        if not before or not before['seconds']:
+            continue
+        ratio = stage['seconds'] / before['seconds']
+        marker = ""
+        if ratio > 1 + tolerance:
+            marker = "  РЕГРЕССИЯ"
+            regressions.append(stage['stage'])
+        print(f"{stage['stage']:<28} {before['seconds']:8.3f} с -> {stage['seconds']:8.3f} с  x{ratio:.2f}{marker}")
+    return regressions
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Замер производительности: генерирует синтетические логи JSON Lines и измеряет время "
+                    "каждого этапа (разбор, фильтр по дате, агрегация, вывод таблицы), скорость чтения "
+                    "и агрегации. Результаты можно сохранить в JSON и сравнить с прошлым запуском."
+    )
+    parser.add_argument('--size-mb', type=float, default=256,
+                        help="Размер синтетического файла в мегабайтах (по умолчанию 256).")
+    parser.add_argument('--file', type=str,
+                        help="Использовать существующий файл вместо генерации синтетического.")
+    parser.add_argument('--urls', type=int, default=len(URLS),
+                        help=f"Число уникальных URL в синтетических логах (по умолчанию {len(URLS)}).")
+    parser.add_argument('--days', type=int, default=30,
+                        help="Разброс меток времени в днях, начиная с 2025-06-01 (по умолчанию 30).")
+    parser.add_argument('--malformed-ratio', type=float, default=0.0,
+                        help="Доля повреждённых строк в синтетических логах, от 0 до 1 (по умолчанию 0).")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Начальное значение генератора случайных чисел (по умолчанию 0).")
+    parser.add_argument('--date', type=str, default='2025-06-01',
+                        help="Дата для этапа filter_log_entries_by_date (по умолчанию 2025-06-01).")
+    parser.add_argument('--skip-stages', action='store_true',
+                        help="Не измерять этапы (parse_log_files держит все записи в памяти).")
+    parser.add_argument('--skip-readers', action='store_true',
+                        help="Не измерять скорость разных способов чтения файла.")
+    parser.add_argument('--aggregation-rows', type=int, default=1_000_000,
+                        help="Число записей для замера агрегации по URL (по умолчанию 1000000, 0 - пропустить).")
+    parser.add_argument('--label', type=str, default='',
+                        help="Метка запуска (например, версия или ветка), сохраняется в JSON.")
+    parser.add_argument('--json', type=str,
+                        help="Сохранить результаты в JSON-файл.")
+    parser.add_argument('--compare', type=str,
+                        help="JSON-файл прошлого запуска: вывести изменение времени этапов и завершиться "
+                             "с кодом 1, если какой-либо этап стал медленнее больше чем на --tolerance.")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Допустимое замедление этапа при --compare, доля (по умолчанию 0.1, то есть 10%%).")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if not 0 <= args.malformed_ratio < 1:
+        print(f"Ошибка: Доля повреждённых строк должна быть в интервале [0, 1), получено {args.malformed_ratio}.",
+              file=sys.stderr)
+        sys.exit(1)
+        return
+    try:
+        specific_date = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+    except ValueError:
+        print(f"Ошибка: Неверный формат даты '{args.date}'. Ожидается YYYY-MM-DD.", file=sys.stderr)
+        sys.exit(1)
+        return
+
+    baseline = None
+    if args.compare:
+        try:
+            with open(args.compare, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+        except (IOError, ValueError) as e:
+            print(f"Ошибка при чтении результатов из файла '{args.compare}': {e}", file=sys.stderr)
+            sys.exit(1)
+            return
+
+    results = {
+        'version': BENCH_FORMAT_VERSION,
+        'label': args.label,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'decoder': log_sorter.make_record_decoder().name,
+        'params': {
+            'size_mb': args.size_mb, 'file': args.file, 'urls': args.urls, 'days': args.days,
+            'malformed_ratio': args.malformed_ratio, 'seed': args.seed, 'date': args.date,
+        },
+        'stages': [],
+        'readers': [],
+        'aggregation': [],
+    }
+
+    filepath = args.file
+    cleanup = False
+    if not filepath:
+        fd, filepath = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        cleanup = True
+        print(f"Генерация {args.size_mb} МБ синтетических логов в {filepath}...", file=sys.stderr)
+        generate_log_file(filepath, args.size_mb, args.seed, args.urls, args.days, args.malformed_ratio)
+    results['file_size'] = os.path.getsize(filepath)
+
+    try:
+        if not args.skip_stages:
+            results['stages'] = measure_stages(filepath, specific_date)
+            for stage in results['stages']:
+                throughput = f"{stage['mb_per_s']:8.1f} МБ/с" if stage['mb_per_s'] is not None else " " * 13
+                rss = ""
+                if stage['cumulative_peak_rss_mb'] is not None:
+                    rss = (f"пик RSS процесса {stage['cumulative_peak_rss_mb']:8.1f} МБ "
+                           f"(+{stage['peak_rss_growth_mb']:.1f} МБ за этап)")
+                print(f"{stage['stage']:<28} {stage['lines']:>12} строк  {stage['seconds']:8.3f} с  "
+                      f"{stage['lines_per_s']:12.0f} строк/с  {throughput}  {rss}")
+        if not args.skip_readers:
+            for label, reader in READERS:
+                result = measure(reader, filepath)
+                results['readers'].append({'reader': label, **result})
+                print(f"{label:<22} {result['lines']:>12} строк  {result['seconds']:8.2f} с  "
+                      f"{result['mb_per_s']:8.1f} МБ/с")
+    finally:
+        if cleanup:
+            os.remove(filepath)
+
+    if args.aggregation_rows > 0:
+        records = generate_records(args.aggregation_rows, args.seed)
+        backends = ['python'] + (['numpy'] if log_sorter.numpy is not None else [])
+        aggregation = {backend: measure_aggregation(records, backend) for backend in backends}
+        for backend, result in aggregation.items():
+            speedup = aggregation['python']['seconds'] / result['seconds'] if result['seconds'] else 0.0
+            results['aggregation'].append({'backend': backend, **result})
+            print(f"агрегация {backend:<12} {result['rows']:>12} строк  {result['seconds']:8.2f} с  "
+                  f"{result['seconds_per_million']:8.2f} с/млн  x{speedup:.1f}")
+
+    if args.json:
+        try:
+            log_sorter.write_json_atomic(args.json, results)
+        except IOError as e:
+            print(f"Ошибка при записи результатов в файл {args.json}: {e}", file=sys.stderr)
+
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Этапы медленнее базового запуска больше чем на {args.tolerance:.0%}: {', '.join(regressions)}.",
+                  file=sys.stderr)
+            sys.exit(1)
+            return
+
+
+if __name__ == "__main__":
+    main()
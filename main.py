@@ -1,10 +1,120 @@
 import os
 import json
-import tabulate
 import argparse
 import sys
-import io
+import mmap
+import threading
+import time
+import math
+import functools
 import datetime
+import re
+import itertools
+import operator
+import heapq
+import array
+import importlib
+import importlib.util
+import glob
+import collections
+import contextlib
+
+# Необязательные ускорители импортируются при первом обращении (optional_module), а не при запуске:
+# numpy, msgspec и др. заметно удлиняют старт, а нужны не на всех путях.
+OPTIONAL_MODULES = ('orjson', 'msgspec', 'zstandard', 'inotify_simple', 'numpy', 'resource')
+
+
+def optional_module(name):
+    namespace = globals()
+    if name not in namespace:
+        try:
+            namespace[name] = importlib.import_module(name)
+        except ImportError:
+            namespace[name] = None
+    return namespace[name]
+
+
+def optional_module_available(name):
+    # Проверка без импорта: numpy нужен только при агрегации, а не при разборе аргументов.
+    namespace = globals()
+    if name in namespace:
+        return namespace[name] is not None
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def resolve_loads_json():
+    namespace = globals()
+    if 'loads_json' not in namespace:
+        orjson = optional_module('orjson')
+        namespace['loads_json'] = orjson.loads if orjson is not None else loads_json_stdlib
+    return namespace['loads_json']
+
+
+def __getattr__(name):
+    if name in OPTIONAL_MODULES:
+        return optional_module(name)
+    if name == 'loads_json':
+        return resolve_loads_json()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+SHARDS_PER_WORKER = 4
+URL_STATS_FORMAT_VERSION = 1
+STATE_FORMAT_VERSION = 1
+STATE_HEAD_BYTES = 1024
+LOG_INDEX_FORMAT_VERSION = 2
+LOG_INDEX_SUFFIX = '.idx'
+COLUMNAR_MAGIC = b'LSCOLS01'
+COLUMNAR_FORMAT_VERSION = 1
+COLUMNAR_COLUMNS = (('days', 'i'), ('timestamps', 'q'), ('url_ids', 'i'), ('response_times', 'd'))
+COLUMNAR_ALIGNMENT = 8
+ROLLUP_FORMAT_VERSION = 3
+ROLLUP_INSERT_BATCH = 10000
+MISSING_TIMESTAMP = -2 ** 63
+FOLLOW_READ_SIZE = 1024 * 1024
+FOLLOW_MAX_PENDING = 16 * 1024 * 1024
+FOLLOW_POLL_INTERVAL = 0.5
+DEFAULT_PERCENTILE_ACCURACY = 0.01
+SKETCH_MAX_BINS = 2048
+SKETCH_MIN_VALUE = 1e-9
+REPORTED_PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+TOP_SORT_KEYS = ('total', 'avg', 'p50', 'p95', 'p99', 'max')
+HEAVY_HITTERS_CAPACITY_FACTOR = 10
+ISO_DAY_CACHE_SIZE = 4096
+URL_NORMALIZE_CACHE_SIZE = 65536
+URL_ID_PLACEHOLDER = '/{id}'
+URL_ID_SEGMENT = re.compile(r'/(?:\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})'
+                            r'(?=[/?#]|$)')
+BUCKET_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+BUCKET_URL_ID_BITS = 32
+BUCKET_TIMESTAMP_CACHE_SIZE = 65536
+DATE_PREFIX_SEPARATORS = frozenset(('', 'T', 't', ' '))
+RECORD_DECODERS = ('auto', 'msgspec', 'orjson', 'json')
+AGGREGATION_BACKENDS = ('auto', 'numpy', 'python')
+NUMPY_CHUNK_SIZE = 65536
+NUMERIC_TYPES = frozenset((int, float))
+DEFAULT_GROUP_BY = ('url',)
+DEFAULT_METRIC = 'response_time'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+DECOMPRESS_QUEUE_SIZE = 8
+CONCURRENT_READ_MAX_BYTES = 16 * 1024 * 1024
+GLOB_MAGIC = re.compile(r'[*?[]')
+STATS_CHUNK_SIZE = 65536
+STATS_STAGE_ORDER = ('load_stats', 'rollup', 'index', 'io_wait', 'read', 'decode', 'filter', 'aggregate', 'columnar',
+                     'save_stats', 'render', 'write')
+STATS_FORMATS = ('text', 'json')
+TRACEMALLOC_TOP_SITES = 10
+TABLE_COLUMN_GAP = '  '
+TABLE_MIN_PADDING = 2
+REPORT_WRITE_BUFFER = 1024 * 1024
+REPORT_FORMATS = ('table', 'csv', 'jsonl', 'prom')
+REPORT_EXTENSIONS = {'table': '.txt', 'csv': '.csv', 'jsonl': '.jsonl', 'prom': '.prom'}
+PROMETHEUS_METRIC_PREFIX = 'log_sorter'
 
 
 def get_unique_filename(base_name, extension=".txt"):
@@ -16,223 +126,3820 @@ def get_unique_filename(base_name, extension=".txt"):
     return filename
 
 
-def parse_log_files(filepaths):
-    all_parsed_logs = []
-    for filepath in filepaths:
-        if not os.path.exists(filepath):
-            print(f"Внимание: Файл '{filepath}' не найден, пропускаем.", file=sys.stderr)
-            continue
-        if not os.path.isfile(filepath):
-            print(f"Внимание: Путь '{filepath}' не является файлом, пропускаем.", file=sys.stderr)
-            continue
-
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        log_entry = json.loads(line)
-                        all_parsed_logs.append(log_entry)
-                    except json.JSONDecodeError:
-                        print(f"Внимание: Не удалось распарсить строку как JSON в '{filepath}': {line}",
-                              file=sys.stderr)
-                        continue
-        except IOError as e:
-            print(f"Ошибка при чтении файла '{filepath}': {e}", file=sys.stderr)
-            continue
-    return all_parsed_logs
+def missing_file_warning(filepath):
+    if not os.path.exists(filepath):
+        return f"Внимание: Файл '{filepath}' не найден, пропускаем."
+    if not os.path.isfile(filepath):
+        return f"Внимание: Путь '{filepath}' не является файлом, пропускаем."
+    return None
+
+
+class ReportFile:
+    __slots__ = ('base_name', 'extension', 'temp_path', 'stream')
+
+    def __init__(self, base_name, extension=".txt"):
+        self.base_name = base_name
+        self.extension = extension
+        self.temp_path = f"{base_name}{extension}.{os.getpid()}.tmp"
+        self.stream = open(self.temp_path, 'w', encoding='utf-8', buffering=REPORT_WRITE_BUFFER)
+
+    def commit(self):
+        self.stream.close()
+        filename = get_unique_filename(self.base_name, self.extension)
+        os.replace(self.temp_path, filename)
+        return filename
+
+    def discard(self):
+        self.stream.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+def iter_existing_files(filepaths):
+    for filepath in filepaths:
+        warning = missing_file_warning(filepath)
+        if warning is not None:
+            print(warning, file=sys.stderr)
+            continue
+        yield filepath
+
+
+def iter_directory_files(directory):
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.startswith('.') or filename.endswith(LOG_INDEX_SUFFIX):
+                continue
+            yield os.path.join(root, filename)
+
+
+def expand_log_paths(paths):
+    expanded = {}
+    for path in paths:
+        # Существующий путь берётся как есть: имена вроде 'pod[1].log' не должны разбираться как шаблон.
+        if GLOB_MAGIC.search(path) and not os.path.exists(path):
+            matches = sorted(glob.glob(path, recursive=True))
+        else:
+            matches = [path]
+        if not matches:
+            print(f"Внимание: Шаблон '{path}' не совпал ни с одним файлом, пропускаем.", file=sys.stderr)
+        for match in matches:
+            if os.path.isdir(match):
+                expanded.update(dict.fromkeys(iter_directory_files(match)))
+            else:
+                expanded[match] = None
+    return list(expanded)
+
+
+def loads_json_stdlib(line):
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    return json.loads(line)
+
+
+class RecordDecoder:
+    __slots__ = ('name', 'decode', 'timestamp_field_name', 'projected', 'group_by', 'metric', 'attributes')
+
+    def __init__(self, name, decode, timestamp_field_name='@timestamp', projected=False, group_by=DEFAULT_GROUP_BY,
+                 metric=DEFAULT_METRIC, attributes=None):
+        self.name = name
+        self.decode = decode
+        self.timestamp_field_name = timestamp_field_name
+        self.projected = projected
+        self.group_by = group_by
+        self.metric = metric
+        self.attributes = attributes
+
+    def source_fields(self, field):
+        # 'key' и 'metric' — логические поля отчёта: ключ группировки и агрегируемое значение.
+        if field == 'timestamp':
+            return (self.timestamp_field_name,)
+        if field == 'key':
+            return self.group_by
+        if field == 'metric':
+            return (self.metric,)
+        return (field,)
+
+    def getter(self, field):
+        fields = self.source_fields(field)
+        if len(fields) > 1:
+            return self.group_key_getter(fields)
+        if self.projected:
+            return operator.attrgetter(self.attributes[fields[0]])
+        return operator.methodcaller('get', fields[0])
+
+    def group_key_getter(self, fields):
+        # Один кортеж на запись независимо от числа измерений: attrgetter/itemgetter собирают его в C.
+        if self.projected:
+            get_values = operator.attrgetter(*(self.attributes[name] for name in fields))
+        else:
+            get_values = operator.itemgetter(*fields)
+
+        def get_key(record):
+            try:
+                key = get_values(record)
+            except KeyError:
+                return None
+            return None if None in key or '' in key else key
+
+        return get_key
+
+    def column(self, field):
+        fields = self.source_fields(field)
+        if len(fields) > 1:
+            get_key = self.group_key_getter(fields)
+            return lambda records: list(map(get_key, records))
+        if self.projected:
+            get_value = operator.attrgetter(self.attributes[fields[0]])
+            return lambda records: list(map(get_value, records))
+        field = fields[0]
+        return lambda records: [record.get(field) for record in records]
+
+
+def parse_group_by(text):
+    fields = tuple(field.strip() for field in (text or '').split(','))
+    if not all(fields):
+        raise ValueError(f"неверный список полей группировки '{text}', ожидается например url,http_method,status")
+    if len(set(fields)) != len(fields):
+        raise ValueError(f"поля группировки повторяются: '{text}'")
+    return fields
+
+
+def make_msgspec_decoder(timestamp_field_name, group_by=DEFAULT_GROUP_BY, metric=DEFAULT_METRIC):
+    import typing
+    import msgspec
+
+    attributes = {'url': 'url', 'response_time': 'response_time'}
+    attributes.setdefault(timestamp_field_name, 'timestamp')
+    for name in (*group_by, metric):
+        if name not in attributes:
+            attributes[name] = f'field{len(attributes)}'
+    record_type = msgspec.defstruct('LogRecord', [
+        (attribute, typing.Any, msgspec.field(default=None, name=name)) for name, attribute in attributes.items()
+    ])
+    return RecordDecoder('msgspec', msgspec.json.Decoder(record_type).decode, timestamp_field_name, projected=True,
+                         group_by=group_by, metric=metric, attributes=attributes)
+
+
+def make_dict_decoder(timestamp_field_name='@timestamp', group_by=DEFAULT_GROUP_BY, metric=DEFAULT_METRIC):
+    return RecordDecoder('orjson' if optional_module('orjson') is not None else 'json', resolve_loads_json(),
+                         timestamp_field_name, group_by=group_by, metric=metric)
+
+
+def make_record_decoder(name='auto', timestamp_field_name='@timestamp', group_by=DEFAULT_GROUP_BY,
+                        metric=DEFAULT_METRIC):
+    if name == 'auto':
+        name = ('msgspec' if optional_module('msgspec') is not None
+                else 'orjson' if optional_module('orjson') is not None else 'json')
+
+    if name == 'msgspec':
+        if optional_module('msgspec') is None:
+            raise ValueError("пакет msgspec не установлен")
+        return make_msgspec_decoder(timestamp_field_name, group_by, metric)
+    if name == 'orjson':
+        orjson = optional_module('orjson')
+        if orjson is None:
+            raise ValueError("пакет orjson не установлен")
+        return RecordDecoder('orjson', orjson.loads, timestamp_field_name, group_by=group_by, metric=metric)
+    if name == 'json':
+        return RecordDecoder('json', loads_json_stdlib, timestamp_field_name, group_by=group_by, metric=metric)
+    raise ValueError(f"неизвестный декодер '{name}'")
+
+
+def warn_unparsable_line(line, filepath):
+    line = line.strip()
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+    print(f"Внимание: Не удалось распарсить строку как JSON в '{filepath}': {line}",
+          file=sys.stderr)
+
+
+def parse_log_line(line, filepath):
+    if not line or line.isspace():
+        return None
+    try:
+        return resolve_loads_json()(line)
+    except ValueError:
+        warn_unparsable_line(line, filepath)
+        return None
+
+
+def iter_mmap_lines(f, start=0, end=None):
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return
+
+    with mapped:
+        if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        mapped.seek(start)
+        if end is None or end >= len(mapped):
+            yield from iter(mapped.readline, b'')
+            return
+
+        position = start
+        while position < end:
+            raw_line = mapped.readline()
+            if not raw_line:
+                break
+            position += len(raw_line)
+            yield raw_line
+
+
+def detect_compression(filepath):
+    with open(filepath, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def open_decompressed(filepath, compression):
+    if compression == 'gzip':
+        import gzip
+        return gzip.open(filepath, 'rb')
+    zstandard = optional_module('zstandard')
+    if zstandard is None:
+        raise IOError("для чтения файлов zstd нужен пакет zstandard")
+    return zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), read_across_frames=True, closefd=True)
+
+
+def iter_decompressed_chunks(stream, chunk_size=DECOMPRESS_CHUNK_SIZE, queue_size=DECOMPRESS_QUEUE_SIZE):
+    import queue
+
+    chunks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def decompress():
+        try:
+            while not stop.is_set():
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                put(chunk)
+        except Exception as e:
+            put(e)
+        put(None)
+
+    thread = threading.Thread(target=decompress, name='log-decompressor', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise IOError(f"ошибка распаковки: {item}") from item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iter_chunk_lines(chunks):
+    tail = b''
+    for chunk in chunks:
+        lines = chunk.split(b'\n')
+        lines[0] = tail + lines[0]
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def iter_file_lines(filepath, start=0, end=None):
+    compression = detect_compression(filepath)
+    if compression is None:
+        with open(filepath, 'rb') as f:
+            yield from iter_mmap_lines(f, start, end)
+        return
+
+    with open_decompressed(filepath, compression) as stream:
+        if start:
+            # Смещение в сжатом файле считается в распакованных байтах, end для него не задаётся.
+            stream.seek(start)
+        yield from iter_chunk_lines(iter_decompressed_chunks(stream))
+
+
+def iter_decoded_lines(raw_lines, filepath, decoder, window=None, counters=None):
+    is_outside_window = make_raw_line_date_filter(window, decoder.timestamp_field_name) if window else None
+    decode = decoder.decode
+    check_object = not decoder.projected
+    for raw_line in raw_lines:
+        if is_outside_window is not None and is_outside_window(raw_line):
+            if counters is not None:
+                counters['date_skipped'] += 1
+            continue
+        if not raw_line or raw_line.isspace():
+            count_skipped_line(counters, 'empty')
+            continue
+        try:
+            record = decode(raw_line)
+        except ValueError:
+            warn_unparsable_line(raw_line, filepath)
+            count_skipped_line(counters, 'malformed')
+            continue
+        if check_object and type(record) is not dict:
+            warn_unparsable_line(raw_line, filepath)
+            count_skipped_line(counters, 'malformed')
+            continue
+        yield record
+
+
+def count_skipped_line(counters, key):
+    if counters is not None:
+        counters[key] = counters.get(key, 0) + 1
+
+
+def iter_log_entries(filepaths, window=None, timestamp_field_name='@timestamp', counters=None, decoder=None,
+                     stats=None):
+    if decoder is None:
+        decoder = make_dict_decoder(timestamp_field_name)
+    for filepath in iter_existing_files(filepaths):
+        raw_lines = iter_file_lines(filepath)
+        if stats is not None:
+            raw_lines = stats.iterate('read', raw_lines, count_bytes=True)
+        try:
+            yield from iter_decoded_lines(raw_lines, filepath, decoder, window, counters)
+        except IOError as e:
+            print(f"Ошибка при чтении файла '{filepath}': {e}", file=sys.stderr)
+            continue
+
+
+def read_log_file_contents(filepath, max_bytes=CONCURRENT_READ_MAX_BYTES):
+    warning = missing_file_warning(filepath)
+    if warning is not None:
+        return None, warning
+    # Порог сравнивается с размером на диске, поэтому сжатые файлы целиком не читаются: они потоково
+    # распаковываются в iter_file_lines, как и большие несжатые.
+    if os.path.getsize(filepath) > max_bytes or detect_compression(filepath) is not None:
+        return None, None
+    with open(filepath, 'rb') as f:
+        return f.read(), None
+
+
+def iter_prefetched_log_files(filepaths, concurrency, max_bytes=CONCURRENT_READ_MAX_BYTES):
+    import concurrent.futures
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='log-reader')
+    pending = collections.deque()
+
+    def take():
+        filepath, future = pending.popleft()
+        try:
+            return (filepath,) + future.result()
+        except Exception as e:
+            return filepath, None, e
+
+    try:
+        for filepath in filepaths:
+            pending.append((filepath, pool.submit(read_log_file_contents, filepath, max_bytes)))
+            if len(pending) >= 2 * concurrency:
+                yield take()
+        while pending:
+            yield take()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_log_entries_concurrent(filepaths, concurrency, window=None, counters=None, decoder=None,
+                                max_bytes=CONCURRENT_READ_MAX_BYTES, stats=None):
+    if decoder is None:
+        decoder = make_dict_decoder()
+    prefetched = iter_prefetched_log_files(filepaths, concurrency, max_bytes)
+    if stats is not None:
+        prefetched = stats.iterate('io_wait', prefetched, chunk_size=1)
+    for filepath, contents, problem in prefetched:
+        if isinstance(problem, str):
+            print(problem, file=sys.stderr)
+            continue
+        if problem is not None:
+            print(f"Ошибка при чтении файла '{filepath}': {problem}", file=sys.stderr)
+            continue
+        raw_lines = iter_file_lines(filepath) if contents is None else iter_chunk_lines((contents,))
+        if stats is not None:
+            raw_lines = stats.iterate('read', raw_lines, count_bytes=True)
+        try:
+            yield from iter_decoded_lines(raw_lines, filepath, decoder, window, counters)
+        except IOError as e:
+            print(f"Ошибка при чтении файла '{filepath}': {e}", file=sys.stderr)
+
+
+def plan_log_shards(filepaths, shard_count, segments=()):
+    segments = [(filepath, 0, os.path.getsize(filepath)) for filepath in iter_existing_files(filepaths)] + \
+        list(segments)
+    total_size = sum(end - start for _, start, end in segments)
+    shard_size = max(1, total_size // max(1, shard_count))
+
+    shards = []
+    for filepath, start, end in segments:
+        try:
+            if end and detect_compression(filepath) is not None:
+                shards.append((filepath, 0, end))
+                continue
+            with open(filepath, 'rb') as f:
+                while start < end:
+                    boundary = start + shard_size
+                    if boundary < end:
+                        f.seek(boundary)
+                        f.readline()
+                        boundary = f.tell()
+                    boundary = min(boundary, end)
+                    shards.append((filepath, start, boundary))
+                    start = boundary
+        except IOError as e:
+            print(f"Ошибка при чтении файла '{filepath}': {e}", file=sys.stderr)
+    return shards
+
+
+def iter_log_shard_entries(filepath, start, end, window=None, timestamp_field_name='@timestamp', counters=None,
+                           decoder=None, stats=None):
+    if decoder is None:
+        decoder = make_dict_decoder(timestamp_field_name)
+    raw_lines = iter_file_lines(filepath, start, end)
+    if stats is not None:
+        raw_lines = stats.iterate('read', raw_lines, count_bytes=True)
+    try:
+        yield from iter_decoded_lines(raw_lines, filepath, decoder, window, counters)
+    except IOError as e:
+        print(f"Ошибка при чтении файла '{filepath}': {e}", file=sys.stderr)
+
+
+def parse_log_files(filepaths):
+    return list(iter_log_entries(filepaths))
+
+
+def parse_timestamp_date(timestamp_str):
+    try:
+        return datetime.datetime.fromisoformat(timestamp_str).date().isoformat()
+    except (ValueError, TypeError):
+        pass
+    try:
+        return datetime.datetime.strptime(timestamp_str.split(' ')[0], '%Y-%m-%d').date().isoformat()
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def is_iso_day(day):
+    if len(day) != 10 or day[4] != '-' or day[7] != '-' or not day.isascii():
+        return False
+    try:
+        datetime.date.fromisoformat(day)
+    except ValueError:
+        return False
+    return True
+
+
+_iso_day_cache = {}
+
+
+def timestamp_date_prefix(timestamp_str):
+    if not isinstance(timestamp_str, str):
+        return None
+
+    day = timestamp_str[:10]
+    valid = _iso_day_cache.get(day)
+    if valid is None:
+        if len(_iso_day_cache) >= ISO_DAY_CACHE_SIZE:
+            _iso_day_cache.clear()
+        valid = _iso_day_cache[day] = is_iso_day(day)
+
+    if valid and timestamp_str[10:11] in DATE_PREFIX_SEPARATORS:
+        return day
+    return parse_timestamp_date(timestamp_str)
+
+
+class DateWindow:
+    __slots__ = ('date_from', 'date_to', 'lo', 'hi', 'excluded_days')
+
+    def __init__(self, date_from=None, date_to=None, excluded_days=frozenset()):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.lo = date_from.isoformat() if date_from else '0000-00-00'
+        self.hi = date_to.isoformat() if date_to else '9999-99-99'
+        # Дни, уже посчитанные по сводкам (--rollup-db): сырые строки за них пропускаются.
+        self.excluded_days = excluded_days
+
+    @property
+    def single_day(self):
+        return self.date_from is not None and self.date_from == self.date_to
+
+    def contains_day(self, day):
+        return day is not None and self.lo <= day <= self.hi and day not in self.excluded_days
+
+    def contains_timestamp(self, timestamp_str):
+        return self.contains_day(timestamp_date_prefix(timestamp_str))
+
+    def label(self):
+        if self.single_day:
+            return self.lo
+        if self.date_from and self.date_to:
+            return f"{self.lo}_{self.hi}"
+        if self.date_from:
+            return f"since_{self.lo}"
+        return f"until_{self.hi}"
+
+    def describe(self):
+        if self.single_day:
+            return f"дате {self.lo}"
+        if self.date_from and self.date_to:
+            return f"диапазону дат {self.lo} — {self.hi}"
+        if self.date_from:
+            return f"диапазону дат с {self.lo}"
+        return f"диапазону дат по {self.hi}"
+
+
+def make_raw_line_date_filter(window, timestamp_field_name='@timestamp'):
+    key = json.dumps(timestamp_field_name, ensure_ascii=False).encode('utf-8')
+    pattern = re.compile(rb'(?<!\\)' + re.escape(key) + rb'\s*:\s*"(\d{4}-\d{2}-\d{2})[Tt "]')
+    lo, hi = window.lo.encode('ascii'), window.hi.encode('ascii')
+    excluded = frozenset(day.encode('ascii') for day in window.excluded_days)
+
+    def is_outside_window(raw_line):
+        if raw_line.count(key) != 1:
+            return False
+        match = pattern.search(raw_line)
+        if match is None:
+            return False
+        day = match.group(1)
+        return day < lo or day > hi or day in excluded
+
+    return is_outside_window
+
+
+def iter_in_window(items, window, get_timestamp):
+    lo, hi, excluded = window.lo, window.hi, window.excluded_days
+    valid_days = _iso_day_cache
+    for item in items:
+        timestamp_str = get_timestamp(item)
+        if type(timestamp_str) is str:
+            day = timestamp_str[:10]
+            if valid_days.get(day) and timestamp_str[10:11] in DATE_PREFIX_SEPARATORS:
+                if lo <= day <= hi and day not in excluded:
+                    yield item
+                continue
+        if window.contains_timestamp(timestamp_str):
+            yield item
+
+
+def iter_log_entries_in_window(log_entries, window, timestamp_field_name='@timestamp'):
+    return iter_in_window(log_entries, window, operator.methodcaller('get', timestamp_field_name))
+
+
+def iter_records_in_window(records, window, decoder):
+    return iter_in_window(records, window, decoder.getter('timestamp'))
+
+
+def iter_log_entries_by_date(log_entries, specific_date, timestamp_field_name='@timestamp'):
+    return iter_log_entries_in_window(log_entries, DateWindow(specific_date, specific_date), timestamp_field_name)
+
+
+def filter_log_entries_by_date(log_entries, specific_date, timestamp_field_name='@timestamp'):
+    if not specific_date:
+        return log_entries
+
+    return list(iter_log_entries_by_date(log_entries, specific_date, timestamp_field_name))
+
+
+def filter_log_entries_by_date_range(log_entries, date_from=None, date_to=None, timestamp_field_name='@timestamp'):
+    if not date_from and not date_to:
+        return log_entries
+
+    return list(iter_log_entries_in_window(log_entries, DateWindow(date_from, date_to), timestamp_field_name))
+
+
+def count_log_entries(log_entries, counters, key):
+    for entry in log_entries:
+        counters[key] += 1
+        yield entry
+
+
+def peak_rss_bytes():
+    resource = optional_module('resource')
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RunStats:
+    __slots__ = ('enabled', 'hooks', 'wall', 'cpu', 'items', 'bytes_read', 'current', 'switched_at',
+                 'started_at', 'report')
+
+    def __init__(self, enabled=True, hooks=()):
+        self.enabled = enabled
+        self.hooks = list(hooks)
+        self.wall = {}
+        self.cpu = {}
+        self.items = {}
+        self.bytes_read = 0
+        self.current = None
+        self.switched_at = self.started_at = (time.perf_counter(), time.process_time())
+        self.report = None
+
+    def switch(self, stage):
+        now = (time.perf_counter(), time.process_time())
+        previous = self.current
+        if previous is not None:
+            self.wall[previous] = self.wall.get(previous, 0.0) + now[0] - self.switched_at[0]
+            self.cpu[previous] = self.cpu.get(previous, 0.0) + now[1] - self.switched_at[1]
+        self.current = stage
+        self.switched_at = now
+        return previous
+
+    def stage(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed_stage(name)
+
+    @contextlib.contextmanager
+    def timed_stage(self, name):
+        previous = self.switch(name)
+        try:
+            yield self
+        finally:
+            self.switch(previous)
+
+    def iterate(self, name, items, chunk_size=STATS_CHUNK_SIZE, count_bytes=False):
+        if not self.enabled:
+            return items
+        return self.iterate_chunks(name, items, chunk_size, count_bytes)
+
+    def iterate_chunks(self, name, items, chunk_size, count_bytes):
+        # Время считается на пачку элементов, а не на каждый: так замер почти не замедляет конвейер.
+        iterator = iter(items)
+        while True:
+            previous = self.switch(name)
+            try:
+                chunk = list(itertools.islice(iterator, chunk_size))
+            finally:
+                self.switch(previous)
+            if not chunk:
+                return
+            self.items[name] = self.items.get(name, 0) + len(chunk)
+            if count_bytes:
+                self.bytes_read += sum(map(len, chunk))
+            yield from chunk
+
+    def finish(self, counters=None, windowed=False, missing_fields=None):
+        now = (time.perf_counter(), time.process_time())
+        counters = counters or {}
+        prefiltered = counters.get('date_skipped', 0)
+        window_filtered = counters.get('parsed', 0) - counters.get('matched', 0) if windowed else 0
+        skipped = {
+            'empty': counters.get('empty', 0),
+            'malformed': counters.get('malformed', 0),
+            'date_filtered': prefiltered + window_filtered,
+            'missing_fields': missing_fields,
+        }
+        import tracemalloc
+
+        traced_peak = allocations = None
+        if tracemalloc.is_tracing():
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+            allocations = [str(site) for site in snapshot.statistics('lineno')[:TRACEMALLOC_TOP_SITES]]
+        self.report = {
+            'wall': now[0] - self.started_at[0],
+            'cpu': now[1] - self.started_at[1],
+            'stages': [{'stage': stage, 'wall': self.wall[stage], 'cpu': self.cpu[stage], 'items': self.items.get(stage)}
+                       for stage in sorted(self.wall, key=stats_stage_rank)],
+            'bytes_read': self.bytes_read if 'read' in self.items else None,
+            'lines_read': counters.get('parsed', 0) + prefiltered + skipped['empty'] + skipped['malformed'],
+            'records_parsed': counters.get('parsed', 0),
+            'lines_summarized': counters.get('summarized', 0),
+            'lines_skipped': skipped,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'peak_traced_bytes': traced_peak,
+            'allocations': allocations,
+        }
+        for hook in self.hooks:
+            hook(self.report)
+        return self.report
+
+
+def stats_stage_rank(stage):
+    return STATS_STAGE_ORDER.index(stage) if stage in STATS_STAGE_ORDER else len(STATS_STAGE_ORDER)
+
+
+def count_aggregated_records(url_stats):
+    if isinstance(url_stats, dict):
+        return sum(stats.count for stats in url_stats.values())
+    if isinstance(url_stats, BucketedStats):
+        return sum(url_stats.counts)
+    return None
+
+
+class LatencySketch:
+    __slots__ = ('relative_accuracy', 'max_bins', 'gamma', 'log_gamma', 'bins', 'zero_count', 'count')
+
+    def __init__(self, relative_accuracy=DEFAULT_PERCENTILE_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"относительная точность должна быть в интервале (0, 1), получено {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        if value - value:
+            # NaN и бесконечности (stdlib json их принимает) не попадают ни в одну корзину.
+            return
+        self.count += 1
+        if value <= SKETCH_MIN_VALUE:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        bins = self.bins
+        bins[index] = bins.get(index, 0) + 1
+        if len(bins) > self.max_bins:
+            self.collapse()
+
+    def collapse(self):
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        if excess <= 0:
+            return
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[target] += self.bins.pop(index)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("нельзя объединить скетчи с разной точностью")
+        bins = self.bins
+        for index, count in other.bins.items():
+            bins[index] = bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(bins) > self.max_bins:
+            self.collapse()
+        return self
+
+    def copy(self):
+        return LatencySketch(self.relative_accuracy, self.max_bins).merge(self)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {
+            'accuracy': self.relative_accuracy,
+            'max_bins': self.max_bins,
+            'zero': self.zero_count,
+            'bins': sorted(self.bins.items())
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['accuracy'], data.get('max_bins', SKETCH_MAX_BINS))
+        sketch.bins = {int(index): count for index, count in data['bins']}
+        sketch.zero_count = data['zero']
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        return sketch
+
+    def __eq__(self, other):
+        if not isinstance(other, LatencySketch):
+            return NotImplemented
+        return (self.relative_accuracy == other.relative_accuracy and self.bins == other.bins
+                and self.zero_count == other.zero_count)
+
+
+def add_exact_tail(tail, value):
+    # Алгоритм Шевчука (как в math.fsum): неперекрывающиеся слагаемые по возрастанию модуля, список растёт
+    # на месте и обычно держит одно-два числа.
+    if tail is None:
+        return [value]
+    count = 0
+    for term in tail:
+        if abs(value) < abs(term):
+            value, term = term, value
+        total = value + term
+        error = term - (total - value)
+        if error:
+            tail[count] = error
+            count += 1
+        value = total
+    del tail[count:]
+    tail.append(value)
+    return tail
+
+
+def add_exact(high, low, tail, value):
+    # Точная сумма хранится как high + low + sum(tail): high - обычная сумма, low - её ошибки округления
+    # (TwoSum), tail - ошибки округления самого low, нужен редко. Итог не зависит ни от порядка строк, ни от
+    # того, как их разбили между процессами, индексами и сводками, а сырые значения не хранятся.
+    total = high + value
+    shifted = total - high
+    error = (high - (total - shifted)) + (value - shifted)
+    if not error:
+        return total, low, tail
+    if error - error:
+        # NaN и бесконечности (и переполнение) поглощают конечную часть суммы.
+        return total, 0, None
+    new_low = low + error
+    shifted = new_low - low
+    rest = (low - (new_low - shifted)) + (error - shifted)
+    if rest:
+        tail = add_exact_tail(tail, rest)
+    return total, new_low, tail
+
+
+def exact_sum_value(high, low, tail):
+    if tail is None and not low:
+        return high
+    return math.fsum((*(tail or ()), low, high))
+
+
+def exact_sum_terms(high, low, tail):
+    return [term for term in (*(tail or ()), low, high) if term] or [high]
+
+
+def fold_exact_sum(terms):
+    # Сворачивает пачку значений на месте в неперекрывающиеся слагаемые их точной суммы (первое - округлённая
+    # сумма), чтобы векторный backend добавлял в агрегат пару чисел вместо каждого значения.
+    total = sum(terms)
+    if type(total) is int:
+        terms.clear()
+        terms.append(total)
+        return
+    if total - total:
+        specials = [term for term in terms if term - term]
+        if specials:
+            terms.clear()
+            terms.append(sum(specials))
+            return
+    count = len(terms)
+    try:
+        residual = math.fsum(terms)
+        while residual:
+            terms.append(-residual)
+            residual = math.fsum(terms)
+    except OverflowError:
+        terms.clear()
+        terms.append(total)
+        return
+    del terms[:count]
+    for i, term in enumerate(terms):
+        terms[i] = -term
+    if not terms:
+        # Слагаемые взаимно уничтожились: точная сумма равна нулю.
+        terms.append(0.0)
+
+
+class UrlStats:
+    __slots__ = ('count', 'sum_high', 'sum_low', 'sum_tail', 'min', 'max', 'sketch')
+
+    def __init__(self, count=0, total=0, minimum=None, maximum=None, sketch=None):
+        self.count = count
+        self.sum_high = total
+        self.sum_low = 0
+        self.sum_tail = None
+        self.min = minimum
+        self.max = maximum
+        self.sketch = sketch
+
+    @property
+    def total(self):
+        return exact_sum_value(self.sum_high, self.sum_low, self.sum_tail)
+
+    def add_to_total(self, value):
+        self.sum_high, self.sum_low, self.sum_tail = add_exact(self.sum_high, self.sum_low, self.sum_tail, value)
+
+    def add(self, response_time):
+        # То же, что add_to_total, но без вызова функции на каждую строку.
+        self.count += 1
+        high = self.sum_high
+        total = self.sum_high = high + response_time
+        shifted = total - high
+        error = (high - (total - shifted)) + (response_time - shifted)
+        if error:
+            low = self.sum_low
+            new_low = self.sum_low = low + error
+            shifted = new_low - low
+            rest = (low - (new_low - shifted)) + (error - shifted)
+            if rest:
+                if rest - rest:
+                    self.sum_low, self.sum_tail = 0, None
+                else:
+                    self.sum_tail = add_exact_tail(self.sum_tail, rest)
+        if self.min is None or response_time < self.min:
+            self.min = response_time
+        if self.max is None or response_time > self.max:
+            self.max = response_time
+        if self.sketch is not None:
+            self.sketch.add(response_time)
+
+    def merge(self, other):
+        self.count += other.count
+        for term in exact_sum_terms(other.sum_high, other.sum_low, other.sum_tail):
+            self.add_to_total(term)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        if other.sketch is not None:
+            if self.sketch is None:
+                self.sketch = other.sketch.copy()
+            else:
+                self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count > 0 else 0
+
+    def percentile(self, q):
+        if self.sketch is None:
+            return None
+        value = self.sketch.quantile(q)
+        if value is None:
+            return None
+        return min(max(value, self.min), self.max)
+
+    def to_dict(self):
+        data = {'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max}
+        if self.sum_low or self.sum_tail is not None:
+            data['partials'] = exact_sum_terms(self.sum_high, self.sum_low, self.sum_tail)
+        if self.sketch is not None:
+            data['sketch'] = self.sketch.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = data.get('sketch')
+        stats = cls(data['count'], data['total'], data.get('min'), data.get('max'),
+                    LatencySketch.from_dict(sketch) if sketch else None)
+        if 'partials' in data:
+            stats.sum_high = 0
+            for term in data['partials']:
+                stats.add_to_total(term)
+        return stats
+
+    def __eq__(self, other):
+        if not isinstance(other, UrlStats):
+            return NotImplemented
+        return (self.count == other.count and self.total == other.total and self.min == other.min
+                and self.max == other.max and self.sketch == other.sketch)
+
+    def __repr__(self):
+        return f"UrlStats(count={self.count}, total={self.total}, min={self.min}, max={self.max})"
+
+
+class UrlNormalizer:
+    __slots__ = ('strip_query', 'collapse_ids', 'templates', 'rules', 'normalize')
+
+    def __init__(self, strip_query=False, collapse_ids=False, templates=()):
+        self.strip_query = strip_query
+        self.collapse_ids = collapse_ids
+        self.templates = tuple((pattern, template) for pattern, template in templates)
+        self.rules = []
+        for pattern, template in self.templates:
+            try:
+                compiled = re.compile(pattern)
+                compiled.sub(template, '')
+            except (re.error, IndexError) as e:
+                raise ValueError(f"неверное правило шаблона URL '{pattern}' -> '{template}': {e}") from None
+            self.rules.append((compiled, template))
+        self.normalize = functools.lru_cache(maxsize=URL_NORMALIZE_CACHE_SIZE)(self.normalize_uncached)
+
+    def normalize_uncached(self, url):
+        if type(url) is not str:
+            return url
+        if self.strip_query:
+            url = url.split('?', 1)[0].split('#', 1)[0]
+        for pattern, template in self.rules:
+            match = pattern.search(url)
+            if match is not None:
+                return url[:match.start()] + match.expand(template) + url[match.end():]
+        if self.collapse_ids:
+            url = URL_ID_SEGMENT.sub(URL_ID_PLACEHOLDER, url)
+        return url
+
+    def key(self):
+        return {
+            'strip_query': self.strip_query,
+            'collapse_ids': self.collapse_ids,
+            'templates': [list(rule) for rule in self.templates]
+        }
+
+    def __reduce__(self):
+        return UrlNormalizer, (self.strip_query, self.collapse_ids, self.templates)
+
+
+def normalize_url_stats(url_stats, normalize):
+    normalized = {}
+    for url, stats in url_stats.items():
+        merge_url_stats(normalized, {normalize(url): stats})
+    return normalized
+
+
+def resolve_aggregation_backend(name='auto'):
+    if name == 'auto':
+        return 'numpy' if optional_module_available('numpy') else 'python'
+    if name == 'numpy' and not optional_module_available('numpy'):
+        raise ValueError("пакет numpy не установлен")
+    if name not in AGGREGATION_BACKENDS:
+        raise ValueError(f"неизвестный движок агрегации '{name}'")
+    return name
+
+
+class MetricsOptions:
+    __slots__ = ('percentile_accuracy', 'url_normalizer', 'heavy_hitters', 'backend', 'group_by', 'metric')
+
+    def __init__(self, percentile_accuracy=None, url_normalizer=None, heavy_hitters=None, backend='python',
+                 group_by=DEFAULT_GROUP_BY, metric=DEFAULT_METRIC):
+        self.percentile_accuracy = percentile_accuracy
+        self.url_normalizer = url_normalizer
+        self.heavy_hitters = heavy_hitters
+        self.backend = backend
+        self.group_by = group_by
+        self.metric = metric
+
+    @property
+    def use_numpy(self):
+        return self.backend == 'numpy' and self.percentile_accuracy is None and not self.heavy_hitters
+
+    @property
+    def normalize_url(self):
+        return self.url_normalizer.normalize if self.url_normalizer is not None else None
+
+    @property
+    def normalize_key(self):
+        normalize = self.normalize_url
+        if normalize is None or 'url' not in self.group_by:
+            return None
+        if len(self.group_by) == 1:
+            return normalize
+        position = self.group_by.index('url')
+
+        def normalize_key(key):
+            return key[:position] + (normalize(key[position]),) + key[position + 1:]
+
+        return normalize_key
+
+    @property
+    def custom_schema(self):
+        return self.group_by != DEFAULT_GROUP_BY or self.metric != DEFAULT_METRIC
+
+    @property
+    def percentiles(self):
+        return self.percentile_accuracy is not None
+
+    def new_stats(self):
+        if self.percentile_accuracy is None:
+            return UrlStats()
+        return UrlStats(sketch=LatencySketch(self.percentile_accuracy))
+
+    def key(self):
+        key = {
+            'percentile_accuracy': self.percentile_accuracy,
+            'url_rules': self.url_normalizer.key() if self.url_normalizer is not None else None
+        }
+        if self.custom_schema:
+            key['group_by'] = list(self.group_by)
+            key['metric'] = self.metric
+        return key
+
+
+def accumulate_url_metrics(log_entries, url_stats=None):
+    if url_stats is None:
+        url_stats = {}
+
+    for entry in log_entries:
+        url = entry.get('url')
+        response_time = entry.get('response_time')
+
+        if url and isinstance(response_time, (int, float)):
+            stats = url_stats.get(url)
+            if stats is None:
+                stats = url_stats[url] = UrlStats()
+            stats.add(response_time)
+
+    return url_stats
+
+
+def accumulate_url_records(records, decoder, url_stats=None, options=None):
+    if url_stats is None:
+        url_stats = {}
+
+    options = options or MetricsOptions()
+    if options.use_numpy:
+        return accumulate_url_records_numpy(records, decoder, url_stats, options)
+    new_stats = options.new_stats
+    normalize_url = options.normalize_key
+    get_url = decoder.getter('key')
+    get_response_time = decoder.getter('metric')
+    for record in records:
+        url = get_url(record)
+        response_time = get_response_time(record)
+
+        if url and isinstance(response_time, (int, float)):
+            if normalize_url is not None:
+                url = normalize_url(url)
+            stats = url_stats.get(url)
+            if stats is None:
+                stats = url_stats[url] = new_stats()
+            stats.add(response_time)
+
+    return url_stats
+
+
+def group_values_by_id(ids, values):
+    import numpy
+
+    # Значения группируются по URL для точного сложения через fold_exact_sum: порядок внутри группы на сумму
+    # не влияет, поэтому хватает нестабильной сортировки.
+    order = numpy.argsort(ids)
+    ids, values = ids[order], values[order].tolist()
+    bounds = [0, *(numpy.flatnonzero(numpy.diff(ids)) + 1).tolist(), len(ids)]
+    return zip(ids[bounds[:-1]].tolist(), (values[start:end] for start, end in zip(bounds, bounds[1:])))
+
+
+class NumpyUrlColumns:
+    __slots__ = ('urls', 'counts', 'sums', 'minimums', 'maximums', 'has_float', 'ordered', 'order')
+
+    def __init__(self, capacity=1024):
+        import numpy
+
+        self.urls = []
+        self.counts = numpy.zeros(capacity, dtype=numpy.int64)
+        # Точная сумма каждого URL - тройка (high, low, tail), как в UrlStats.
+        self.sums = []
+        self.minimums = numpy.full(capacity, numpy.inf)
+        self.maximums = numpy.full(capacity, -numpy.inf)
+        self.has_float = numpy.zeros(capacity, dtype=bool)
+        self.ordered = numpy.zeros(capacity, dtype=bool)
+        self.order = []
+
+    def grow(self):
+        import numpy
+
+        size = len(self.counts)
+        for name, fill in (('counts', 0), ('minimums', numpy.inf), ('maximums', -numpy.inf), ('has_float', False),
+                           ('ordered', False)):
+            values = getattr(self, name)
+            setattr(self, name, numpy.concatenate((values, numpy.full(size, fill, dtype=values.dtype))))
+
+    def add_url(self, url, seed=None):
+        url_id = len(self.urls)
+        if url_id == len(self.counts):
+            self.grow()
+        self.urls.append(url)
+        self.sums.append((0, 0, None))
+        if seed is not None:
+            self.counts[url_id] = seed.count
+            self.sums[url_id] = (seed.sum_high, seed.sum_low, seed.sum_tail and list(seed.sum_tail))
+            if seed.min is not None:
+                self.minimums[url_id] = seed.min
+                self.maximums[url_id] = seed.max
+            self.has_float[url_id] = type(seed.total) is not int
+        return url_id
+
+    def add(self, url_ids, values, floats):
+        import numpy
+
+        self.counts += numpy.bincount(url_ids, minlength=len(self.counts))
+        sums = self.sums
+        for url_id, url_values in group_values_by_id(url_ids, values):
+            fold_exact_sum(url_values)
+            high, low, tail = sums[url_id]
+            for value in url_values:
+                high, low, tail = add_exact(high, low, tail, value)
+            sums[url_id] = high, low, tail
+        numpy.minimum.at(self.minimums, url_ids, values)
+        numpy.maximum.at(self.maximums, url_ids, values)
+        if floats is True:
+            self.has_float[url_ids] = True
+        elif floats is not False:
+            self.has_float[url_ids[floats]] = True
+
+        new_ids = url_ids[~self.ordered[url_ids]]
+        if len(new_ids):
+            unique_ids, first_positions = numpy.unique(new_ids, return_index=True)
+            self.order.extend(unique_ids[numpy.argsort(first_positions)].tolist())
+            self.ordered[unique_ids] = True
+
+    def store(self, url_stats):
+        for url_id in self.order:
+            count = int(self.counts[url_id])
+            high, low, tail = self.sums[url_id]
+            minimum, maximum = self.minimums[url_id].item(), self.maximums[url_id].item()
+            if not self.has_float[url_id]:
+                high, low, tail = int(exact_sum_value(high, low, tail)), 0, None
+                minimum, maximum = int(minimum), int(maximum)
+            url = self.urls[url_id]
+            stats = url_stats.get(url)
+            if stats is None:
+                stats = url_stats[url] = UrlStats(count, 0, minimum, maximum)
+            else:
+                stats.count, stats.min, stats.max = count, minimum, maximum
+            stats.sum_high, stats.sum_low, stats.sum_tail = high, low, tail
+        return url_stats
+
+
+def accumulate_url_records_numpy(records, decoder, url_stats=None, options=None, chunk_size=NUMPY_CHUNK_SIZE):
+    import numpy
+
+    if url_stats is None:
+        url_stats = {}
+
+    options = options or MetricsOptions()
+    normalize_url = options.normalize_key
+    get_urls = decoder.column('key')
+    get_response_times = decoder.column('metric')
+    columns = NumpyUrlColumns()
+    url_ids = {}
+    normalized_ids = {}
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, chunk_size))
+        if not batch:
+            break
+
+        raw_urls = get_urls(batch)
+        values = get_response_times(batch)
+        try:
+            ids = list(map(url_ids.get, raw_urls))
+        except TypeError:
+            ids = [url_ids.get(url) if url else -1 for url in raw_urls]
+        if None in ids:
+            for url in raw_urls:
+                if url in url_ids:
+                    continue
+                if not url:
+                    url_ids[url] = -1
+                    continue
+                name = normalize_url(url) if normalize_url is not None else url
+                url_id = normalized_ids.get(name)
+                if url_id is None:
+                    url_id = normalized_ids[name] = columns.add_url(name, url_stats.get(name))
+                url_ids[url] = url_id
+            ids = [url_ids[url] if url else -1 for url in raw_urls]
+
+        types = set(map(type, values))
+        if types <= NUMERIC_TYPES:
+            chunk_ids = numpy.array(ids, dtype=numpy.int64)
+            chunk_values = numpy.fromiter(values, dtype=numpy.float64, count=len(values))
+            if len(types) == 2:
+                floats = numpy.fromiter((type(value) is float for value in values), dtype=bool, count=len(values))
+            else:
+                floats = float in types
+        else:
+            kept = [position for position, value in enumerate(values) if isinstance(value, (int, float))]
+            chunk_ids = numpy.array([ids[position] for position in kept], dtype=numpy.int64)
+            chunk_values = numpy.array([values[position] for position in kept], dtype=numpy.float64)
+            floats = numpy.array([type(values[position]) is float for position in kept], dtype=bool)
+
+        selected = chunk_ids >= 0
+        if not selected.all():
+            chunk_ids, chunk_values = chunk_ids[selected], chunk_values[selected]
+            if type(floats) is not bool:
+                floats = floats[selected]
+        if len(chunk_ids):
+            columns.add(chunk_ids, chunk_values, floats)
+
+    return columns.store(url_stats)
+
+
+class SpaceSaving:
+    __slots__ = ('capacity', 'new_stats', 'entries', 'errors', 'heap', 'sequence')
+
+    def __init__(self, capacity, new_stats=UrlStats):
+        self.capacity = capacity
+        self.new_stats = new_stats
+        self.entries = {}
+        self.errors = {}
+        self.heap = []
+        self.sequence = 0
+
+    def estimate(self, url):
+        return self.entries[url].count + self.errors[url]
+
+    def floor(self):
+        if len(self.entries) < self.capacity:
+            return 0
+        return min(stats.count + self.errors[url] for url, stats in self.entries.items())
+
+    def admit(self, url):
+        error = 0
+        if len(self.entries) >= self.capacity:
+            # Ключи в куче устаревают по мере роста счётчиков: обновляем их, пока минимум не станет актуальным.
+            while True:
+                estimate, _, victim = self.heap[0]
+                current = self.estimate(victim)
+                if current == estimate:
+                    break
+                heapq.heapreplace(self.heap, (current, self.next_sequence(), victim))
+            heapq.heappop(self.heap)
+            del self.entries[victim]
+            del self.errors[victim]
+            error = estimate
+
+        stats = self.entries[url] = self.new_stats()
+        self.errors[url] = error
+        heapq.heappush(self.heap, (error, self.next_sequence(), url))
+        return stats
+
+    def next_sequence(self):
+        self.sequence += 1
+        return self.sequence
+
+    def merge(self, other):
+        floor, other_floor = self.floor(), other.floor()
+        for url in self.entries:
+            if url not in other.entries:
+                self.errors[url] += other_floor
+        for url, stats in other.entries.items():
+            if url in self.entries:
+                self.entries[url].merge(stats)
+                self.errors[url] += other.errors[url]
+            else:
+                self.entries[url] = UrlStats().merge(stats)
+                self.errors[url] = other.errors[url] + floor
+
+        kept = heapq.nlargest(self.capacity, self.entries, key=self.estimate)
+        self.entries = {url: self.entries[url] for url in kept}
+        self.errors = {url: self.errors[url] for url in kept}
+        self.heap = [(self.estimate(url), self.next_sequence(), url) for url in kept]
+        heapq.heapify(self.heap)
+        return self
+
+    def top(self, k):
+        return [(url, self.entries[url], self.estimate(url))
+                for url in heapq.nlargest(k, self.entries, key=self.estimate)]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def accumulate_heavy_hitters(records, decoder, summary=None, options=None):
+    options = options or MetricsOptions()
+    if summary is None:
+        summary = SpaceSaving(options.heavy_hitters, options.new_stats)
+
+    entries, admit = summary.entries, summary.admit
+    normalize_url = options.normalize_key
+    get_url = decoder.getter('key')
+    get_response_time = decoder.getter('metric')
+    for record in records:
+        url = get_url(record)
+        response_time = get_response_time(record)
+
+        if url and isinstance(response_time, (int, float)):
+            if normalize_url is not None:
+                url = normalize_url(url)
+            stats = entries.get(url)
+            if stats is None:
+                stats = admit(url)
+            stats.add(response_time)
+
+    return summary
+
+
+def merge_url_stats(url_stats, other_url_stats):
+    for url, stats in other_url_stats.items():
+        if url in url_stats:
+            url_stats[url].merge(stats)
+        else:
+            url_stats[url] = UrlStats().merge(stats)
+    return url_stats
+
+
+def finalize_url_metrics(url_stats, percentiles=False):
+    final_metrics = {}
+    for url, stats in url_stats.items():
+        final_metrics[url] = {
+            'total': stats.count,
+            'avg_time': stats.avg
+        }
+        if percentiles:
+            for name, q in REPORTED_PERCENTILES:
+                final_metrics[url][name] = stats.percentile(q)
+            final_metrics[url]['max'] = stats.max
+
+    return final_metrics
+
+
+def parse_bucket_duration(text):
+    match = re.fullmatch(r'\s*(\d+)\s*([smhd]?)\s*', text or '')
+    if match is None:
+        raise ValueError(f"неверный формат интервала '{text}', ожидается например 30s, 1m, 1h или 1d")
+    seconds = int(match.group(1)) * BUCKET_UNITS[match.group(2) or 's']
+    if seconds <= 0:
+        raise ValueError(f"интервал должен быть положительным, получено '{text}'")
+    return seconds
+
+
+def timestamp_epoch_seconds(timestamp_str):
+    try:
+        moment = datetime.datetime.fromisoformat(timestamp_str)
+    except (ValueError, TypeError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def format_bucket_start(bucket, bucket_seconds):
+    moment = datetime.datetime.fromtimestamp(bucket * bucket_seconds, tz=datetime.timezone.utc)
+    return moment.strftime('%Y-%m-%d %H:%M:%S' if bucket_seconds % 60 else '%Y-%m-%d %H:%M')
+
+
+class BucketedStats:
+    __slots__ = ('bucket_seconds', 'url_ids', 'urls', 'cells', 'counts', 'sums', 'errors', 'tails')
+
+    def __init__(self, bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+        self.url_ids = {}
+        self.urls = []
+        self.cells = {}
+        self.counts = array.array('q')
+        # Суммы ячеек точные, как в UrlStats: в sums - сумма, в errors - её ошибка округления, а редкие
+        # остатки сверх этого - в словаре tails. --workers и слияние дают тот же вывод, что и один проход.
+        self.sums = array.array('d')
+        self.errors = array.array('d')
+        self.tails = {}
+
+    def intern_url(self, url):
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.urls)
+            self.urls.append(url)
+        return url_id
+
+    def cell(self, bucket, url_id):
+        key = (bucket << BUCKET_URL_ID_BITS) | url_id
+        index = self.cells.get(key)
+        if index is None:
+            index = self.cells[key] = len(self.counts)
+            self.counts.append(0)
+            self.sums.append(0.0)
+            self.errors.append(0.0)
+        return index
+
+    def add_to_sum(self, index, value):
+        tails = self.tails
+        self.sums[index], self.errors[index], tail = add_exact(self.sums[index], self.errors[index],
+                                                               tails.get(index), value)
+        if tail is not None:
+            tails[index] = tail
+        elif index in tails:
+            del tails[index]
+
+    def add_rest(self, index, rest):
+        if rest - rest:
+            # NaN и бесконечности: сумма уже лежит в sums.
+            self.errors[index] = 0.0
+            self.tails.pop(index, None)
+        else:
+            self.tails[index] = add_exact_tail(self.tails.get(index), rest)
+
+    def add(self, index, response_time):
+        self.counts[index] += 1
+        self.add_to_sum(index, response_time)
+
+    def merge(self, other):
+        if other.bucket_seconds != self.bucket_seconds:
+            raise ValueError("нельзя объединить агрегаты с разными интервалами")
+        url_id_map = [self.intern_url(url) for url in other.urls]
+        url_mask = (1 << BUCKET_URL_ID_BITS) - 1
+        for key, other_index in other.cells.items():
+            index = self.cell(key >> BUCKET_URL_ID_BITS, url_id_map[key & url_mask])
+            self.counts[index] += other.counts[other_index]
+            for term in exact_sum_terms(other.sums[other_index], other.errors[other_index],
+                                        other.tails.get(other_index)):
+                self.add_to_sum(index, term)
+        return self
+
+    def rows(self):
+        url_mask = (1 << BUCKET_URL_ID_BITS) - 1
+        for key, index in self.cells.items():
+            count = self.counts[index]
+            total = exact_sum_value(self.sums[index], self.errors[index], self.tails.get(index))
+            yield key >> BUCKET_URL_ID_BITS, self.urls[key & url_mask], count, total / count
+
+    def __len__(self):
+        return len(self.cells)
+
+
+def accumulate_bucketed_records(records, decoder, bucket_seconds, table=None, options=None):
+    if table is None:
+        table = BucketedStats(bucket_seconds)
+
+    normalize_url = (options or MetricsOptions()).normalize_key
+    get_url = decoder.getter('key')
+    get_response_time = decoder.getter('metric')
+    get_timestamp = decoder.getter('timestamp')
+    url_ids, intern_url = table.url_ids, table.intern_url
+    cells, cell = table.cells, table.cell
+    counts, sums, errors, add_rest = table.counts, table.sums, table.errors, table.add_rest
+    bucket_cache = {}
+    for record in records:
+        url = get_url(record)
+        response_time = get_response_time(record)
+        if not url or not isinstance(response_time, (int, float)):
+            continue
+
+        timestamp_str = get_timestamp(record)
+        try:
+            bucket = bucket_cache[timestamp_str]
+        except (KeyError, TypeError):
+            seconds = timestamp_epoch_seconds(timestamp_str)
+            bucket = None if seconds is None else int(seconds // bucket_seconds)
+            if type(timestamp_str) is str:
+                if len(bucket_cache) >= BUCKET_TIMESTAMP_CACHE_SIZE:
+                    bucket_cache.clear()
+                bucket_cache[timestamp_str] = bucket
+        if bucket is None:
+            continue
+
+        if normalize_url is not None:
+            url = normalize_url(url)
+        url_id = url_ids.get(url)
+        if url_id is None:
+            url_id = intern_url(url)
+        index = cells.get((bucket << BUCKET_URL_ID_BITS) | url_id)
+        if index is None:
+            index = cell(bucket, url_id)
+        counts[index] += 1
+        # Точное сложение, как в UrlStats.add.
+        high = sums[index]
+        total = sums[index] = high + response_time
+        shifted = total - high
+        error = (high - (total - shifted)) + (response_time - shifted)
+        if error:
+            low = errors[index]
+            new_low = errors[index] = low + error
+            shifted = new_low - low
+            rest = (low - (new_low - shifted)) + (error - shifted)
+            if rest:
+                add_rest(index, rest)
+
+    return table
+
+
+def url_stats_sort_key(by):
+    if by == 'total':
+        return operator.attrgetter('count')
+    if by == 'avg':
+        return operator.attrgetter('avg')
+    if by == 'max':
+        get_value = operator.attrgetter('max')
+    else:
+        get_value = operator.methodcaller('percentile', dict(REPORTED_PERCENTILES)[by])
+
+    def sort_key(stats):
+        value = get_value(stats)
+        return -math.inf if value is None else value
+
+    return sort_key
+
+
+def select_top_url_stats(url_stats, top, by='total'):
+    sort_key = url_stats_sort_key(by)
+    return dict(heapq.nlargest(top, url_stats.items(), key=lambda item: sort_key(item[1])))
+
+
+def finalize_heavy_hitters(summary, top, percentiles=False):
+    selected = summary.top(top)
+    final_metrics = finalize_url_metrics({url: stats for url, stats, _ in selected}, percentiles)
+    for url, _, estimate in selected:
+        final_metrics[url]['total'] = estimate
+    return final_metrics
+
+
+def dump_url_stats(url_stats):
+    return {
+        'version': URL_STATS_FORMAT_VERSION,
+        'urls': {url: stats.to_dict() for url, stats in url_stats.items()}
+    }
+
+
+def restore_url_stats(data):
+    if data.get('version') != URL_STATS_FORMAT_VERSION:
+        raise ValueError(f"неподдерживаемая версия формата агрегатов: {data.get('version')}")
+    return {url: UrlStats.from_dict(stats) for url, stats in data['urls'].items()}
+
+
+def save_url_stats(url_stats, filepath):
+    with open(filepath, 'w', encoding='utf-8') as f:
+        json.dump(dump_url_stats(url_stats), f, ensure_ascii=False)
+
+
+def load_url_stats(filepath):
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return restore_url_stats(json.load(f))
+
+
+def analyze_url_metrics(log_entries):
+    return finalize_url_metrics(accumulate_url_metrics(log_entries))
+
+
+def analyze_log_shard(shard, window=None, decoder_name='auto', options=None, bucket_seconds=None,
+                      timestamp_field_name='@timestamp'):
+    filepath, start, end = shard
+    counters = {'parsed': 0, 'matched': 0, 'date_skipped': 0}
+    schema = options or MetricsOptions()
+    decoder = make_record_decoder(decoder_name, timestamp_field_name, schema.group_by, schema.metric)
+    records = iter_log_shard_entries(filepath, start, end, window, counters=counters, decoder=decoder)
+    records = count_log_entries(records, counters, 'parsed')
+    if window:
+        records = count_log_entries(iter_records_in_window(records, window, decoder), counters, 'matched')
+    if bucket_seconds:
+        return accumulate_bucketed_records(records, decoder, bucket_seconds, options=options), counters
+    if options is not None and options.heavy_hitters:
+        return accumulate_heavy_hitters(records, decoder, options=options), counters
+    return accumulate_url_records(records, decoder, options=options), counters
+
+
+def analyze_log_files_parallel(filepaths, workers, window=None, decoder_name='auto', options=None,
+                               bucket_seconds=None, segments=(), timestamp_field_name='@timestamp', url_stats=None):
+    shards = plan_log_shards(filepaths, workers * SHARDS_PER_WORKER, segments)
+    if url_stats is None and bucket_seconds:
+        url_stats = BucketedStats(bucket_seconds)
+    elif url_stats is None and options is not None and options.heavy_hitters:
+        url_stats = SpaceSaving(options.heavy_hitters, options.new_stats)
+    elif url_stats is None:
+        url_stats = {}
+    counters = {'parsed': 0, 'matched': 0, 'date_skipped': 0}
+    if not shards:
+        return url_stats, counters
+
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(analyze_log_shard, shards, itertools.repeat(window), itertools.repeat(decoder_name),
+                               itertools.repeat(options), itertools.repeat(bucket_seconds),
+                               itertools.repeat(timestamp_field_name))
+        for shard_url_stats, shard_counters in results:
+            if isinstance(url_stats, dict):
+                merge_url_stats(url_stats, shard_url_stats)
+            else:
+                url_stats.merge(shard_url_stats)
+            for key, value in shard_counters.items():
+                counters[key] = counters.get(key, 0) + value
+    return url_stats, counters
+
+
+def state_filter_key(window=None, options=None):
+    return {
+        'window': [window.lo, window.hi] if window else None,
+        **(options or MetricsOptions()).key()
+    }
+
+
+def empty_incremental_state(window=None, options=None):
+    return {
+        'version': STATE_FORMAT_VERSION,
+        'filter': state_filter_key(window, options),
+        'files': {},
+        'stats': dump_url_stats({})
+    }
+
+
+def load_incremental_state(filepath, window=None, options=None):
+    if not os.path.exists(filepath):
+        return empty_incremental_state(window, options)
+
+    with open(filepath, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    if state.get('version') != STATE_FORMAT_VERSION:
+        raise ValueError(f"неподдерживаемая версия файла состояния: {state.get('version')}")
+    if state.get('filter') != state_filter_key(window, options):
+        print(f"Внимание: Фильтр дат или параметры метрик изменились с момента прошлого запуска, "
+              f"состояние '{filepath}' сброшено.", file=sys.stderr)
+        return empty_incremental_state(window, options)
+    return state
+
+
+def write_json_atomic(filepath, data):
+    temp_filepath = f"{filepath}.tmp"
+    with open(temp_filepath, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_filepath, filepath)
+
+
+def save_incremental_state(filepath, state):
+    write_json_atomic(filepath, state)
+
+
+def file_head_hash(filepath, length):
+    import hashlib
+
+    with open(filepath, 'rb') as f:
+        return hashlib.sha1(f.read(length)).hexdigest()
+
+
+def complete_lines_end(filepath, start, size):
+    if size <= start:
+        return start
+    with open(filepath, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            last_newline = mapped.rfind(b'\n', start, size)
+    return start if last_newline < 0 else last_newline + 1
+
+
+def find_previous_checkpoint(filepath, stat, previous_files):
+    previous = previous_files.get(filepath)
+    if previous and previous['inode'] == stat.st_ino and previous['device'] == stat.st_dev:
+        return previous
+    for candidate in previous_files.values():
+        if candidate['inode'] == stat.st_ino and candidate['device'] == stat.st_dev:
+            return candidate
+    return None
+
+
+def find_rotated_checkpoint(filepath, compression, previous_files):
+    import hashlib
+
+    with open_decompressed(filepath, compression) as stream:
+        head = b''
+        while len(head) < STATE_HEAD_BYTES:
+            chunk = stream.read(STATE_HEAD_BYTES - len(head))
+            if not chunk:
+                break
+            head += chunk
+    for candidate in previous_files.values():
+        if candidate['head'] is None or not candidate['offset']:
+            continue
+        length = min(candidate['offset'], STATE_HEAD_BYTES)
+        if len(head) >= length and hashlib.sha1(head[:length]).hexdigest() == candidate['head']:
+            return candidate
+    return None
+
+
+def plan_incremental_read(filepath, previous_files):
+    stat = os.stat(filepath)
+    size = stat.st_size
+    previous = find_previous_checkpoint(filepath, stat, previous_files)
+    compression = detect_compression(filepath) if size > 0 else None
+    compressed = compression is not None
+
+    if compressed:
+        unchanged = previous is not None and previous['size'] == size and previous['mtime'] == stat.st_mtime
+        start, end = (size, size) if unchanged else (0, None)
+        if previous is None:
+            # Сжатая копия ротированного лога: её начало уже учтено в контрольной точке исходного файла,
+            # читаем только строки, дописанные после прошлого запуска.
+            rotated = find_rotated_checkpoint(filepath, compression, previous_files)
+            if rotated is not None:
+                start = rotated['offset']
+        offset = size
+    else:
+        start = 0
+        if previous is not None:
+            head_length = min(previous['offset'], STATE_HEAD_BYTES)
+            if size < previous['offset'] or file_head_hash(filepath, head_length) != previous['head']:
+                print(f"Внимание: Файл '{filepath}' был усечён или перезаписан, читаем его с начала.",
+                      file=sys.stderr)
+            else:
+                start = previous['offset']
+        end = complete_lines_end(filepath, start, size)
+        offset = end
+
+    checkpoint = {
+        'device': stat.st_dev,
+        'inode': stat.st_ino,
+        'size': size,
+        'mtime': stat.st_mtime,
+        'offset': offset,
+        'head': file_head_hash(filepath, min(offset, STATE_HEAD_BYTES)) if not compressed else None
+    }
+    return start, end, checkpoint
+
+
+def analyze_log_files_incremental(filepaths, state, decoder, window=None, options=None):
+    counters = {'parsed': 0, 'matched': 0, 'date_skipped': 0}
+    url_stats = restore_url_stats(state['stats'])
+    # Контрольные точки файлов, не переданных в этот раз, сохраняются: их строки уже лежат в stats, и при
+    # следующем запуске с ними файл не будет прочитан с начала повторно.
+    files = dict(state['files'])
+
+    for filepath in iter_existing_files(filepaths):
+        try:
+            start, end, checkpoint = plan_incremental_read(filepath, state['files'])
+        except IOError as e:
+            print(f"Ошибка при чтении файла '{filepath}': {e}", file=sys.stderr)
+            continue
+
+        if end is None or end > start:
+            records = iter_log_shard_entries(filepath, start, end, window, counters=counters, decoder=decoder)
+            records = count_log_entries(records, counters, 'parsed')
+            if window:
+                records = count_log_entries(iter_records_in_window(records, window, decoder), counters, 'matched')
+            accumulate_url_records(records, decoder, url_stats, options)
+        files[filepath] = checkpoint
+
+    new_state = {
+        'version': STATE_FORMAT_VERSION,
+        'filter': state_filter_key(window, options),
+        'files': files,
+        'stats': dump_url_stats(url_stats)
+    }
+    return url_stats, counters, new_state
+
+
+def log_index_path(filepath):
+    return filepath + LOG_INDEX_SUFFIX
+
+
+def empty_log_index(timestamp_field_name='@timestamp'):
+    return {
+        'version': LOG_INDEX_FORMAT_VERSION,
+        'timestamp_field': timestamp_field_name,
+        'end': 0,
+        'head': None,
+        'undated': 0,
+        'days': {}
+    }
+
+
+def load_log_index(filepath):
+    try:
+        with open(log_index_path(filepath), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    if index.get('version') != LOG_INDEX_FORMAT_VERSION:
+        raise ValueError(f"неподдерживаемая версия индекса: {index.get('version')}")
+    for entry in index['days'].values():
+        entry['urls'] = {url: UrlStats.from_dict(stats) for url, stats in entry['urls'].items()}
+    return index
+
+
+def save_log_index(filepath, index):
+    days = {day: {**entry, 'urls': {url: stats.to_dict() for url, stats in entry['urls'].items()}}
+            for day, entry in index['days'].items()}
+    write_json_atomic(log_index_path(filepath), {**index, 'days': days})
+
+
+def log_index_is_current(filepath, index, timestamp_field_name='@timestamp'):
+    if index['timestamp_field'] != timestamp_field_name or os.path.getsize(filepath) < index['end']:
+        return False
+    return file_head_hash(filepath, min(index['end'], STATE_HEAD_BYTES)) == index['head']
+
+
+def extend_log_index(filepath, index, decoder):
+    start = index['end']
+    end = complete_lines_end(filepath, start, os.path.getsize(filepath))
+    if end <= start:
+        return index
+
+    days = index['days']
+    decode = decoder.decode
+    check_object = not decoder.projected
+    get_url = decoder.getter('url')
+    get_response_time = decoder.getter('response_time')
+    get_timestamp = decoder.getter('timestamp')
+    position = start
+    with open(filepath, 'rb') as f:
+        for raw_line in iter_mmap_lines(f, start, end):
+            offset = position
+            position += len(raw_line)
+            if raw_line.isspace():
+                continue
+            try:
+                record = decode(raw_line)
+            except ValueError:
+                warn_unparsable_line(raw_line, filepath)
+                continue
+            if check_object and type(record) is not dict:
+                warn_unparsable_line(raw_line, filepath)
+                continue
+
+            day = timestamp_date_prefix(get_timestamp(record))
+            if day is None:
+                index['undated'] += 1
+                continue
+            entry = days.get(day)
+            if entry is None:
+                entry = days[day] = {'start': offset, 'end': position, 'lines': 0, 'urls': {}, 'first': {}}
+            entry['end'] = position
+            entry['lines'] += 1
+
+            url = get_url(record)
+            response_time = get_response_time(record)
+            if url and isinstance(response_time, (int, float)):
+                stats = entry['urls'].get(url)
+                if stats is None:
+                    stats = entry['urls'][url] = UrlStats()
+                    entry['first'][url] = offset
+                stats.add(response_time)
+
+    index['end'] = end
+    index['head'] = file_head_hash(filepath, min(end, STATE_HEAD_BYTES))
+    return index
+
+
+def update_log_index(filepath, index=None, decoder=None):
+    if decoder is None:
+        decoder = make_dict_decoder()
+    if os.path.getsize(filepath) and detect_compression(filepath) is not None:
+        raise ValueError("сжатые файлы не индексируются")
+    if index is not None and not log_index_is_current(filepath, index, decoder.timestamp_field_name):
+        print(f"Внимание: Файл '{filepath}' был усечён или перезаписан, индекс строится заново.", file=sys.stderr)
+        index = None
+    if index is None:
+        index = empty_log_index(decoder.timestamp_field_name)
+    return extend_log_index(filepath, index, decoder)
+
+
+def refresh_log_index(filepath, decoder=None):
+    index = load_log_index(filepath)
+    if index is None:
+        return None
+    timestamp_field_name = decoder.timestamp_field_name if decoder is not None else '@timestamp'
+    if index['timestamp_field'] != timestamp_field_name:
+        # Индекс по другому полю не перестраивается: он нужен отчётам по своему полю, а этот отчёт читает лог.
+        raise ValueError(f"индекс построен по полю '{index['timestamp_field']}', а не '{timestamp_field_name}'")
+
+    previous_end, previous_head = index['end'], index['head']
+    index = update_log_index(filepath, index, decoder)
+    if (index['end'], index['head']) != (previous_end, previous_head):
+        try:
+            save_log_index(filepath, index)
+        except IOError as e:
+            print(f"Внимание: Не удалось обновить индекс '{log_index_path(filepath)}': {e}", file=sys.stderr)
+    return index
+
+
+def merge_byte_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(byte_range) for byte_range in merged]
+
+
+def plan_indexed_reads(filepaths, window, counters, use_summaries=False, decoder=None):
+    # Чтения идут в порядке файлов: ('file', путь), ('segment', (путь, начало, конец)) или ('summary', агрегаты).
+    reads = []
+    for filepath in filepaths:
+        index = None
+        if os.path.isfile(log_index_path(filepath)):
+            try:
+                index = refresh_log_index(filepath, decoder)
+            except (IOError, ValueError, KeyError, TypeError) as e:
+                print(f"Внимание: Индекс '{log_index_path(filepath)}' не используется: {e}", file=sys.stderr)
+        if index is None:
+            reads.append(('file', filepath))
+            continue
+
+        ranges = []
+        url_stats = {}
+        first_offsets = {}
+        counters['date_skipped'] += index['undated']
+        for day, entry in index['days'].items():
+            if not window.contains_day(day):
+                counters['date_skipped'] += entry['lines']
+            elif use_summaries:
+                counters['summarized'] += entry['lines']
+                merge_url_stats(url_stats, entry['urls'])
+                for url, offset in entry['first'].items():
+                    first_offsets[url] = min(offset, first_offsets.get(url, offset))
+            else:
+                ranges.append((entry['start'], entry['end']))
+        if url_stats:
+            # URL идут в том же порядке, что и при чтении файла подряд: по смещению первой строки с ними.
+            reads.append(('summary', {url: url_stats[url] for url in sorted(url_stats, key=first_offsets.get)}))
+        reads.extend(('segment', (filepath, start, end)) for start, end in merge_byte_ranges(ranges))
+        size = os.path.getsize(filepath)
+        if size > index['end']:
+            reads.append(('segment', (filepath, index['end'], size)))
+    return reads
+
+
+def group_log_reads(reads):
+    # Подряд идущие файлы и отрезки читаются за один проход, сводка индекса вливается сразу за ними.
+    files, segments = [], []
+    for kind, item in reads:
+        if kind == 'summary':
+            yield files, segments, item
+            files, segments = [], []
+        elif kind == 'segment':
+            segments.append(item)
+        else:
+            if segments:
+                yield files, segments, None
+                files, segments = [], []
+            files.append(item)
+    yield files, segments, None
+
+
+def iter_log_segment_entries(segments, window=None, counters=None, decoder=None, stats=None):
+    for filepath, start, end in segments:
+        yield from iter_log_shard_entries(filepath, start, end, window, counters=counters, decoder=decoder,
+                                          stats=stats)
+
+
+class ColumnarLog:
+    __slots__ = ('urls', 'days', 'timestamps', 'url_ids', 'response_times', 'sources', 'integral')
+
+    def __init__(self, urls=None, sources=None, integral=True):
+        self.urls = urls if urls is not None else []
+        self.sources = sources if sources is not None else []
+        # Все времена ответа в исходных логах целые: при чтении они возвращаются как int, а не float.
+        self.integral = integral
+        for name, typecode in COLUMNAR_COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.days)
+
+
+def is_columnar_log(filepath):
+    try:
+        with open(filepath, 'rb') as f:
+            return f.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+    except (IOError, TypeError):
+        return False
+
+
+def convert_to_columnar(filepaths, decoder=None):
+    if decoder is None:
+        decoder = make_dict_decoder()
+
+    columns = ColumnarLog()
+    url_ids = {}
+    day_cache = {}
+    timestamp_cache = {}
+    get_url = decoder.getter('url')
+    get_response_time = decoder.getter('response_time')
+    get_timestamp = decoder.getter('timestamp')
+    add_day, add_timestamp = columns.days.append, columns.timestamps.append
+    add_url_id, add_response_time = columns.url_ids.append, columns.response_times.append
+    for filepath in iter_existing_files(filepaths):
+        stat = os.stat(filepath)
+        columns.sources.append({'path': os.path.abspath(filepath), 'size': stat.st_size, 'mtime': stat.st_mtime})
+        for record in iter_log_entries([filepath], decoder=decoder):
+            timestamp_str = get_timestamp(record)
+            try:
+                day, timestamp = timestamp_cache[timestamp_str]
+            except (KeyError, TypeError):
+                day_str = timestamp_date_prefix(timestamp_str)
+                day = day_cache.get(day_str)
+                if day is None:
+                    day = day_cache[day_str] = datetime.date.fromisoformat(day_str).toordinal() if day_str else 0
+                seconds = timestamp_epoch_seconds(timestamp_str)
+                timestamp = MISSING_TIMESTAMP if seconds is None else math.floor(seconds)
+                if type(timestamp_str) is str:
+                    if len(timestamp_cache) >= BUCKET_TIMESTAMP_CACHE_SIZE:
+                        timestamp_cache.clear()
+                    timestamp_cache[timestamp_str] = day, timestamp
+
+            url = get_url(record)
+            url_id = -1
+            if url and type(url) is str:
+                url_id = url_ids.get(url)
+                if url_id is None:
+                    url_id = url_ids[url] = len(columns.urls)
+                    columns.urls.append(url)
+            response_time = get_response_time(record)
+            if type(response_time) is float:
+                columns.integral = False
+
+            add_day(day)
+            add_timestamp(timestamp)
+            add_url_id(url_id)
+            add_response_time(response_time if isinstance(response_time, (int, float)) else math.nan)
+    return columns
+
+
+def save_columnar_log(filepath, columns):
+    blobs = []
+    descriptors = []
+    offset = 0
+    for name, typecode in COLUMNAR_COLUMNS:
+        values = getattr(columns, name)
+        if sys.byteorder == 'big':
+            values = array.array(typecode, values)
+            values.byteswap()
+        blob = values.tobytes()
+        blob += b'\0' * (-len(blob) % COLUMNAR_ALIGNMENT)
+        descriptors.append({'name': name, 'type': typecode, 'offset': offset, 'length': len(values)})
+        blobs.append(blob)
+        offset += len(blob)
+
+    header = json.dumps({
+        'version': COLUMNAR_FORMAT_VERSION,
+        'rows': len(columns),
+        'urls': columns.urls,
+        'sources': columns.sources,
+        'integral': columns.integral,
+        'columns': descriptors
+    }, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (-(len(COLUMNAR_MAGIC) + 8 + len(header)) % COLUMNAR_ALIGNMENT)
+
+    temp_filepath = f"{filepath}.tmp"
+    with open(temp_filepath, 'wb') as f:
+        f.write(COLUMNAR_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(temp_filepath, filepath)
+
+
+def load_columnar_log(filepath):
+    with open(filepath, 'rb') as f:
+        if f.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError("файл не является колоночным логом")
+        header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+        if header.get('version') != COLUMNAR_FORMAT_VERSION:
+            raise ValueError(f"неподдерживаемая версия колоночного формата: {header.get('version')}")
+
+        columns = ColumnarLog(header['urls'], header['sources'], header.get('integral', False))
+        data_start = f.tell()
+        for descriptor in header['columns']:
+            values = array.array(descriptor['type'])
+            f.seek(data_start + descriptor['offset'])
+            values.frombytes(f.read(descriptor['length'] * values.itemsize))
+            if len(values) != header['rows']:
+                raise ValueError(f"колонка {descriptor['name']} повреждена")
+            if sys.byteorder == 'big':
+                values.byteswap()
+            setattr(columns, descriptor['name'], values)
+    return columns
+
+
+def warn_stale_columnar_sources(filepath, columns):
+    for source in columns.sources:
+        try:
+            stat = os.stat(source['path'])
+        except OSError:
+            continue
+        if stat.st_size != source['size'] or stat.st_mtime != source['mtime']:
+            print(f"Внимание: Исходный файл '{source['path']}' изменился после конвертации в '{filepath}'.",
+                  file=sys.stderr)
+
+
+def iter_columnar_rows(columns, window=None, counters=None):
+    response_times = columns.response_times
+    if columns.integral:
+        response_times = (value if value != value else int(value) for value in response_times)
+    rows = zip(columns.days, columns.url_ids, response_times, columns.timestamps)
+    if counters is not None:
+        counters['parsed'] += len(columns)
+    if window:
+        lo = window.date_from.toordinal() if window.date_from else 1
+        hi = window.date_to.toordinal() if window.date_to else datetime.date.max.toordinal()
+        matched = 0
+        for day, url_id, response_time, timestamp in rows:
+            if lo <= day <= hi:
+                matched += 1
+                if url_id >= 0 and response_time == response_time:
+                    yield url_id, response_time, timestamp
+        if counters is not None:
+            counters['matched'] += matched
+            counters['date_skipped'] += len(columns) - matched
+        return
+
+    for day, url_id, response_time, timestamp in rows:
+        if url_id >= 0 and response_time == response_time:
+            yield url_id, response_time, timestamp
+
+
+def accumulate_columnar_log_numpy(columns, urls, url_stats, window=None, counters=None):
+    import numpy
+
+    url_ids = numpy.frombuffer(columns.url_ids, dtype=numpy.int32)
+    response_times = numpy.frombuffer(columns.response_times, dtype=numpy.float64)
+    selected = (url_ids >= 0) & ~numpy.isnan(response_times)
+    if counters is not None:
+        counters['parsed'] += len(columns)
+    if window:
+        days = numpy.frombuffer(columns.days, dtype=numpy.int32)
+        in_window = numpy.ones(len(columns), dtype=bool)
+        if window.date_from:
+            in_window &= days >= window.date_from.toordinal()
+        if window.date_to:
+            in_window &= days <= window.date_to.toordinal()
+        in_window &= days > 0
+        selected &= in_window
+        if counters is not None:
+            matched = int(numpy.count_nonzero(in_window))
+            counters['matched'] += matched
+            counters['date_skipped'] += len(columns) - matched
+
+    url_ids, response_times = url_ids[selected], response_times[selected]
+    if not len(url_ids):
+        return url_stats
+    url_count = len(urls)
+    counts = numpy.bincount(url_ids, minlength=url_count)
+    values_by_id = dict(group_values_by_id(url_ids, response_times))
+    minimums = numpy.full(url_count, numpy.inf)
+    numpy.minimum.at(minimums, url_ids, response_times)
+    maximums = numpy.full(url_count, -numpy.inf)
+    numpy.maximum.at(maximums, url_ids, response_times)
+
+    cast = int if columns.integral else float
+    unique_ids, first_positions = numpy.unique(url_ids, return_index=True)
+    for url_id in unique_ids[numpy.argsort(first_positions)].tolist():
+        stats = UrlStats(int(counts[url_id]), 0, cast(minimums[url_id]), cast(maximums[url_id]))
+        terms = values_by_id[url_id]
+        fold_exact_sum(terms)
+        for term in terms:
+            stats.add_to_total(cast(term))
+        url = urls[url_id]
+        if url in url_stats:
+            url_stats[url].merge(stats)
+        else:
+            url_stats[url] = stats
+    return url_stats
+
+
+def accumulate_columnar_log(columns, aggregate, window=None, options=None, counters=None):
+    options = options or MetricsOptions()
+    urls = columns.urls
+    if options.normalize_url is not None:
+        urls = [options.normalize_url(url) for url in urls]
+    rows = iter_columnar_rows(columns, window, counters)
+
+    if isinstance(aggregate, BucketedStats):
+        bucket_seconds = aggregate.bucket_seconds
+        url_ids = [aggregate.intern_url(url) for url in urls]
+        add = aggregate.add
+        for url_id, response_time, timestamp in rows:
+            if timestamp != MISSING_TIMESTAMP:
+                add(aggregate.cell(timestamp // bucket_seconds, url_ids[url_id]), response_time)
+        return aggregate
+
+    if isinstance(aggregate, SpaceSaving):
+        entries, admit = aggregate.entries, aggregate.admit
+        for url_id, response_time, _ in rows:
+            url = urls[url_id]
+            stats = entries.get(url)
+            if stats is None:
+                stats = admit(url)
+            stats.add(response_time)
+        return aggregate
+
+    if options.use_numpy:
+        return accumulate_columnar_log_numpy(columns, urls, aggregate, window, counters)
+
+    stats_by_id = [None] * len(urls)
+    seen_ids = []
+    new_stats = options.new_stats
+    for url_id, response_time, _ in rows:
+        stats = stats_by_id[url_id]
+        if stats is None:
+            stats = stats_by_id[url_id] = new_stats()
+            seen_ids.append(url_id)
+        stats.add(response_time)
+    for url_id in seen_ids:
+        url, stats = urls[url_id], stats_by_id[url_id]
+        if url in aggregate:
+            aggregate[url].merge(stats)
+        else:
+            aggregate[url] = stats
+    return aggregate
+
+
+def accumulate_daily_rollups(records, decoder, rollups=None, options=None):
+    if rollups is None:
+        rollups = {}
+
+    new_stats = (options or MetricsOptions()).new_stats
+    get_url = decoder.getter('url')
+    get_response_time = decoder.getter('response_time')
+    get_timestamp = decoder.getter('timestamp')
+    for record in records:
+        day = timestamp_date_prefix(get_timestamp(record))
+        if day is None:
+            continue
+        rollup = rollups.get(day)
+        if rollup is None:
+            rollup = rollups[day] = [0, {}]
+        rollup[0] += 1
+
+        url = get_url(record)
+        response_time = get_response_time(record)
+        if url and isinstance(response_time, (int, float)):
+            url_stats = rollup[1]
+            stats = url_stats.get(url)
+            if stats is None:
+                stats = url_stats[url] = new_stats()
+            stats.add(response_time)
+
+    return rollups
+
+
+def connect_rollup_db(filepath, create=False):
+    if not create and not os.path.isfile(filepath):
+        raise IOError(f"файл '{filepath}' не найден")
+    import sqlite3
+
+    connection = sqlite3.connect(filepath)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS days (day TEXT PRIMARY KEY, lines INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS url_days (
+            day TEXT NOT NULL, url TEXT NOT NULL, count INTEGER NOT NULL, total, min, max, sketch BLOB, partials BLOB,
+            seen INTEGER NOT NULL, PRIMARY KEY (day, url)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL,
+                                            days TEXT NOT NULL);
+    """)
+    return connection
+
+
+def load_rollup_meta(connection):
+    meta = dict(connection.execute("SELECT key, value FROM meta"))
+    if meta and meta.get('version') != str(ROLLUP_FORMAT_VERSION):
+        raise ValueError(f"неподдерживаемая версия сводок: {meta.get('version')}")
+    return meta
+
+
+def encode_rollup_sketch(sketch):
+    # Плоский массив [zero, индекс, счётчик, ...]: читается без разбора JSON и без объектов на каждую корзину.
+    if sketch is None:
+        return None
+    values = array.array('q', [sketch.zero_count])
+    for index, count in sorted(sketch.bins.items()):
+        values.append(index)
+        values.append(count)
+    return values.tobytes()
+
+
+def encode_rollup_row(day, url, stats, seen=0):
+    # В total лежит старшая часть точной суммы, в partials - младшие слагаемые (если они есть),
+    # в seen - порядковый номер URL среди впервые встреченных за день.
+    partials = None
+    if stats.sum_low or stats.sum_tail is not None:
+        partials = array.array('d', [*(stats.sum_tail or ()), stats.sum_low]).tobytes()
+    return (day, url, stats.count, stats.sum_high, stats.min, stats.max, encode_rollup_sketch(stats.sketch),
+            partials, seen)
+
+
+def save_daily_rollups(filepath, rollups, percentile_accuracy=DEFAULT_PERCENTILE_ACCURACY,
+                       timestamp_field_name='@timestamp', sources=()):
+    connection = connect_rollup_db(filepath, create=True)
+    try:
+        with connection:
+            meta = load_rollup_meta(connection)
+            expected = {'version': str(ROLLUP_FORMAT_VERSION), 'percentile_accuracy': repr(percentile_accuracy),
+                        'timestamp_field': timestamp_field_name}
+            for key, value in expected.items():
+                if meta.get(key, value) != value:
+                    raise ValueError(f"сводки в файле построены с {key}={meta[key]}, а не {value}")
+            connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", expected.items())
+
+            for day, (lines, url_stats) in sorted(rollups.items()):
+                # День пересчитывается целиком: сводка за него заменяет прежнюю.
+                connection.execute("DELETE FROM url_days WHERE day = ?", (day,))
+                connection.execute("INSERT OR REPLACE INTO days (day, lines) VALUES (?, ?)", (day, lines))
+                rows = (encode_rollup_row(day, url, stats, seen) for seen, (url, stats) in enumerate(url_stats.items()))
+                while True:
+                    batch = list(itertools.islice(rows, ROLLUP_INSERT_BATCH))
+                    if not batch:
+                        break
+                    connection.executemany("INSERT INTO url_days VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            connection.executemany("INSERT OR REPLACE INTO sources (path, size, mtime, days) VALUES (?, ?, ?, ?)",
+                                   ((path, size, mtime, json.dumps(days)) for path, size, mtime, days in sources))
+    finally:
+        connection.close()
+
+
+def find_rolled_up_files(connection, filepaths, window, days):
+    # Файл можно не читать, если он не менялся после свёртки и все его дни либо свёрнуты, либо вне окна.
+    covered = []
+    for filepath in filepaths:
+        row = connection.execute("SELECT size, mtime, days FROM sources WHERE path = ?",
+                                 (os.path.abspath(filepath),)).fetchone()
+        if row is None:
+            continue
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            continue
+        if (stat.st_size, stat.st_mtime) != (row[0], row[1]):
+            continue
+        if all(day in days or not window.contains_day(day) for day in json.loads(row[2])):
+            covered.append(filepath)
+    return covered
+
+
+def query_rollups(filepath, window=None, options=None, timestamp_field_name='@timestamp', filepaths=()):
+    options = options or MetricsOptions()
+    connection = connect_rollup_db(filepath)
+    try:
+        meta = load_rollup_meta(connection)
+        if meta.get('timestamp_field', timestamp_field_name) != timestamp_field_name:
+            raise ValueError(f"сводки построены по полю '{meta['timestamp_field']}', а не '{timestamp_field_name}'")
+        if options.percentiles and meta.get('percentile_accuracy') != repr(options.percentile_accuracy):
+            raise ValueError(f"сводки построены с точностью перцентилей {meta.get('percentile_accuracy')}, "
+                             f"укажите её в --percentile-accuracy")
+        url_stats, days = load_rolled_up_stats(connection, window, options.percentile_accuracy)
+        covered = find_rolled_up_files(connection, filepaths, window or DateWindow(), days) if filepaths else []
+        return url_stats, days, covered
+    finally:
+        connection.close()
+
+
+def rollup_day_range(window):
+    if window is None:
+        return '0000-00-00', '9999-99-99'
+    return window.lo, window.hi
+
+
+def load_rolled_up_stats(connection, window=None, percentile_accuracy=None):
+    lo, hi = rollup_day_range(window)
+    days = dict(connection.execute("SELECT day, lines FROM days WHERE day BETWEEN ? AND ?", (lo, hi)))
+    # Счётчики и экстремумы складываются прямо в SQLite. SUM(total) округлял бы сумму на каждом дне,
+    # поэтому суммы собираются в Python из точных слагаемых.
+    url_stats = {
+        url: UrlStats(count, 0, minimum, maximum)
+        for url, count, minimum, maximum in connection.execute(
+            "SELECT url, SUM(count), MIN(min), MAX(max) FROM url_days WHERE day BETWEEN ? AND ? GROUP BY url",
+            (lo, hi))
+    }
+    first_seen = {}
+    for day, seen, url, total, blob in connection.execute(
+            "SELECT day, seen, url, total, partials FROM url_days WHERE day BETWEEN ? AND ?", (lo, hi)):
+        stats = url_stats[url]
+        stats.add_to_total(total)
+        if blob is not None:
+            for term in array.array('d', blob):
+                stats.add_to_total(term)
+        first_seen[url] = min((day, seen), first_seen.get(url, (day, seen)))
+    # URL идут в порядке первого появления в логе, как при чтении строк за эти дни подряд.
+    url_stats = {url: url_stats[url] for url in sorted(url_stats, key=first_seen.get)}
+    if percentile_accuracy is None:
+        return url_stats, days
+
+    for url, blob in connection.execute(
+            "SELECT url, sketch FROM url_days WHERE day BETWEEN ? AND ? AND sketch IS NOT NULL", (lo, hi)):
+        stats = url_stats[url]
+        sketch = stats.sketch
+        if sketch is None:
+            sketch = stats.sketch = LatencySketch(percentile_accuracy)
+        values = array.array('q')
+        values.frombytes(blob)
+        sketch.zero_count += values[0]
+        bins = sketch.bins
+        for index, count in zip(values[1::2], values[2::2]):
+            bins[index] = bins.get(index, 0) + count
+    for stats in url_stats.values():
+        if stats.sketch is not None:
+            stats.sketch.count = stats.sketch.zero_count + sum(stats.sketch.bins.values())
+            stats.sketch.collapse()
+    return url_stats, days
+
+
+class LogFollower:
+    __slots__ = ('filepath', 'file', 'device', 'inode', 'offset', 'pending', 'unsupported')
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = None
+        self.device = None
+        self.inode = None
+        self.offset = 0
+        self.pending = b''
+        self.unsupported = False
+
+    def open(self):
+        try:
+            self.file = open(self.filepath, 'rb')
+        except IOError:
+            return False
+        magic = self.file.read(4)
+        if magic.startswith(GZIP_MAGIC) or magic == ZSTD_MAGIC:
+            print(f"Внимание: Сжатый файл '{self.filepath}' нельзя отслеживать, пропускаем.", file=sys.stderr)
+            self.close()
+            self.unsupported = True
+            return False
+        stat = os.fstat(self.file.fileno())
+        self.device, self.inode = stat.st_dev, stat.st_ino
+        self.offset = 0
+        self.pending = b''
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def iter_new_lines(self):
+        self.file.seek(self.offset)
+        while True:
+            chunk = self.file.read(FOLLOW_READ_SIZE)
+            if not chunk:
+                return
+            self.offset += len(chunk)
+            lines = (self.pending + chunk).split(b'\n')
+            self.pending = lines.pop()
+            if len(self.pending) > FOLLOW_MAX_PENDING:
+                print(f"Внимание: Слишком длинная строка в '{self.filepath}', пропускаем.", file=sys.stderr)
+                self.pending = b''
+            yield from lines
+
+    def poll(self):
+        if self.unsupported:
+            return
+        if self.file is None and not self.open():
+            return
+
+        try:
+            stat = os.stat(self.filepath)
+        except OSError:
+            stat = None
+        same_file = stat is not None and stat.st_ino == self.inode and stat.st_dev == self.device
+
+        if same_file and stat.st_size < self.offset:
+            print(f"Внимание: Файл '{self.filepath}' был усечён, читаем его с начала.", file=sys.stderr)
+            self.offset = 0
+            self.pending = b''
+
+        yield from self.iter_new_lines()
+
+        if not same_file:
+            if self.pending:
+                yield self.pending
+            self.close()
+            if stat is not None and self.open():
+                yield from self.iter_new_lines()
+
+
+class ChangeWaiter:
+    __slots__ = ('stop_event', 'inotify')
+
+    def __init__(self, filepaths, stop_event):
+        self.stop_event = stop_event
+        self.inotify = None
+        inotify_simple = optional_module('inotify_simple')
+        if inotify_simple is None:
+            return
+
+        mask = (inotify_simple.flags.MODIFY | inotify_simple.flags.CREATE | inotify_simple.flags.DELETE
+                | inotify_simple.flags.MOVED_FROM | inotify_simple.flags.MOVED_TO)
+        try:
+            self.inotify = inotify_simple.INotify()
+            for directory in {os.path.dirname(os.path.abspath(filepath)) for filepath in filepaths}:
+                self.inotify.add_watch(directory, mask)
+        except OSError:
+            self.close()
+
+    def wait(self, timeout):
+        if self.inotify is None:
+            self.stop_event.wait(timeout)
+        else:
+            self.inotify.read(timeout=max(0, int(timeout * 1000)))
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+def render_live_table(url_stats, percentiles=False, top=None, top_by='total', group_by=DEFAULT_GROUP_BY,
+                      metric=DEFAULT_METRIC):
+    if sys.stdout.isatty():
+        print("\033[H\033[2J", end="")
+    print(f"Обновлено: {datetime.datetime.now():%Y-%m-%d %H:%M:%S}")
+    if top:
+        url_stats = select_top_url_stats(url_stats, top, top_by)
+    print_url_metrics_table(finalize_url_metrics(url_stats, percentiles), top_by, group_by=group_by, metric=metric)
+    sys.stdout.flush()
+
+
+def follow_log_files(filepaths, decoder, window=None, interval=2.0, render=render_live_table, stop_event=None,
+                     poll_interval=FOLLOW_POLL_INTERVAL, options=None):
+    if stop_event is None:
+        stop_event = threading.Event()
+    followers = [LogFollower(filepath) for filepath in filepaths]
+    waiter = ChangeWaiter(filepaths, stop_event)
+    url_stats = {}
+    counters = {'parsed': 0, 'matched': 0, 'date_skipped': 0}
+    next_render = time.monotonic()
+
+    try:
+        while not stop_event.is_set():
+            for follower in followers:
+                records = iter_decoded_lines(follower.poll(), follower.filepath, decoder, window, counters)
+                records = count_log_entries(records, counters, 'parsed')
+                if window:
+                    records = count_log_entries(iter_records_in_window(records, window, decoder), counters, 'matched')
+                accumulate_url_records(records, decoder, url_stats, options)
+
+            now = time.monotonic()
+            if now >= next_render:
+                render(url_stats)
+                next_render = now + interval
+            if not stop_event.is_set():
+                waiter.wait(min(poll_interval, max(0, next_render - time.monotonic())))
+    finally:
+        waiter.close()
+        for follower in followers:
+            follower.close()
+    return url_stats, counters
+
+
+def shorten_url(url, max_url_len=30):
+    if len(url) > max_url_len:
+        return url[:max_url_len - 3] + "..."
+    return url
+
+
+def group_key_values(key, group_by):
+    return [key] if len(group_by) == 1 else list(key)
+
+
+def group_key_headers(group_by):
+    return ["handler"] if group_by == DEFAULT_GROUP_BY else list(group_by)
+
+
+def group_key_cells(key, group_by):
+    return [shorten_url(str(value)) for value in group_key_values(key, group_by)]
+
+
+def format_table_number(value):
+    # Те же числа, что выводил tabulate: округление до 3 знаков и формат 'g' без лишних нулей.
+    return "" if value is None else format(float(f"{value:.3f}"), 'g')
+
+
+def format_fixed_width_row(cells, widths, right_aligned):
+    return TABLE_COLUMN_GAP.join(
+        cell.rjust(width) if right else cell.ljust(width)
+        for cell, width, right in zip(cells, widths, right_aligned)
+    ).rstrip()
+
+
+def iter_fixed_width_table(headers, numeric, make_rows):
+    widths = [len(header) + TABLE_MIN_PADDING for header in headers]
+    filled = [False] * len(headers)
+    for row in make_rows():
+        widths = list(map(max, widths, map(len, row)))
+        filled = [was_filled or cell != "" for was_filled, cell in zip(filled, row)]
+    right_aligned = [is_numeric and is_filled for is_numeric, is_filled in zip(numeric, filled)]
+
+    yield format_fixed_width_row(headers, widths, right_aligned)
+    yield TABLE_COLUMN_GAP.join('-' * width for width in widths)
+    for row in make_rows():
+        yield format_fixed_width_row(row, widths, right_aligned)
+
+
+def write_fixed_width_table(out, headers, numeric, make_rows):
+    out.writelines(line + '\n' for line in iter_fixed_width_table(headers, numeric, make_rows))
+
+
+def sort_url_metrics(url_metrics_data, sort_by='total'):
+    sort_field = 'avg_time' if sort_by == 'avg' else sort_by
+    return sorted(url_metrics_data.items(), reverse=True,
+                  key=lambda item: -math.inf if item[1][sort_field] is None else item[1][sort_field])
+
+
+def print_url_metrics_table(url_metrics_data, sort_by='total', out=None, group_by=DEFAULT_GROUP_BY,
+                            metric=DEFAULT_METRIC):
+    if out is None:
+        out = sys.stdout
+    if not url_metrics_data:
+        print("Нет данных для отображения метрик.", file=out)
+        return
+
+    sorted_metrics = sort_url_metrics(url_metrics_data, sort_by)
+    percentile_columns = [name for name, _ in REPORTED_PERCENTILES] + ['max']
+    show_percentiles = 'p50' in sorted_metrics[0][1]
+
+    def make_rows():
+        for index, (url, metrics) in enumerate(sorted_metrics):
+            row = [str(index), *group_key_cells(url, group_by), str(metrics['total']),
+                   format_table_number(metrics['avg_time'])]
+            if show_percentiles:
+                row.extend(format_table_number(metrics[name]) for name in percentile_columns)
+            yield row
+
+    headers = ["", *group_key_headers(group_by), "total", f"avg_{metric}"]
+    numeric = [True, *(False for _ in group_by), True, True]
+    if show_percentiles:
+        headers.extend(percentile_columns)
+        numeric.extend(True for _ in percentile_columns)
+    write_fixed_width_table(out, headers, numeric, make_rows)
+
+
+def print_bucketed_metrics_table(table, out=None, group_by=DEFAULT_GROUP_BY, metric=DEFAULT_METRIC):
+    if out is None:
+        out = sys.stdout
+    if not table:
+        print("Нет данных для отображения метрик.", file=out)
+        return
+
+    rows = sorted(table.rows(), key=lambda row: (row[0], -row[2], row[1]))
+
+    def make_rows():
+        for index, (bucket, url, count, avg) in enumerate(rows):
+            yield [str(index), format_bucket_start(bucket, table.bucket_seconds), *group_key_cells(url, group_by),
+                   str(count), format_table_number(avg)]
+
+    write_fixed_width_table(out, ["", "bucket", *group_key_headers(group_by), "total", f"avg_{metric}"],
+                            [True, False, *(False for _ in group_by), True, True], make_rows)
+
+
+def url_metric_columns(sorted_metrics):
+    columns = ['total', 'avg_time']
+    if sorted_metrics and 'p50' in sorted_metrics[0][1]:
+        columns.extend(name for name, _ in REPORTED_PERCENTILES)
+        columns.append('max')
+    return columns
+
+
+def format_bucket_iso(bucket, bucket_seconds):
+    moment = datetime.datetime.fromtimestamp(bucket * bucket_seconds, tz=datetime.timezone.utc)
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def escape_prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_name(field):
+    name = re.sub(r'[^a-zA-Z0-9_]', '_', field)
+    return f"_{name}" if name[:1].isdigit() else name
+
+
+def prometheus_label_names(group_by):
+    return ['handler' if field == 'url' else prometheus_name(field) for field in group_by]
+
+
+def format_prometheus_value(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def write_prometheus_url_metrics(out, sorted_metrics, columns, group_by=DEFAULT_GROUP_BY, metric=DEFAULT_METRIC):
+    if group_by == DEFAULT_GROUP_BY and metric == DEFAULT_METRIC:
+        families = [
+            ('requests', "Количество запросов к URL за период отчёта.", 'total', None),
+            ('response_time_avg', "Среднее время ответа URL.", 'avg_time', None),
+        ]
+        if 'p50' in columns:
+            families.append(('response_time', "Перцентили времени ответа URL.", None, REPORTED_PERCENTILES))
+            families.append(('response_time_max', "Максимальное время ответа URL.", 'max', None))
+    else:
+        value_name, groups = prometheus_name(metric), ", ".join(group_by)
+        families = [
+            ('requests', f"Количество записей по группам {groups} за период отчёта.", 'total', None),
+            (f'{value_name}_avg', f"Среднее значение {metric} по группам {groups}.", 'avg_time', None),
+        ]
+        if 'p50' in columns:
+            families.append((value_name, f"Перцентили {metric} по группам {groups}.", None, REPORTED_PERCENTILES))
+            families.append((f'{value_name}_max', f"Максимальное значение {metric} по группам {groups}.", 'max',
+                             None))
+
+    label_names = prometheus_label_names(group_by)
+    for suffix, description, column, quantiles in families:
+        name = f"{PROMETHEUS_METRIC_PREFIX}_{suffix}"
+        # Метка quantile допустима только у типа summary, а он требует ещё серии _sum и _count.
+        out.write(f"# HELP {name} {description}\n# TYPE {name} {'gauge' if quantiles is None else 'summary'}\n")
+        for url, metrics in sorted_metrics:
+            labels = ",".join(f'{label}="{escape_prometheus_label(str(value))}"'
+                              for label, value in zip(label_names, group_key_values(url, group_by)))
+            if quantiles is None:
+                if metrics[column] is not None:
+                    out.write(f'{name}{{{labels}}} {format_prometheus_value(metrics[column])}\n')
+                continue
+            for percentile, q in quantiles:
+                if metrics[percentile] is not None:
+                    out.write(f'{name}{{{labels},quantile="{q}"}} '
+                              f'{format_prometheus_value(metrics[percentile])}\n')
+            out.write(f'{name}_sum{{{labels}}} {format_prometheus_value(metrics["avg_time"] * metrics["total"])}\n')
+            out.write(f'{name}_count{{{labels}}} {metrics["total"]}\n')
+
+
+def write_url_metrics(url_metrics_data, report_format='table', sort_by='total', out=None, group_by=DEFAULT_GROUP_BY,
+                      metric=DEFAULT_METRIC):
+    if out is None:
+        out = sys.stdout
+    if report_format == 'table':
+        print_url_metrics_table(url_metrics_data, sort_by, out, group_by, metric)
+        return
+
+    sorted_metrics = sort_url_metrics(url_metrics_data, sort_by)
+    columns = url_metric_columns(sorted_metrics)
+    if report_format == 'csv':
+        import csv
+
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(list(group_by) + columns)
+        for url, metrics in sorted_metrics:
+            writer.writerow(group_key_values(url, group_by) +
+                            ["" if metrics[column] is None else metrics[column] for column in columns])
+    elif report_format == 'jsonl':
+        for url, metrics in sorted_metrics:
+            out.write(json.dumps({**dict(zip(group_by, group_key_values(url, group_by))),
+                                  **{column: metrics[column] for column in columns}}, ensure_ascii=False) + '\n')
+    elif report_format == 'prom':
+        write_prometheus_url_metrics(out, sorted_metrics, columns, group_by, metric)
+    else:
+        raise ValueError(f"неизвестный формат отчёта '{report_format}'")
+
+
+def write_bucketed_metrics(table, report_format='table', out=None, group_by=DEFAULT_GROUP_BY, metric=DEFAULT_METRIC):
+    if out is None:
+        out = sys.stdout
+    if report_format == 'table':
+        print_bucketed_metrics_table(table, out, group_by, metric)
+        return
+
+    rows = sorted(table.rows(), key=lambda row: (row[0], -row[2], row[1]))
+    if report_format == 'csv':
+        import csv
+
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(['bucket', *group_by, 'total', 'avg_time'])
+        for bucket, url, count, avg in rows:
+            writer.writerow([format_bucket_iso(bucket, table.bucket_seconds), *group_key_values(url, group_by),
+                             count, avg])
+    elif report_format == 'jsonl':
+        for bucket, url, count, avg in rows:
+            out.write(json.dumps({'bucket': format_bucket_iso(bucket, table.bucket_seconds),
+                                  **dict(zip(group_by, group_key_values(url, group_by))),
+                                  'total': count, 'avg_time': avg}, ensure_ascii=False) + '\n')
+    else:
+        raise ValueError(f"формат отчёта '{report_format}' не поддерживается для --bucket")
+
+
+def format_megabytes(size):
+    return "н/д" if size is None else f"{size / (1024 * 1024):.1f} МБ"
+
+
+def print_run_stats(report, stats_format='text'):
+    if stats_format == 'json':
+        print(json.dumps(report, ensure_ascii=False), file=sys.stderr)
+        return
+
+    other = report['wall'] - sum(stage['wall'] for stage in report['stages'])
+    table_data = [
+        [stage['stage'], f"{stage['wall']:.3f}", f"{stage['cpu']:.3f}",
+         "" if stage['items'] is None else str(stage['items']),
+         f"{stage['wall'] / report['wall']:.0%}" if report['wall'] else ""]
+        for stage in report['stages']
+    ]
+    table_data.append(['other', f"{other:.3f}", "", "", f"{other / report['wall']:.0%}" if report['wall'] else ""])
+    skipped = report['lines_skipped']
+    missing = "н/д" if skipped['missing_fields'] is None else skipped['missing_fields']
+    print(f"Статистика выполнения: {report['wall']:.3f} с, CPU {report['cpu']:.3f} с, "
+          f"пиковая память {format_megabytes(report['peak_rss_bytes'])}"
+          + ("" if report['peak_traced_bytes'] is None
+             else f" (tracemalloc: {format_megabytes(report['peak_traced_bytes'])})") + ".", file=sys.stderr)
+    write_fixed_width_table(sys.stderr, ["stage", "wall_s", "cpu_s", "items", "share"],
+                            [False, True, True, True, True], lambda: table_data)
+    print(f"Прочитано строк: {report['lines_read']}, байт: "
+          f"{'н/д' if report['bytes_read'] is None else report['bytes_read']}, записей: {report['records_parsed']}.",
+          file=sys.stderr)
+    if report['lines_summarized']:
+        print(f"Взято из сводок индекса и --rollup-db без чтения логов: строк {report['lines_summarized']}.",
+              file=sys.stderr)
+    print(f"Пропущено строк: пустых {skipped['empty']}, с ошибкой JSON {skipped['malformed']}, "
+          f"вне диапазона дат {skipped['date_filtered']}, без url/response_time {missing}.", file=sys.stderr)
+    if report['allocations']:
+        print("Больше всего памяти удерживается на момент завершения в:", file=sys.stderr)
+        for site in report['allocations']:
+            print(f"  {site}", file=sys.stderr)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Анализирует лог-файлы в формате JSON Lines и выводит метрики по URL.",
+        epilog="Для ускорения отчётов по датам постройте индекс: main.py index --files <файлы>. "
+               "Для многократных отчётов по одним и тем же логам сконвертируйте их в колоночный формат: "
+               "main.py convert --files <файлы> --output <файл>, и передавайте его в --files. "
+               "Для отчётов за месяцы сверните завершённые дни в сводки: main.py rollup --files <файлы> "
+               "--db <файл>, и передавайте его в --rollup-db."
+    )
+
+    parser.add_argument(
+        '--files',
+        nargs='+',
+        help='Путь к одному или нескольким лог-файлам JSON Lines. Можно указывать каталоги (берутся все файлы '
+             'внутри, кроме скрытых и .idx) и шаблоны в кавычках, например \'logs/**/*.log\'.'
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        required=True,
+        help="Базовое название для файла отчета (без расширения) или для заголовка консольного вывода. "
+             "Пример: 'ОтчетПоЗапросам'."
+    )
+
+    parser.add_argument(
+        "--date",
+        type=str,
+        help="Конкретная дата для фильтрации данных в формате YYYY-MM-DD. "
+             "Пример: 2025-06-22. Ожидается наличие поля '@timestamp' (или другого) в логах."
+    )
+
+    parser.add_argument(
+        "--date-from",
+        type=str,
+        help="Начало диапазона дат (включительно) в формате YYYY-MM-DD. Можно использовать вместе с --date-to."
+    )
+
+    parser.add_argument(
+        "--date-to",
+        type=str,
+        help="Конец диапазона дат (включительно) в формате YYYY-MM-DD. Можно использовать вместе с --date-from."
+    )
+
+    parser.add_argument(
+        "--createfile",
+        action="store_true",
+        help="Если указан, весь основной вывод скрипта будет записан в файл с именем из --report. "
+             "Если файл с таким именем уже существует, будет добавлен числовой суффикс."
+             "Если не указан, вывод будет напечатан в консоль. Ошибки всегда выводятся в stderr."
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Количество процессов для параллельного разбора файлов. "
+             "Файлы делятся на части по границам строк. По умолчанию 1 (последовательная обработка)."
+    )
+
+    parser.add_argument(
+        "--io-concurrency",
+        type=int,
+        default=1,
+        help="Количество файлов, которые одновременно открываются и читаются в фоновых потоках. "
+             "Ускоряет обработку тысяч небольших файлов (особенно на NFS), записи по-прежнему "
+             "агрегируются в одном процессе в порядке файлов. По умолчанию 1 (последовательное чтение)."
+    )
+
+    parser.add_argument(
+        "--decoder",
+        choices=RECORD_DECODERS,
+        default='auto',
+        help="Декодер строк логов. msgspec извлекает только используемые в отчёте поля (url, response_time и "
+             "@timestamp или заданные --group-by, --metric и --timestamp-field), "
+             "не создавая объекты для остальных полей; orjson и json разбирают строку целиком. "
+             "auto выбирает msgspec, затем orjson, если они установлены, иначе стандартный json."
+    )
+
+    parser.add_argument(
+        "--group-by",
+        type=str,
+        default=','.join(DEFAULT_GROUP_BY),
+        help="Поля записи через запятую, по которым группируются метрики, например url,http_method,status. "
+             "Записи, в которых нет хотя бы одного из полей, пропускаются. По умолчанию url."
+    )
+
+    parser.add_argument(
+        "--metric",
+        type=str,
+        default=DEFAULT_METRIC,
+        help="Числовое поле записи, по которому считаются среднее, перцентили и максимум. "
+             f"По умолчанию {DEFAULT_METRIC}."
+    )
+
+    parser.add_argument(
+        "--timestamp-field",
+        type=str,
+        default='@timestamp',
+        help="Поле записи с временем события в формате ISO 8601 для фильтров по датам и --bucket. "
+             "По умолчанию @timestamp."
+    )
+
+    parser.add_argument(
+        "--backend",
+        choices=AGGREGATION_BACKENDS,
+        default='auto',
+        help="Движок агрегации по URL. numpy группирует записи пачками через векторные операции, "
+             "python обрабатывает их в цикле. auto выбирает numpy, если пакет установлен. "
+             "С --percentiles, --bucket и --approx-top всегда используется python."
+    )
+
+    parser.add_argument(
+        "--format",
+        choices=REPORT_FORMATS,
+        default='table',
+        help="Формат отчёта: table - таблица для чтения человеком (по умолчанию), csv и jsonl - строки "
+             "с полными URL и числами без округления, prom - текстовый формат Prometheus (gauge-метрики "
+             f"{PROMETHEUS_METRIC_PREFIX}_requests, {PROMETHEUS_METRIC_PREFIX}_response_time_avg и др. с меткой "
+             "handler). Строки записываются по мере формирования. С --createfile расширение файла "
+             "соответствует формату."
+    )
+
+    parser.add_argument(
+        "--stats",
+        nargs='?',
+        const='text',
+        choices=STATS_FORMATS,
+        help="Вывести в stderr статистику выполнения: время и CPU по этапам (read, decode, filter, aggregate, "
+             "render и др.), прочитанные байты и строки, пропущенные строки (пустые, с ошибкой JSON, вне "
+             "диапазона дат, без url/response_time) и пиковую память. json выводит её одной строкой JSON."
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="FILE",
+        help="Записать профиль cProfile в указанный файл (смотреть через python -m pstats FILE)."
+    )
 
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Отслеживать выделения памяти через tracemalloc: в статистику добавляется пик и "
+             f"{TRACEMALLOC_TOP_SITES} мест, удерживающих больше всего памяти. Заметно замедляет работу."
+    )
 
-def filter_log_entries_by_date(log_entries, specific_date, timestamp_field_name='@timestamp'):
-    if not specific_date:
-        return log_entries
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Инкрементальный режим: для каждого файла запоминается прочитанное смещение, а агрегаты по URL "
+             "сохраняются в файле состояния. При следующем запуске читаются только новые строки. "
+             "Ротация и усечение файлов определяются автоматически. --workers в этом режиме не используется."
+    )
 
-    filtered_entries = []
-    for entry in log_entries:
-        timestamp_str = entry.get(timestamp_field_name)
-        if timestamp_str:
-            try:
-                log_date = None
-                try:
-                    log_datetime = datetime.datetime.fromisoformat(timestamp_str)
-                    log_date = log_datetime.date()
-                except ValueError:
-                    try:
-                        log_date = datetime.datetime.strptime(timestamp_str.split(' ')[0], '%Y-%m-%d').date()
-                    except ValueError:
-                        pass
-
-                if log_date and log_date == specific_date:
-                    filtered_entries.append(entry)
-            except Exception as e:
-                pass
-    return filtered_entries
+    parser.add_argument(
+        "--state-file",
+        type=str,
+        help="Путь к файлу состояния для --incremental. По умолчанию <report>.state.json."
+    )
 
+    parser.add_argument(
+        "--percentiles",
+        action="store_true",
+        help="Добавить в отчёт колонки p50, p95, p99 и max времени ответа. Перцентили считаются приближённо "
+             "по скетчу с фиксированным объёмом памяти на URL и объединяются между файлами и частями."
+    )
 
-def analyze_url_metrics(log_entries):
-    url_data = {}
+    parser.add_argument(
+        "--percentile-accuracy",
+        type=float,
+        default=DEFAULT_PERCENTILE_ACCURACY,
+        help="Относительная точность перцентилей для --percentiles. По умолчанию 0.01 (1%%)."
+    )
 
-    for entry in log_entries:
-        url = entry.get('url')
-        response_time = entry.get('response_time')
+    parser.add_argument(
+        "--top",
+        type=int,
+        help="Показать только K URL с наибольшим значением метрики из --top-by. "
+             "Отбор идёт через ограниченную кучу без сортировки всех URL."
+    )
 
-        if url and isinstance(response_time, (int, float)):
-            if url not in url_data:
-                url_data[url] = {
-                    'total_requests': 0,
-                    'sum_response_time': 0
-                }
+    parser.add_argument(
+        "--top-by",
+        choices=TOP_SORT_KEYS,
+        default='total',
+        help="Метрика для --top и сортировки таблицы: total, avg, max или перцентиль p50/p95/p99 "
+             "(перцентили требуют --percentiles). По умолчанию total."
+    )
+
+    parser.add_argument(
+        "--approx-top",
+        action="store_true",
+        help="Приближённый режим для --top по total: во время разбора хранится не более "
+             f"{HEAVY_HITTERS_CAPACITY_FACTOR}×K счётчиков (алгоритм Space-Saving), поэтому память не зависит "
+             "от числа уникальных URL. Значения total являются оценкой сверху."
+    )
 
-            url_data[url]['total_requests'] += 1
-            url_data[url]['sum_response_time'] += response_time
+    parser.add_argument(
+        "--strip-query",
+        action="store_true",
+        help="Отбрасывать query-строку и фрагмент URL (всё после '?' или '#') перед группировкой."
+    )
 
-    final_metrics = {}
-    for url, data in url_data.items():
-        total = data['total_requests']
-        sum_time = data['sum_response_time']
+    parser.add_argument(
+        "--collapse-ids",
+        action="store_true",
+        help="Заменять числовые и UUID-сегменты пути на {id}, например /api/users/123 -> /api/users/{id}."
+    )
 
-        avg_time = sum_time / total if total > 0 else 0
+    parser.add_argument(
+        "--url-template",
+        nargs=2,
+        action="append",
+        metavar=("REGEX", "TEMPLATE"),
+        help="Правило нормализации URL: совпавшая с регулярным выражением часть заменяется шаблоном "
+             "(поддерживаются ссылки на группы \\1, \\g<name>). Можно указать несколько раз, применяется "
+             "первое совпавшее правило, после чего --collapse-ids не используется."
+    )
 
-        final_metrics[url] = {
-            'total': total,
-            'avg_time': avg_time
-        }
+    parser.add_argument(
+        "--bucket",
+        type=str,
+        help="Разбить метрики по URL на временные интервалы указанной длины, например 30s, 1m, 1h или 1d. "
+             "Интервалы выравниваются по UTC, строки таблицы упорядочены по времени, затем по числу запросов."
+    )
 
-    return final_metrics
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Режим слежения: файлы читаются с начала, затем отслеживаются новые строки (inotify при наличии "
+             "пакета inotify_simple, иначе периодический опрос), таблица перерисовывается каждые --interval секунд. "
+             "Ротация и усечение файлов обрабатываются. Завершение по Ctrl+C."
+    )
 
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=2.0,
+        help="Интервал перерисовки таблицы в режиме --follow, в секундах. По умолчанию 2."
+    )
 
-def print_url_metrics_table(url_metrics_data):
-    if not url_metrics_data:
-        print("Нет данных для отображения метрик.")
+    parser.add_argument(
+        "--save-stats",
+        type=str,
+        help="Путь к файлу, в который будут сохранены частичные агрегаты по URL (JSON). "
+             "Сохранённые агрегаты можно позже объединить через --load-stats без повторного чтения логов."
+    )
+
+    parser.add_argument(
+        "--load-stats",
+        nargs='+',
+        help="Один или несколько файлов с агрегатами, сохранёнными через --save-stats. "
+             "Они объединяются с результатами разбора --files (фильтр --date к ним не применяется)."
+    )
+
+    parser.add_argument(
+        "--rollup-db",
+        type=str,
+        metavar="FILE",
+        help="Файл SQLite со сводками по дням (main.py rollup). Для отчётов с --date, --date-from и --date-to "
+             "дни из сводок не читаются из логов, --files нужны только для дней, которых в сводках нет."
+    )
+
+    return parser
+
+
+def build_index_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="main.py index",
+        description="Строит или дополняет индекс лог-файлов (файл <лог>.idx рядом с каждым логом): "
+                    "диапазоны байтов каждого дня и сводки по URL за день. Отчёты с --date, --date-from "
+                    "и --date-to используют индекс, читая только нужные дни."
+    )
+
+    parser.add_argument(
+        '--files',
+        nargs='+',
+        required=True,
+        help='Путь к одному или нескольким несжатым лог-файлам JSON Lines.'
+    )
+
+    return parser
+
+
+def index_main(argv):
+    args = build_index_arg_parser().parse_args(argv)
+
+    failed = False
+    for filepath in iter_existing_files(expand_log_paths(args.files)):
+        try:
+            try:
+                index = load_log_index(filepath)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Внимание: Индекс '{log_index_path(filepath)}' повреждён ({e}), строится заново.",
+                      file=sys.stderr)
+                index = None
+            index = update_log_index(filepath, index)
+            save_log_index(filepath, index)
+        except (IOError, ValueError) as e:
+            print(f"Ошибка при индексировании файла '{filepath}': {e}", file=sys.stderr)
+            failed = True
+            continue
+        print(f"Индекс {log_index_path(filepath)}: дней {len(index['days'])}, "
+              f"проиндексировано байт {index['end']}.")
+
+    if failed:
+        sys.exit(1)
         return
 
-    table_data = []
-    max_url_len = 30
 
-    sorted_metrics = sorted(url_metrics_data.items(), key=lambda item: item[1]['total'], reverse=True)
+def build_convert_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="main.py convert",
+        description="Конвертирует лог-файлы JSON Lines в компактный колоночный файл (дата, время, "
+                    "идентификатор URL, время ответа). Такой файл можно передавать в --files вместо "
+                    "исходных логов: повторные отчёты не тратят время на разбор JSON."
+    )
+
+    parser.add_argument(
+        '--files',
+        nargs='+',
+        required=True,
+        help='Путь к одному или нескольким лог-файлам JSON Lines (в том числе .gz и .zst).'
+    )
+
+    parser.add_argument(
+        '--output',
+        type=str,
+        required=True,
+        help='Путь к создаваемому колоночному файлу.'
+    )
+
+    parser.add_argument(
+        "--decoder",
+        choices=RECORD_DECODERS,
+        default='auto',
+        help="Декодер строк логов, как в основном режиме."
+    )
+
+    return parser
+
 
-    for url, metrics in sorted_metrics:
-        display_url = url
-        if len(url) > max_url_len:
-            display_url = url[:max_url_len - 3] + "..."
+def convert_main(argv):
+    args = build_convert_arg_parser().parse_args(argv)
 
-        table_data.append([
-            display_url,
-            metrics['total'],
-            f"{metrics['avg_time']:.3f}" 
-        ])
+    try:
+        decoder = make_record_decoder(args.decoder)
+    except ValueError as e:
+        print(f"Ошибка: Декодер '{args.decoder}' недоступен: {e}.", file=sys.stderr)
+        sys.exit(1)
+        return
 
-    headers = ["handler", "total", "avg_response_time"]
+    columns = convert_to_columnar(expand_log_paths(args.files), decoder)
+    if not columns.sources:
+        print("Ошибка: Не найдено ни одного файла для конвертации.", file=sys.stderr)
+        sys.exit(1)
+        return
 
-    print(tabulate.tabulate(
-        table_data,
-        headers=headers,
-        tablefmt="simple",
-        showindex=True,
-        numalign="right",
-        stralign="left"
-    ))
+    try:
+        save_columnar_log(args.output, columns)
+    except IOError as e:
+        print(f"Ошибка при записи в файл {args.output}: {e}", file=sys.stderr)
+        sys.exit(1)
+        return
+    print(f"Записано строк: {len(columns)}, уникальных URL: {len(columns.urls)} в файл {args.output}.")
 
 
-def main():
+def build_rollup_arg_parser():
     parser = argparse.ArgumentParser(
-        description="Анализирует лог-файлы в формате JSON Lines и выводит метрики по URL."
+        prog="main.py rollup",
+        description="Записывает в файл SQLite сводки по дням: для каждого дня и URL количество, сумму, минимум, "
+                    "максимум и скетч перцентилей времени ответа. Отчёты с --rollup-db берут дни из сводок, "
+                    "а сырые логи читают только за дни, которых в сводках нет. Каждый день пересчитывается "
+                    "целиком, поэтому передавайте все файлы, в которых он встречается."
     )
 
     parser.add_argument(
         '--files',
         nargs='+',
-        help='Путь к одному или нескольким лог-файлам JSON Lines.'
+        required=True,
+        help='Путь к одному или нескольким лог-файлам JSON Lines (в том числе .gz и .zst), каталогам или шаблонам.'
     )
 
     parser.add_argument(
-        "--report",
+        '--db',
         type=str,
         required=True,
-        help="Базовое название для файла отчета (без расширения) или для заголовка консольного вывода. "
-             "Пример: 'ОтчетПоЗапросам'."
+        help='Путь к файлу SQLite со сводками. Создаётся, если его нет; сводки за уже записанные дни заменяются.'
     )
 
     parser.add_argument(
-        "--date",
+        "--date-from",
         type=str,
-        help="Конкретная дата для фильтрации данных в формате YYYY-MM-DD. "
-             "Пример: 2025-06-22. Ожидается наличие поля '@timestamp' (или другого) в логах."
+        help="Записывать сводки только начиная с этой даты (YYYY-MM-DD), например чтобы не трогать старые дни."
     )
 
     parser.add_argument(
-        "--createfile",
-        action="store_true",
-        help="Если указан, весь основной вывод скрипта будет записан в файл с именем из --report. "
-             "Если файл с таким именем уже существует, будет добавлен числовой суффикс."
-             "Если не указан, вывод будет напечатан в консоль. Ошибки всегда выводятся в stderr."
+        "--date-to",
+        type=str,
+        help="Записывать сводки только по эту дату (YYYY-MM-DD) включительно. Незавершённый текущий день "
+             "лучше не сворачивать: отчёты возьмут его из сводки, а не из дописывающегося лога."
+    )
+
+    parser.add_argument(
+        "--decoder",
+        choices=RECORD_DECODERS,
+        default='auto',
+        help="Декодер строк логов, как в основном режиме."
+    )
+
+    parser.add_argument(
+        "--timestamp-field",
+        type=str,
+        default='@timestamp',
+        help="Поле записи с временем события, как в основном режиме. По умолчанию @timestamp."
+    )
+
+    parser.add_argument(
+        "--percentile-accuracy",
+        type=float,
+        default=DEFAULT_PERCENTILE_ACCURACY,
+        help="Относительная точность скетчей перцентилей. Отчёты с --percentiles должны использовать ту же. "
+             "По умолчанию 0.01 (1%%)."
     )
 
-    args = parser.parse_args()
+    return parser
 
-    original_stdout = sys.stdout
-    output_buffer = io.StringIO()
 
-    if args.createfile:
-        sys.stdout = output_buffer
+def rollup_main(argv):
+    import sqlite3
+
+    args = build_rollup_arg_parser().parse_args(argv)
+
+    parsed_dates = {}
+    for option, value in (('date_from', args.date_from), ('date_to', args.date_to)):
+        if not value:
+            continue
+        try:
+            parsed_dates[option] = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            print(f"Ошибка: Неверный формат даты '{value}'. Ожидается YYYY-MM-DD.", file=sys.stderr)
+            sys.exit(1)
+            return
+    window = DateWindow(parsed_dates.get('date_from'), parsed_dates.get('date_to')) if parsed_dates else None
+
+    if not 0 < args.percentile_accuracy < 1:
+        print(f"Ошибка: Точность перцентилей должна быть в интервале (0, 1), получено {args.percentile_accuracy}.",
+              file=sys.stderr)
+        sys.exit(1)
+        return
+    try:
+        decoder = make_record_decoder(args.decoder, args.timestamp_field)
+    except ValueError as e:
+        print(f"Ошибка: Декодер '{args.decoder}' недоступен: {e}.", file=sys.stderr)
+        sys.exit(1)
+        return
+
+    options = MetricsOptions(percentile_accuracy=args.percentile_accuracy)
+    rollups = {}
+    sources = []
+    for filepath in iter_existing_files(expand_log_paths(args.files)):
+        stat = os.stat(filepath)
+        file_rollups = accumulate_daily_rollups(iter_log_entries([filepath], decoder=decoder), decoder,
+                                                options=options)
+        sources.append((os.path.abspath(filepath), stat.st_size, stat.st_mtime, sorted(file_rollups)))
+        for day, (lines, url_stats) in file_rollups.items():
+            if window and not window.contains_day(day):
+                continue
+            rollup = rollups.get(day)
+            if rollup is None:
+                rollups[day] = [lines, url_stats]
+            else:
+                rollup[0] += lines
+                merge_url_stats(rollup[1], url_stats)
+    if not rollups:
+        print("Ошибка: Не найдено ни одной записи лога с датой для сводок.", file=sys.stderr)
+        sys.exit(1)
+        return
+
+    try:
+        save_daily_rollups(args.db, rollups, args.percentile_accuracy, args.timestamp_field, sources)
+    except (IOError, ValueError, sqlite3.Error) as e:
+        print(f"Ошибка при записи сводок в файл {args.db}: {e}", file=sys.stderr)
+        sys.exit(1)
+        return
+    print(f"Сводки записаны в файл {args.db}: дней {len(rollups)}, с {min(rollups)} по {max(rollups)}.")
 
-    specific_date = None
-    if args.date:
+
+def main(argv=None, stats=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'index':
+        index_main(argv[1:])
+        return
+    if argv and argv[0] == 'convert':
+        convert_main(argv[1:])
+        return
+    if argv and argv[0] == 'rollup':
+        rollup_main(argv[1:])
+        return
+
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+
+    profiler = None
+    if args.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.trace_memory:
+        import tracemalloc
+
+        tracemalloc.start()
+    try:
+        report_main(args, stats)
+    finally:
+        if args.trace_memory:
+            import tracemalloc
+
+            tracemalloc.stop()
+        if profiler is not None:
+            profiler.disable()
+            try:
+                profiler.dump_stats(args.profile)
+                print(f"Профиль записан в файл {args.profile}.", file=sys.stderr)
+            except IOError as e:
+                print(f"Ошибка при записи профиля в файл {args.profile}: {e}", file=sys.stderr)
+
+
+def report_main(args, stats=None):
+    if stats is None:
+        stats = RunStats(enabled=bool(args.stats or args.trace_memory))
+
+    parsed_dates = {}
+    for option, value in (('date', args.date), ('date_from', args.date_from), ('date_to', args.date_to)):
+        if not value:
+            continue
         try:
-            specific_date = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+            parsed_dates[option] = datetime.datetime.strptime(value, '%Y-%m-%d').date()
         except ValueError:
-            print(f"Ошибка: Неверный формат даты '{args.date}'. Ожидается YYYY-MM-DD.", file=sys.stderr)
+            print(f"Ошибка: Неверный формат даты '{value}'. Ожидается YYYY-MM-DD.", file=sys.stderr)
             sys.exit(1)
             return
 
+    window = None
+    if 'date' in parsed_dates:
+        if 'date_from' in parsed_dates or 'date_to' in parsed_dates:
+            print("Ошибка: --date нельзя использовать вместе с --date-from/--date-to.", file=sys.stderr)
+            sys.exit(1)
+            return
+        window = DateWindow(parsed_dates['date'], parsed_dates['date'])
+    elif parsed_dates:
+        window = DateWindow(parsed_dates.get('date_from'), parsed_dates.get('date_to'))
+        if window.date_from and window.date_to and window.date_from > window.date_to:
+            print(f"Ошибка: Начало диапазона {window.lo} позже конца {window.hi}.", file=sys.stderr)
+            sys.exit(1)
+            return
 
-    if not args.files:
+    if not args.files and not args.load_stats and not args.rollup_db:
         print("Ошибка: Необходимо указать файлы для обработки с помощью --files.", file=sys.stderr)
         sys.exit(1)
         return
 
-    all_log_entries = parse_log_files(args.files)
+    if args.workers < 1:
+        print(f"Ошибка: Количество процессов должно быть положительным, получено {args.workers}.", file=sys.stderr)
+        sys.exit(1)
+        return
 
-    if not all_log_entries:
-        print("Не удалось прочитать ни одной валидной записи лога из указанных файлов.", file=sys.stderr)
-        if args.createfile:
-            sys.stdout = original_stdout
+    if args.io_concurrency < 1:
+        print(f"Ошибка: Значение --io-concurrency должно быть положительным, получено {args.io_concurrency}.",
+              file=sys.stderr)
+        sys.exit(1)
+        return
+    if args.io_concurrency > 1:
+        for option, enabled in (('--workers', args.workers > 1), ('--follow', args.follow),
+                                ('--incremental', args.incremental)):
+            if enabled:
+                print(f"Ошибка: --io-concurrency нельзя использовать вместе с {option}.", file=sys.stderr)
+                sys.exit(1)
+                return
+
+    try:
+        group_by = parse_group_by(args.group_by)
+    except ValueError as e:
+        print(f"Ошибка: {e}.", file=sys.stderr)
+        sys.exit(1)
+        return
+    if group_by != DEFAULT_GROUP_BY:
+        # Агрегаты в JSON хранятся по строковому ключу URL, составные ключи туда не помещаются.
+        for option, enabled in (('--incremental', args.incremental), ('--save-stats', args.save_stats),
+                                ('--load-stats', args.load_stats)):
+            if enabled:
+                print(f"Ошибка: --group-by нельзя использовать вместе с {option}.", file=sys.stderr)
+                sys.exit(1)
+                return
+
+    try:
+        decoder = make_record_decoder(args.decoder, args.timestamp_field, group_by, args.metric)
+    except ValueError as e:
+        print(f"Ошибка: Декодер '{args.decoder}' недоступен: {e}.", file=sys.stderr)
+        sys.exit(1)
+        return
+
+    percentile_accuracy = None
+    if args.percentiles:
+        if not 0 < args.percentile_accuracy < 1:
+            print(f"Ошибка: Точность перцентилей должна быть в интервале (0, 1), получено {args.percentile_accuracy}.",
+                  file=sys.stderr)
+            sys.exit(1)
+            return
+        percentile_accuracy = args.percentile_accuracy
+
+    url_normalizer = None
+    if args.strip_query or args.collapse_ids or args.url_template:
+        try:
+            url_normalizer = UrlNormalizer(args.strip_query, args.collapse_ids, args.url_template or ())
+        except ValueError as e:
+            print(f"Ошибка: {e}.", file=sys.stderr)
+            sys.exit(1)
+            return
+        if 'url' not in group_by:
+            print("Ошибка: Нормализация URL требует поля url в --group-by.", file=sys.stderr)
+            sys.exit(1)
+            return
+    heavy_hitters = None
+    if args.top is not None and args.top < 1:
+        print(f"Ошибка: Значение --top должно быть положительным, получено {args.top}.", file=sys.stderr)
+        sys.exit(1)
+        return
+    if args.top_by not in ('total', 'avg') and not args.percentiles:
+        # Колонки max и перцентилей есть только в отчёте с --percentiles.
+        print(f"Ошибка: Сортировка по {args.top_by} требует --percentiles.", file=sys.stderr)
+        sys.exit(1)
+        return
+    if args.approx_top:
+        if not args.top or args.top_by != 'total':
+            print("Ошибка: --approx-top работает только вместе с --top и --top-by total.", file=sys.stderr)
+            sys.exit(1)
+            return
+        for option, enabled in (('--follow', args.follow), ('--incremental', args.incremental),
+                                ('--save-stats', args.save_stats), ('--load-stats', args.load_stats)):
+            if enabled:
+                print(f"Ошибка: --approx-top нельзя использовать вместе с {option}.", file=sys.stderr)
+                sys.exit(1)
+                return
+        heavy_hitters = args.top * HEAVY_HITTERS_CAPACITY_FACTOR
+    try:
+        backend = resolve_aggregation_backend(args.backend)
+    except ValueError as e:
+        print(f"Ошибка: Движок агрегации '{args.backend}' недоступен: {e}.", file=sys.stderr)
         sys.exit(1)
         return
+    options = MetricsOptions(percentile_accuracy, url_normalizer, heavy_hitters, backend, group_by, args.metric)
 
-    if specific_date:
-        filtered_entries = filter_log_entries_by_date(all_log_entries, specific_date)
-        if not filtered_entries:
-            print(f"Нет записей лога, соответствующих дате {specific_date.strftime('%Y-%m-%d')}.", file=sys.stderr)
-            if args.createfile:
-                sys.stdout = original_stdout
-            sys.exit(0)
+    bucket_seconds = None
+    if args.bucket:
+        try:
+            bucket_seconds = parse_bucket_duration(args.bucket)
+        except ValueError as e:
+            print(f"Ошибка: {e}.", file=sys.stderr)
+            sys.exit(1)
             return
-        all_log_entries = filtered_entries
+        for option, enabled in (('--follow', args.follow), ('--incremental', args.incremental),
+                                ('--percentiles', args.percentiles), ('--save-stats', args.save_stats),
+                                ('--load-stats', args.load_stats), ('--top', args.top),
+                                ('--top-by', args.top_by != 'total'), ('--format prom', args.format == 'prom')):
+            if enabled:
+                print(f"Ошибка: --bucket нельзя использовать вместе с {option}.", file=sys.stderr)
+                sys.exit(1)
+                return
 
-    url_metrics = analyze_url_metrics(all_log_entries)
+    if args.rollup_db:
+        if not window:
+            print("Ошибка: --rollup-db работает только с --date, --date-from или --date-to.", file=sys.stderr)
+            sys.exit(1)
+            return
+        for option, enabled in (('--follow', args.follow), ('--incremental', args.incremental),
+                                ('--bucket', bucket_seconds), ('--approx-top', heavy_hitters),
+                                ('--group-by/--metric', options.custom_schema)):
+            if enabled:
+                print(f"Ошибка: --rollup-db нельзя использовать вместе с {option}.", file=sys.stderr)
+                sys.exit(1)
+                return
 
-    print_url_metrics_table(url_metrics)
+    files = expand_log_paths(args.files or [])
+    columnar_files = [filepath for filepath in files if is_columnar_log(filepath)]
+    if columnar_files:
+        files = [filepath for filepath in files if filepath not in columnar_files]
+        for option, enabled in (('--follow', args.follow), ('--incremental', args.incremental),
+                                ('--rollup-db', args.rollup_db)):
+            if enabled:
+                print(f"Ошибка: Колоночные файлы нельзя использовать вместе с {option}.", file=sys.stderr)
+                sys.exit(1)
+                return
+        if options.custom_schema or args.timestamp_field != '@timestamp':
+            print("Ошибка: Колоночные файлы хранят только поля url, response_time и @timestamp, "
+                  "--group-by, --metric и --timestamp-field для них не поддерживаются.", file=sys.stderr)
+            sys.exit(1)
+            return
 
-    if args.createfile:
-        sys.stdout = original_stdout
+    if args.follow:
+        if args.createfile:
+            print("Ошибка: --follow нельзя использовать вместе с --createfile.", file=sys.stderr)
+            sys.exit(1)
+            return
+        if args.format != 'table':
+            print(f"Ошибка: --follow выводит только таблицу, --format {args.format} не поддерживается.",
+                  file=sys.stderr)
+            sys.exit(1)
+            return
+        if args.interval <= 0:
+            print(f"Ошибка: Интервал обновления должен быть положительным, получено {args.interval}.", file=sys.stderr)
+            sys.exit(1)
+            return
+        try:
+            follow_log_files(files, decoder, window, args.interval,
+                             render=functools.partial(render_live_table, percentiles=options.percentiles,
+                                                      top=args.top, top_by=args.top_by, group_by=group_by,
+                                                      metric=args.metric),
+                             options=options)
+        except KeyboardInterrupt:
+            pass
+        return
 
-        report_base_name = args.report
-        if specific_date:
-            report_base_name += f"_{specific_date.strftime('%Y-%m-%d')}"
+    loaded_url_stats = {}
+    for stats_path in args.load_stats or []:
+        try:
+            with stats.stage('load_stats'):
+                loaded = load_url_stats(stats_path)
+                if url_normalizer is not None:
+                    loaded = normalize_url_stats(loaded, url_normalizer.normalize)
+                merge_url_stats(loaded_url_stats, loaded)
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            print(f"Ошибка при чтении агрегатов из файла '{stats_path}': {e}", file=sys.stderr)
+            sys.exit(1)
+            return
 
-        log_filename = get_unique_filename(report_base_name, extension=".txt")
+    rolled_up_url_stats = {}
+    # Строки, взятые из сводок индекса и --rollup-db, не читаются из логов и считаются отдельно от parsed.
+    index_counters = {'date_skipped': 0, 'summarized': 0}
+    if args.rollup_db:
+        import sqlite3
 
         try:
-            with open(log_filename, 'w', encoding='utf-8') as f:
-                f.write(output_buffer.getvalue())
-            print(f"Вывод успешно записан в файл: {log_filename}")
+            with stats.stage('rollup'):
+                rolled_up_url_stats, rolled_up_days, rolled_up_files = query_rollups(
+                    args.rollup_db, window, options, args.timestamp_field, files)
+        except (IOError, ValueError, KeyError, TypeError, sqlite3.Error) as e:
+            print(f"Ошибка при чтении сводок из файла '{args.rollup_db}': {e}", file=sys.stderr)
+            sys.exit(1)
+            return
+        if url_normalizer is not None:
+            rolled_up_url_stats = normalize_url_stats(rolled_up_url_stats, url_normalizer.normalize)
+        index_counters['summarized'] = sum(rolled_up_days.values())
+        files = [filepath for filepath in files if filepath not in rolled_up_files]
+        window = DateWindow(window.date_from, window.date_to, frozenset(rolled_up_days))
+
+    reads = [('file', filepath) for filepath in files]
+    if window and files and not args.incremental:
+        use_summaries = (not options.percentiles and not bucket_seconds and not heavy_hitters
+                         and not options.custom_schema)
+        with stats.stage('index'):
+            reads = plan_indexed_reads(files, window, index_counters, use_summaries, decoder)
+        if url_normalizer is not None:
+            reads = [(kind, normalize_url_stats(item, url_normalizer.normalize) if kind == 'summary' else item)
+                     for kind, item in reads]
+
+    with stats.stage('aggregate'):
+        if args.incremental:
+            state_path = args.state_file or f"{args.report}.state.json"
+            try:
+                state = load_incremental_state(state_path, window, options)
+                url_stats, counters, state = analyze_log_files_incremental(files, state, decoder, window, options)
+            except (IOError, ValueError, KeyError, TypeError) as e:
+                print(f"Ошибка при чтении файла состояния '{state_path}': {e}", file=sys.stderr)
+                sys.exit(1)
+                return
+            try:
+                save_incremental_state(state_path, state)
+            except IOError as e:
+                print(f"Ошибка при записи файла состояния {state_path}: {e}", file=sys.stderr)
+        else:
+            # Сводки вливаются в том месте, где их строки встретились бы при чтении файлов подряд,
+            # поэтому URL с равными значениями метрики выводятся в том же порядке, что и без сводок.
+            counters = {'parsed': 0, 'matched': 0, 'date_skipped': 0}
+            url_stats = rolled_up_url_stats or None
+            summarized_records = count_aggregated_records(rolled_up_url_stats)
+            for group_files, segments, summary in group_log_reads(reads):
+                if args.workers > 1:
+                    url_stats, group_counters = analyze_log_files_parallel(
+                        group_files, args.workers, window, decoder.name, options, bucket_seconds, segments,
+                        args.timestamp_field, url_stats)
+                    for key, value in group_counters.items():
+                        counters[key] = counters.get(key, 0) + value
+                else:
+                    if args.io_concurrency > 1:
+                        records = iter_log_entries_concurrent(group_files, args.io_concurrency, window, counters,
+                                                              decoder, stats=stats)
+                    else:
+                        records = iter_log_entries(group_files, window, counters=counters, decoder=decoder,
+                                                   stats=stats)
+                    if segments:
+                        records = itertools.chain(records, iter_log_segment_entries(segments, window, counters,
+                                                                                    decoder, stats))
+                    records = count_log_entries(stats.iterate('decode', records), counters, 'parsed')
+                    if window:
+                        records = count_log_entries(
+                            stats.iterate('filter', iter_records_in_window(records, window, decoder)), counters,
+                            'matched')
+                    if bucket_seconds:
+                        url_stats = accumulate_bucketed_records(records, decoder, bucket_seconds, url_stats,
+                                                                options)
+                    elif heavy_hitters:
+                        url_stats = accumulate_heavy_hitters(records, decoder, url_stats, options)
+                    else:
+                        url_stats = accumulate_url_records(records, decoder, url_stats, options)
+                if summary:
+                    merge_url_stats(url_stats, summary)
+                    summarized_records += count_aggregated_records(summary)
+
+    missing_fields = None
+    if stats.enabled and not args.incremental:
+        aggregated = count_aggregated_records(url_stats)
+        if aggregated is not None:
+            missing_fields = counters['matched' if window else 'parsed'] - aggregated + summarized_records
+
+    for key, value in index_counters.items():
+        counters[key] = counters.get(key, 0) + value
+    for filepath in columnar_files:
+        with stats.stage('columnar'):
+            try:
+                columns = load_columnar_log(filepath)
+            except (IOError, ValueError, KeyError, TypeError) as e:
+                print(f"Ошибка при чтении файла '{filepath}': {e}", file=sys.stderr)
+                continue
+            warn_stale_columnar_sources(filepath, columns)
+            accumulate_columnar_log(columns, url_stats, window, options, counters)
+
+    if args.save_stats:
+        try:
+            with stats.stage('save_stats'):
+                save_url_stats(url_stats, args.save_stats)
         except IOError as e:
-            print(f"Ошибка при записи в файл {log_filename}: {e}", file=sys.stderr)
-    else:
-        pass
+            print(f"Ошибка при записи агрегатов в файл {args.save_stats}: {e}", file=sys.stderr)
+
+    if not bucket_seconds and not heavy_hitters:
+        url_stats = merge_url_stats(url_stats, loaded_url_stats)
+
+    if not counters['parsed'] and not counters['date_skipped'] and not counters['summarized'] and not url_stats:
+        print("Не удалось прочитать ни одной валидной записи лога из указанных файлов.", file=sys.stderr)
+        sys.exit(1)
+        return
+
+    if window and not counters['matched'] and not counters['summarized'] and not url_stats:
+        print(f"Нет записей лога, соответствующих {window.describe()}.", file=sys.stderr)
+        sys.exit(0)
+        return
+
+    out = sys.stdout
+    report_file = None
+    if args.createfile:
+        report_base_name = args.report
+        if window:
+            report_base_name += f"_{window.label()}"
+        extension = REPORT_EXTENSIONS[args.format]
+        try:
+            report_file = ReportFile(report_base_name, extension)
+        except IOError as e:
+            print(f"Ошибка при записи в файл {report_base_name}{extension}: {e}", file=sys.stderr)
+            sys.exit(1)
+            return
+        out = report_file.stream
+
+    try:
+        with stats.stage('render'):
+            if bucket_seconds:
+                write_bucketed_metrics(url_stats, args.format, out, group_by, args.metric)
+            elif heavy_hitters:
+                url_metrics = finalize_heavy_hitters(url_stats, args.top, options.percentiles)
+                write_url_metrics(url_metrics, args.format, out=out, group_by=group_by, metric=args.metric)
+                max_error = max((url_stats.errors[url] for url in url_metrics), default=0)
+                if max_error:
+                    print(f"Внимание: Значения total приближённые, завышение не больше {max_error}.", file=sys.stderr)
+            else:
+                if args.top:
+                    url_stats = select_top_url_stats(url_stats, args.top, args.top_by)
+                write_url_metrics(finalize_url_metrics(url_stats, options.percentiles), args.format, args.top_by, out,
+                                  group_by, args.metric)
+        if report_file is not None:
+            with stats.stage('write'):
+                log_filename = report_file.commit()
+            print(f"Вывод успешно записан в файл: {log_filename}")
+    except IOError as e:
+        if report_file is None:
+            raise
+        report_file.discard()
+        print(f"Ошибка при записи в файл {report_file.base_name}{report_file.extension}: {e}", file=sys.stderr)
+    except BaseException:
+        # Прерванный отчёт (Ctrl+C, ошибка форматирования) не должен оставлять временный файл.
+        if report_file is not None:
+            report_file.discard()
+        raise
+
+    if stats.enabled:
+        report = stats.finish(counters, bool(window), missing_fields)
+        if args.stats or args.trace_memory:
+            print_run_stats(report, args.stats or 'text')
 
 
 if __name__ == "__main__":
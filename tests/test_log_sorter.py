@@ -1,10 +1,22 @@
 import pytest
+import json
 import os
 import datetime
 import sys
 from unittest.mock import patch
 import argparse
 import re
+import io
+import gzip
+import threading
+import random
+import pickle
+import collections
+import math
+import copy
+import time
+import csv
+import subprocess
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(current_dir, os.pardir))
@@ -14,16 +26,92 @@ if project_root not in sys.path:
 
 
 
+import main as log_sorter
 from main import (
     get_unique_filename,
+    iter_log_entries,
     parse_log_files,
+    iter_log_entries_by_date,
     filter_log_entries_by_date,
+    filter_log_entries_by_date_range,
+    timestamp_date_prefix,
+    DateWindow,
+    make_raw_line_date_filter,
+    count_log_entries,
+    iter_mmap_lines,
+    detect_compression,
+    iter_decompressed_chunks,
+    iter_chunk_lines,
+    loads_json_stdlib,
+    make_record_decoder,
+    iter_records_in_window,
+    accumulate_url_records,
+    parse_log_line,
     analyze_url_metrics,
+    accumulate_url_metrics,
+    merge_url_stats,
+    finalize_url_metrics,
+    UrlStats,
+    LatencySketch,
+    MetricsOptions,
+    dump_url_stats,
+    restore_url_stats,
+    save_url_stats,
+    load_url_stats,
+    plan_log_shards,
+    iter_log_shard_entries,
+    analyze_log_files_parallel,
+    empty_incremental_state,
+    load_incremental_state,
+    save_incremental_state,
+    complete_lines_end,
+    analyze_log_files_incremental,
+    LogFollower,
+    follow_log_files,
     print_url_metrics_table,
+    parse_bucket_duration,
+    BucketedStats,
+    accumulate_bucketed_records,
+    UrlNormalizer,
+    SpaceSaving,
+    accumulate_heavy_hitters,
+    select_top_url_stats,
+    update_log_index,
+    load_log_index,
+    save_log_index,
+    log_index_path,
+    convert_to_columnar,
+    save_columnar_log,
+    load_columnar_log,
+    is_columnar_log,
+    accumulate_columnar_log,
+    accumulate_url_records_numpy,
+    resolve_aggregation_backend,
+    expand_log_paths,
+    iter_log_entries_concurrent,
+    RunStats,
+    print_bucketed_metrics_table,
+    shorten_url,
+    format_bucket_start,
+    write_url_metrics,
+    write_bucketed_metrics,
+    normalize_url_stats,
+    parse_group_by,
+    accumulate_daily_rollups,
+    save_daily_rollups,
+    query_rollups,
+    build_arg_parser,
     main
 )
 
 
+DEFAULT_ARGS = vars(build_arg_parser().parse_args(["--report", "TestReport"]))
+
+
+def make_args(**overrides):
+    return argparse.Namespace(**{**DEFAULT_ARGS, **overrides})
+
+
 
 def test_get_unique_filename_no_conflict(mocker):
     mocker.patch('os.path.exists', return_value=False)
@@ -108,6 +196,549 @@ def test_parse_log_files_io_error(mocker, capsys):
 
 
 
+def test_iter_log_entries_is_lazy(tmp_path):
+    file_path = tmp_path / "test.log"
+    file_path.write_text('{"a": 1}\n{"b": 2}\n')
+    entries = iter_log_entries([str(file_path)])
+    assert not isinstance(entries, list)
+    assert next(entries) == {"a": 1}
+    assert list(entries) == [{"b": 2}]
+
+
+def test_iter_log_entries_multiple_files(tmp_path):
+    first = tmp_path / "first.log"
+    second = tmp_path / "second.log"
+    first.write_text('{"a": 1}\n')
+    second.write_text('{"b": 2}\n')
+    assert list(iter_log_entries([str(first), str(second)])) == [{"a": 1}, {"b": 2}]
+
+
+def _write_sharded_log(path, lines):
+    path.write_text("".join(line + "\n" for line in lines))
+
+
+def test_iter_mmap_lines(tmp_path):
+    file_path = tmp_path / "test.log"
+    file_path.write_bytes(b'{"a": 1}\r\n\n{"b": 2}')
+    with open(file_path, 'rb') as f:
+        assert list(iter_mmap_lines(f)) == [b'{"a": 1}\r\n', b'\n', b'{"b": 2}']
+    with open(file_path, 'rb') as f:
+        assert list(iter_mmap_lines(f, 0, 11)) == [b'{"a": 1}\r\n', b'\n']
+    with open(file_path, 'rb') as f:
+        assert list(iter_mmap_lines(f, 11)) == [b'{"b": 2}']
+
+
+def test_iter_mmap_lines_empty_file(tmp_path):
+    file_path = tmp_path / "empty.log"
+    file_path.write_bytes(b"")
+    with open(file_path, 'rb') as f:
+        assert list(iter_mmap_lines(f)) == []
+
+
+def test_parse_log_line_accepts_bytes(capsys):
+    assert parse_log_line(b'{"url": "/\xd0\xb0"}\n', "test.log") == {"url": "/а"}
+    assert parse_log_line(b'  \r\n', "test.log") is None
+    assert parse_log_line(b'\xff broken\n', "test.log") is None
+    assert "Не удалось распарсить строку как JSON в 'test.log'" in capsys.readouterr().err
+
+
+def test_loads_json_stdlib():
+    assert loads_json_stdlib(b'{"a": [1, 2.5]}') == {"a": [1, 2.5]}
+    assert loads_json_stdlib('{"a": null}') == {"a": None}
+    with pytest.raises(ValueError):
+        loads_json_stdlib(b'{broken')
+
+
+AVAILABLE_DECODERS = ['json'] + [
+    name for name, module in (('orjson', 'orjson'), ('msgspec', 'msgspec'))
+    if getattr(sys.modules['main'], module) is not None
+]
+
+
+@pytest.mark.parametrize("name", AVAILABLE_DECODERS)
+def test_record_decoder_projects_fields(name):
+    decoder = make_record_decoder(name)
+    fields = [decoder.getter(field) for field in ('url', 'response_time', 'timestamp')]
+    record = decoder.decode(b'{"@timestamp": "2023-01-01T10:00:00Z", "url": "/a", "headers": {"x": [1, 2]}, '
+                            b'"response_time": 1.5, "trace_id": "abc"}\n')
+    assert [get(record) for get in fields] == ["/a", 1.5, "2023-01-01T10:00:00Z"]
+
+    record = decoder.decode(b'{"message": "no fields"}')
+    assert [get(record) for get in fields] == [None, None, None]
+
+
+def test_msgspec_decoder_skips_unused_fields():
+    if sys.modules['main'].msgspec is None:
+        pytest.skip("msgspec не установлен")
+    decoder = make_record_decoder('msgspec')
+    assert decoder.projected
+    record = decoder.decode(b'{"url": "/a", "trace_id": "abc", "response_time": 1}')
+    assert not hasattr(record, 'trace_id')
+
+
+@pytest.mark.parametrize("name", AVAILABLE_DECODERS)
+def test_record_decoder_invalid_input(name, tmp_path, capsys):
+    decoder = make_record_decoder(name)
+    with pytest.raises(ValueError):
+        decoder.decode(b'{broken')
+
+    file_path = tmp_path / "test.log"
+    file_path.write_text('[1, 2]\n{"url": "/a"}\n')
+    records = list(iter_log_entries([str(file_path)], decoder=decoder))
+    assert [decoder.getter('url')(record) for record in records] == ["/a"]
+    assert "[1, 2]" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("name", AVAILABLE_DECODERS)
+def test_record_decoder_custom_timestamp_field(name):
+    decoder = make_record_decoder(name, 'event_time')
+    record = decoder.decode(b'{"event_time": "2023-01-01", "@timestamp": "x"}')
+    assert decoder.getter('timestamp')(record) == "2023-01-01"
+
+
+def test_make_record_decoder_auto_and_unknown(mocker):
+    assert make_record_decoder('auto').name in ('msgspec', 'orjson', 'json')
+    mocker.patch('main.msgspec', None)
+    mocker.patch('main.orjson', None)
+    assert make_record_decoder('auto').name == 'json'
+    with pytest.raises(ValueError):
+        make_record_decoder('orjson')
+    with pytest.raises(ValueError):
+        make_record_decoder('yaml')
+
+
+def test_iter_log_entries_with_record_decoder(tmp_path, capsys):
+    file_path = tmp_path / "test.log"
+    file_path.write_text('{"url": "/a", "response_time": 10, "@timestamp": "2023-01-01T10:00:00Z", "x": 1}\n'
+                         'Invalid JSON\n'
+                         '{"url": "/b", "response_time": 20, "@timestamp": "2023-01-02T10:00:00Z"}\n')
+    decoder = make_record_decoder(AVAILABLE_DECODERS[-1])
+    get_url = decoder.getter('url')
+    records = list(iter_log_entries([str(file_path)], decoder=decoder))
+    assert [get_url(r) for r in records] == ["/a", "/b"]
+    assert "Invalid JSON" in capsys.readouterr().err
+
+    day = datetime.date(2023, 1, 2)
+    assert [get_url(r) for r in iter_records_in_window(records, DateWindow(day, day), decoder)] == ["/b"]
+    assert finalize_url_metrics(accumulate_url_records(records, decoder)) == {
+        "/a": {"total": 1, "avg_time": 10.0},
+        "/b": {"total": 1, "avg_time": 20.0},
+    }
+
+
+COMPRESSED_LINES = [f'{{"url": "/u{i % 5}", "response_time": {i}}}' for i in range(1000)]
+
+
+def _write_gzip_members(path, lines, members=3):
+    step = len(lines) // members + 1
+    with open(path, 'wb') as f:
+        for i in range(0, len(lines), step):
+            f.write(gzip.compress("".join(line + "\n" for line in lines[i:i + step]).encode('utf-8')))
+
+
+def test_detect_compression(tmp_path):
+    plain = tmp_path / "plain.log.gz"
+    plain.write_text('{"a": 1}\n')
+    packed = tmp_path / "packed.log"
+    packed.write_bytes(gzip.compress(b'{"a": 1}\n'))
+    zstd = tmp_path / "frame.zst"
+    zstd.write_bytes(b'\x28\xb5\x2f\xfd' + b'\x00' * 8)
+    assert detect_compression(str(plain)) is None
+    assert detect_compression(str(packed)) == 'gzip'
+    assert detect_compression(str(zstd)) == 'zstd'
+
+
+def test_iter_chunk_lines_splits_across_chunks():
+    chunks = [b'{"a"', b': 1}\n{"b": 2}\n\n{"c"', b': 3}']
+    assert list(iter_chunk_lines(chunks)) == [b'{"a": 1}', b'{"b": 2}', b'', b'{"c": 3}']
+
+
+def test_iter_decompressed_chunks_reads_in_background():
+    stream = io.BytesIO(b"x" * 10)
+    assert b"".join(iter_decompressed_chunks(stream, chunk_size=3, queue_size=1)) == b"x" * 10
+
+
+def test_iter_decompressed_chunks_early_close_stops_thread():
+    stream = io.BytesIO(b"x" * 1000)
+    before = threading.active_count()
+    chunks = iter_decompressed_chunks(stream, chunk_size=1, queue_size=1)
+    assert next(chunks) == b"x"
+    chunks.close()
+    assert threading.active_count() == before
+
+
+def test_iter_decompressed_chunks_propagates_errors():
+    class BrokenStream:
+        def read(self, size):
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+    with pytest.raises(IOError, match="ошибка распаковки"):
+        list(iter_decompressed_chunks(BrokenStream()))
+
+
+def test_parse_log_files_multi_member_gzip(tmp_path):
+    file_path = tmp_path / "rotated.log.gz"
+    _write_gzip_members(file_path, COMPRESSED_LINES)
+    assert parse_log_files([str(file_path)]) == [json.loads(line) for line in COMPRESSED_LINES]
+
+
+def test_parse_log_files_zstd(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    file_path = tmp_path / "rotated.log.zst"
+    compressor = zstandard.ZstdCompressor()
+    data = "".join(line + "\n" for line in COMPRESSED_LINES).encode('utf-8')
+    file_path.write_bytes(compressor.compress(data[:5000]) + compressor.compress(data[5000:]))
+    assert parse_log_files([str(file_path)]) == [json.loads(line) for line in COMPRESSED_LINES]
+
+
+def test_parse_log_files_zstd_without_package(tmp_path, mocker, capsys):
+    file_path = tmp_path / "rotated.log.zst"
+    file_path.write_bytes(b'\x28\xb5\x2f\xfd' + b'\x00' * 8)
+    mocker.patch('main.zstandard', None)
+    assert parse_log_files([str(file_path)]) == []
+    assert "нужен пакет zstandard" in capsys.readouterr().err
+
+
+def test_parse_log_files_truncated_gzip(tmp_path, capsys):
+    file_path = tmp_path / "broken.log.gz"
+    file_path.write_bytes(gzip.compress(b'{"a": 1}\n' * 1000)[:-20])
+    parse_log_files([str(file_path)])
+    assert "Ошибка при чтении файла" in capsys.readouterr().err
+
+
+def test_plan_log_shards_keeps_compressed_files_whole(tmp_path):
+    file_path = tmp_path / "rotated.log.gz"
+    _write_gzip_members(file_path, COMPRESSED_LINES)
+    shards = plan_log_shards([str(file_path)], 16)
+    assert shards == [(str(file_path), 0, file_path.stat().st_size)]
+    entries = list(iter_log_shard_entries(*shards[0]))
+    assert len(entries) == len(COMPRESSED_LINES)
+
+
+def test_plan_log_shards_aligned_to_lines(tmp_path):
+    file_path = tmp_path / "test.log"
+    lines = [f'{{"url": "/u{i % 7}", "response_time": {i}}}' for i in range(200)]
+    _write_sharded_log(file_path, lines)
+    data = file_path.read_bytes()
+
+    shards = plan_log_shards([str(file_path)], 8)
+    assert len(shards) > 1
+    assert shards[0][1] == 0
+    assert shards[-1][2] == len(data)
+    for (_, _, end), (_, next_start, _) in zip(shards, shards[1:]):
+        assert end == next_start
+        assert data[end - 1:end] == b"\n"
+
+
+def test_plan_log_shards_across_files(tmp_path, capsys):
+    first = tmp_path / "first.log"
+    second = tmp_path / "second.log"
+    empty = tmp_path / "empty.log"
+    _write_sharded_log(first, ['{"a": 1}'] * 10)
+    _write_sharded_log(second, ['{"b": 2}'] * 10)
+    empty.write_text("")
+
+    shards = plan_log_shards([str(first), str(tmp_path / "missing.log"), str(empty), str(second)], 2)
+    assert {shard[0] for shard in shards} == {str(first), str(second)}
+    assert "Файл" in capsys.readouterr().err
+
+
+def test_iter_log_shard_entries_covers_file_once(tmp_path):
+    file_path = tmp_path / "test.log"
+    lines = [f'{{"n": {i}}}' for i in range(100)]
+    _write_sharded_log(file_path, lines)
+
+    entries = []
+    for filepath, start, end in plan_log_shards([str(file_path)], 5):
+        entries.extend(iter_log_shard_entries(filepath, start, end))
+    assert entries == [{"n": i} for i in range(100)]
+
+
+def test_analyze_log_files_parallel_matches_serial(tmp_path):
+    file_path = tmp_path / "test.log"
+    lines = [f'{{"url": "/u{i % 13}", "response_time": {i % 97}, "@timestamp": "2023-01-0{1 + i % 3}T10:00:00"}}'
+             for i in range(500)]
+    _write_sharded_log(file_path, lines)
+
+    window = DateWindow(datetime.date(2023, 1, 2), datetime.date(2023, 1, 2))
+    url_data, counters = analyze_log_files_parallel([str(file_path)], 2, window)
+    serial = analyze_url_metrics(filter_log_entries_by_date(parse_log_files([str(file_path)]),
+                                                            datetime.date(2023, 1, 2)))
+    assert finalize_url_metrics(url_data) == serial
+    assert list(finalize_url_metrics(url_data)) == list(serial)
+    matched = sum(1 for i in range(500) if i % 3 == 1)
+    assert counters == {'parsed': matched, 'matched': matched, 'date_skipped': 500 - matched}
+
+
+def _float_log_lines(count=3000, seed=11):
+    rng = random.Random(seed)
+    lines, values = [], {}
+    for i in range(count):
+        url = f"/u{i % 7}"
+        value = round(rng.expovariate(10), 3) if i % 5 else rng.uniform(1e6, 1e7)
+        values.setdefault(url, []).append(value)
+        lines.append(json.dumps({"url": url, "response_time": value, "@timestamp": f"2023-01-0{1 + i % 3}T10:00:00"}))
+    return lines, values
+
+
+@pytest.mark.parametrize("workers", [2, 3, 4])
+def test_analyze_log_files_parallel_matches_serial_with_floats(tmp_path, workers):
+    file_path = tmp_path / "test.log"
+    lines, values = _float_log_lines()
+    _write_sharded_log(file_path, lines)
+
+    url_data, _ = analyze_log_files_parallel([str(file_path)], workers)
+    serial = analyze_url_metrics(parse_log_files([str(file_path)]))
+    assert {url: stats.total for url, stats in url_data.items()} == \
+        {url: math.fsum(url_values) for url, url_values in values.items()}
+    assert finalize_url_metrics(url_data) == serial
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_workers_output_matches_serial_with_floats(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    _write_sharded_log(log_file, _float_log_lines()[0])
+    outputs = []
+    for workers in (1, 3, 4):
+        mock_parse_args.return_value = make_args(files=[str(log_file)], date_from="2023-01-02", format="jsonl",
+                                                 workers=workers)
+        main()
+        outputs.append(capsys.readouterr().out)
+    mock_sys_exit.assert_not_called()
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+def test_analyze_log_files_parallel_no_files():
+    assert analyze_log_files_parallel([], 4) == ({}, {'parsed': 0, 'matched': 0, 'date_skipped': 0})
+
+
+def _run_incremental(filepaths, state, window=None):
+    url_stats, counters, state = analyze_log_files_incremental(
+        [str(path) for path in filepaths], state, make_record_decoder('json'), window)
+    return finalize_url_metrics(url_stats), counters, state
+
+
+def test_complete_lines_end(tmp_path):
+    file_path = tmp_path / "test.log"
+    file_path.write_bytes(b'{"a": 1}\n{"b": 2}\n{"c"')
+    assert complete_lines_end(str(file_path), 0, 21) == 18
+    assert complete_lines_end(str(file_path), 18, 21) == 18
+    assert complete_lines_end(str(file_path), 5, 5) == 5
+
+
+def test_incremental_reads_only_appended_lines(tmp_path):
+    file_path = tmp_path / "access.log"
+    file_path.write_text('{"url": "/a", "response_time": 100}\n{"url": "/b", "response_time": 200}\n')
+
+    metrics, counters, state = _run_incremental([file_path], empty_incremental_state())
+    assert counters['parsed'] == 2
+    assert metrics == {"/a": {"total": 1, "avg_time": 100.0}, "/b": {"total": 1, "avg_time": 200.0}}
+
+    with open(file_path, 'a') as f:
+        f.write('{"url": "/a", "response_time": 150}\n{"url": "/c", "respon')
+    metrics, counters, state = _run_incremental([file_path], state)
+    assert counters['parsed'] == 1
+    assert metrics["/a"] == {"total": 2, "avg_time": 125.0}
+    assert "/c" not in metrics
+
+    with open(file_path, 'a') as f:
+        f.write('se_time": 50}\n')
+    metrics, counters, state = _run_incremental([file_path], state)
+    assert counters['parsed'] == 1
+    assert metrics["/c"] == {"total": 1, "avg_time": 50.0}
+
+    metrics, counters, state = _run_incremental([file_path], state)
+    assert counters['parsed'] == 0
+    assert metrics["/a"]["total"] == 2
+
+
+def test_incremental_keeps_checkpoints_of_files_left_out(tmp_path):
+    first, second = tmp_path / "a.log", tmp_path / "b.log"
+    first.write_text('{"url": "/a", "response_time": 1}\n' * 3)
+    second.write_text('{"url": "/b", "response_time": 2}\n' * 2)
+
+    metrics, _, state = _run_incremental([first, second], empty_incremental_state())
+    assert metrics["/a"]["total"] == 3
+    metrics, counters, state = _run_incremental([first], state)
+    assert counters['parsed'] == 0
+    metrics, counters, state = _run_incremental([first, second], state)
+    assert counters['parsed'] == 0
+    assert metrics == {"/a": {"total": 3, "avg_time": 1.0}, "/b": {"total": 2, "avg_time": 2.0}}
+
+
+def test_incremental_detects_truncation(tmp_path, capsys):
+    file_path = tmp_path / "access.log"
+    file_path.write_text('{"url": "/a", "response_time": 100}\n' * 3)
+    _, _, state = _run_incremental([file_path], empty_incremental_state())
+
+    file_path.write_text('{"url": "/b", "response_time": 10}\n' * 5)
+    metrics, counters, _ = _run_incremental([file_path], state)
+    assert counters['parsed'] == 5
+    assert metrics["/a"]["total"] == 3
+    assert metrics["/b"]["total"] == 5
+    assert "был усечён или перезаписан" in capsys.readouterr().err
+
+
+def test_incremental_follows_rotated_file(tmp_path):
+    current = tmp_path / "access.log"
+    rotated = tmp_path / "access.log.1"
+    current.write_text('{"url": "/a", "response_time": 100}\n')
+    _, _, state = _run_incremental([current], empty_incremental_state())
+
+    with open(current, 'a') as f:
+        f.write('{"url": "/a", "response_time": 200}\n')
+    os.rename(current, rotated)
+    current.write_text('{"url": "/b", "response_time": 10}\n')
+
+    metrics, counters, state = _run_incremental([rotated, current], state)
+    assert counters['parsed'] == 2
+    assert metrics == {"/a": {"total": 2, "avg_time": 150.0}, "/b": {"total": 1, "avg_time": 10.0}}
+    assert set(state['files']) == {str(rotated), str(current)}
+
+
+def test_incremental_reads_compressed_file_once(tmp_path):
+    file_path = tmp_path / "access.log.1.gz"
+    file_path.write_bytes(gzip.compress(b'{"url": "/a", "response_time": 100}\n'))
+    _, counters, state = _run_incremental([file_path], empty_incremental_state())
+    assert counters['parsed'] == 1
+    metrics, counters, _ = _run_incremental([file_path], state)
+    assert counters['parsed'] == 0
+    assert metrics["/a"]["total"] == 1
+
+
+@pytest.mark.parametrize("suffix", [".gz", ".zst"])
+def test_incremental_skips_lines_counted_before_compressed_rotation(tmp_path, suffix):
+    if suffix == ".zst":
+        zstandard = pytest.importorskip("zstandard")
+        compress = zstandard.ZstdCompressor().compress
+    else:
+        compress = gzip.compress
+    current = tmp_path / "access.log"
+    current.write_text('{"url": "/a", "response_time": 100}\n' * 3)
+    _, _, state = _run_incremental([current], empty_incremental_state())
+
+    with open(current, 'a') as f:
+        f.write('{"url": "/a", "response_time": 400}\n')
+    (tmp_path / f"access.log.1{suffix}").write_bytes(compress(current.read_bytes()))
+    current.write_text("")
+
+    files = sorted(tmp_path.glob("access.log*"))
+    metrics, counters, state = _run_incremental(files, state)
+    assert counters['parsed'] == 1
+    assert metrics == {"/a": {"total": 4, "avg_time": 175.0}}
+    metrics, counters, _ = _run_incremental(files, state)
+    assert counters['parsed'] == 0
+    assert metrics["/a"]["total"] == 4
+
+
+def test_incremental_state_round_trip_and_window_reset(tmp_path, capsys):
+    state_path = tmp_path / "report.state.json"
+    day = datetime.date(2023, 1, 1)
+    window = DateWindow(day, day)
+    assert load_incremental_state(str(state_path), window) == empty_incremental_state(window)
+
+    state = empty_incremental_state(window)
+    state['files']['x.log'] = {'offset': 10}
+    save_incremental_state(str(state_path), state)
+    assert load_incremental_state(str(state_path), window) == state
+    assert not os.path.exists(f"{state_path}.tmp")
+
+    assert load_incremental_state(str(state_path), None) == empty_incremental_state(None)
+    assert "изменились с момента прошлого запуска" in capsys.readouterr().err
+
+    state = empty_incremental_state(None, MetricsOptions(0.01))
+    save_incremental_state(str(state_path), state)
+    assert load_incremental_state(str(state_path), None, MetricsOptions(0.01)) == state
+    assert load_incremental_state(str(state_path), None, MetricsOptions(0.02)) == \
+        empty_incremental_state(None, MetricsOptions(0.02))
+
+
+def test_log_follower_reads_appended_complete_lines(tmp_path):
+    file_path = tmp_path / "access.log"
+    file_path.write_bytes(b'{"a": 1}\n{"b"')
+    follower = LogFollower(str(file_path))
+    assert list(follower.poll()) == [b'{"a": 1}']
+    assert list(follower.poll()) == []
+
+    with open(file_path, 'ab') as f:
+        f.write(b': 2}\n{"c": 3}\n')
+    assert list(follower.poll()) == [b'{"b": 2}', b'{"c": 3}']
+    follower.close()
+
+
+def test_log_follower_waits_for_missing_file(tmp_path):
+    file_path = tmp_path / "access.log"
+    follower = LogFollower(str(file_path))
+    assert list(follower.poll()) == []
+    file_path.write_bytes(b'{"a": 1}\n')
+    assert list(follower.poll()) == [b'{"a": 1}']
+    follower.close()
+
+
+def test_log_follower_handles_truncation(tmp_path, capsys):
+    file_path = tmp_path / "access.log"
+    file_path.write_bytes(b'{"a": 1}\n{"a": 2}\n')
+    follower = LogFollower(str(file_path))
+    list(follower.poll())
+    with open(file_path, 'wb') as f:
+        f.write(b'{"b": 1}\n')
+    assert list(follower.poll()) == [b'{"b": 1}']
+    assert "был усечён" in capsys.readouterr().err
+    follower.close()
+
+
+def test_log_follower_handles_rotation(tmp_path):
+    file_path = tmp_path / "access.log"
+    file_path.write_bytes(b'{"a": 1}\n')
+    follower = LogFollower(str(file_path))
+    list(follower.poll())
+
+    with open(file_path, 'ab') as f:
+        f.write(b'{"a": 2}\n{"a": 3}')
+    os.rename(file_path, tmp_path / "access.log.1")
+    file_path.write_bytes(b'{"b": 1}\n')
+    assert list(follower.poll()) == [b'{"a": 2}', b'{"a": 3}', b'{"b": 1}']
+    follower.close()
+
+
+def test_log_follower_skips_compressed_files(tmp_path, capsys):
+    file_path = tmp_path / "access.log.gz"
+    file_path.write_bytes(gzip.compress(b'{"a": 1}\n'))
+    follower = LogFollower(str(file_path))
+    assert list(follower.poll()) == []
+    assert "нельзя отслеживать" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_follow_log_files_updates_metrics_incrementally(tmp_path, mocker, use_inotify):
+    if not use_inotify:
+        mocker.patch('main.inotify_simple', None)
+    elif sys.modules['main'].inotify_simple is None:
+        pytest.skip("inotify_simple не установлен")
+
+    file_path = tmp_path / "access.log"
+    file_path.write_text('{"url": "/a", "response_time": 100}\n')
+    stop_event = threading.Event()
+    snapshots = []
+
+    def render(url_stats):
+        snapshots.append(finalize_url_metrics(url_stats))
+        if len(snapshots) == 1:
+            with open(file_path, 'a') as f:
+                f.write('{"url": "/a", "response_time": 200}\n{"url": "/b", "response_time": 5}\n')
+        elif snapshots[-1].get("/b"):
+            stop_event.set()
+        elif len(snapshots) > 200:
+            stop_event.set()
+
+    url_stats, counters = follow_log_files([str(file_path)], make_record_decoder('json'), interval=0.01,
+                                           render=render, stop_event=stop_event, poll_interval=0.01)
+    assert snapshots[0] == {"/a": {"total": 1, "avg_time": 100.0}}
+    assert snapshots[-1] == {"/a": {"total": 2, "avg_time": 150.0}, "/b": {"total": 1, "avg_time": 5.0}}
+    assert counters['parsed'] == 3
+
+
 def test_filter_log_entries_by_date_no_specific_date():
     logs = [{"@timestamp": "2023-01-01"}, {"@timestamp": "2023-01-02"}]
     assert filter_log_entries_by_date(logs, None) == logs
@@ -167,6 +798,111 @@ def test_filter_log_entries_by_date_custom_timestamp_field():
 
 
 
+def test_filter_log_entries_by_date_matching_date_only_and_offset():
+    logs = [
+        {"@timestamp": "2023-01-01"},
+        {"@timestamp": "2023-01-01T23:59:59+03:00"},
+        {"@timestamp": "2023-01-01t10:00:00"},
+        {"@timestamp": "2023-01-02T00:00:00"},
+    ]
+    assert filter_log_entries_by_date(logs, datetime.date(2023, 1, 1)) == logs[:3]
+
+
+def test_filter_log_entries_by_date_rejects_invalid_prefixes():
+    logs = [
+        {"@timestamp": "2023-13-01T10:00:00"},
+        {"@timestamp": "2023-02-30T10:00:00"},
+        {"@timestamp": "2023-01-01garbage"},
+        {"@timestamp": 20230101},
+        {"@timestamp": None},
+    ]
+    assert filter_log_entries_by_date_range(logs, datetime.date(2000, 1, 1), datetime.date(2100, 1, 1)) == []
+
+
+def test_timestamp_date_prefix_fallback_formats():
+    assert timestamp_date_prefix("2023-01-01T10:00:00Z") == "2023-01-01"
+    assert timestamp_date_prefix("20230101T10:00:00") == "2023-01-01"
+    assert timestamp_date_prefix("2023-01-01 10:00:00,123 extra") == "2023-01-01"
+    assert timestamp_date_prefix("invalid-date-format") is None
+    assert timestamp_date_prefix(None) is None
+
+
+def test_filter_log_entries_by_date_range():
+    logs = [{"@timestamp": f"2023-01-0{day}T10:00:00Z", "day": day} for day in range(1, 6)]
+    assert [e["day"] for e in filter_log_entries_by_date_range(logs, datetime.date(2023, 1, 2),
+                                                                datetime.date(2023, 1, 4))] == [2, 3, 4]
+    assert [e["day"] for e in filter_log_entries_by_date_range(logs, date_from=datetime.date(2023, 1, 4))] == [4, 5]
+    assert [e["day"] for e in filter_log_entries_by_date_range(logs, date_to=datetime.date(2023, 1, 1))] == [1]
+    assert filter_log_entries_by_date_range(logs) == logs
+
+
+def test_date_window_label_and_describe():
+    day = datetime.date(2023, 1, 1)
+    later = datetime.date(2023, 1, 31)
+    assert DateWindow(day, day).label() == "2023-01-01"
+    assert DateWindow(day, day).describe() == "дате 2023-01-01"
+    assert DateWindow(day, later).label() == "2023-01-01_2023-01-31"
+    assert DateWindow(day).label() == "since_2023-01-01"
+    assert DateWindow(date_to=later).label() == "until_2023-01-31"
+
+
+@pytest.mark.parametrize("raw_line, outside", [
+    (b'{"@timestamp":"2023-01-01T10:00:00Z","url":"/a"}', True),
+    (b'{"url": "/a", "@timestamp" : "2023-01-03 10:00:00"}', True),
+    (b'{"@timestamp":"2023-01-02T10:00:00Z","url":"/a"}', False),
+    (b'{"@timestamp":"2023-01-02"}', False),
+    (b'{"@timestamp":"20230101T10:00:00"}', False),
+    (b'{"@timestamp":"2023-W01-1T10:00:00"}', False),
+    (b'{"@timestamp":20230101}', False),
+    (b'{"url":"/a"}', False),
+    (b'{"@timestamp":"2023-01-01T10:00:00Z","@timestamp":"2023-01-02T10:00:00Z"}', False),
+    (b'{"msg":"x\\"@timestamp":"2023-01-01T10:00:00Z"}', False),
+])
+def test_make_raw_line_date_filter(raw_line, outside):
+    day = datetime.date(2023, 1, 2)
+    is_outside_window = make_raw_line_date_filter(DateWindow(day, day))
+    assert is_outside_window(raw_line) is outside
+
+
+def test_make_raw_line_date_filter_custom_field():
+    day = datetime.date(2023, 1, 2)
+    is_outside_window = make_raw_line_date_filter(DateWindow(day, day), 'время')
+    assert is_outside_window('{"время":"2023-01-01T10:00:00Z"}'.encode('utf-8')) is True
+    assert is_outside_window(b'{"@timestamp":"2023-01-01T10:00:00Z"}') is False
+
+
+def test_iter_log_entries_skips_lines_outside_window_before_decoding(tmp_path, mocker):
+    file_path = tmp_path / "test.log"
+    file_path.write_text('{"@timestamp": "2023-01-01T10:00:00Z", "n": 1}\n'
+                         '{"@timestamp": "2023-01-02T10:00:00Z", "n": 2}\n'
+                         '{"@timestamp": "2023-01-03T10:00:00Z", "n": 3}\n')
+    loads = mocker.patch('main.loads_json', wraps=sys.modules['main'].loads_json)
+    counters = {'date_skipped': 0}
+    day = datetime.date(2023, 1, 2)
+    entries = list(iter_log_entries([str(file_path)], DateWindow(day, day), counters=counters))
+    assert entries == [{"@timestamp": "2023-01-02T10:00:00Z", "n": 2}]
+    assert loads.call_count == 1
+    assert counters == {'date_skipped': 2}
+
+
+def test_iter_log_entries_by_date_is_lazy():
+    logs = iter([
+        {"@timestamp": "2023-01-01T10:00:00Z", "data": "entry1"},
+        {"@timestamp": "2023-01-02T11:00:00Z", "data": "entry2"},
+    ])
+    filtered = iter_log_entries_by_date(logs, datetime.date(2023, 1, 2))
+    assert not isinstance(filtered, list)
+    assert list(filtered) == [{"@timestamp": "2023-01-02T11:00:00Z", "data": "entry2"}]
+
+
+def test_count_log_entries():
+    counters = {'parsed': 0}
+    entries = list(count_log_entries(iter([{"a": 1}, {"b": 2}]), counters, 'parsed'))
+    assert entries == [{"a": 1}, {"b": 2}]
+    assert counters['parsed'] == 2
+
+
+
 def test_analyze_url_metrics_empty_logs():
     assert analyze_url_metrics([]) == {}
 
@@ -205,6 +941,200 @@ def test_analyze_url_metrics_missing_fields():
     assert len(result) == 1
 
 
+def test_analyze_url_metrics_accepts_generator():
+    logs = ({"url": "/a", "response_time": t} for t in (10, 20, 30))
+    assert analyze_url_metrics(logs) == {"/a": {"total": 3, "avg_time": 20.0}}
+
+
+def test_merge_url_stats():
+    first = accumulate_url_metrics([{"url": "/a", "response_time": 10}])
+    second = accumulate_url_metrics([{"url": "/a", "response_time": 30}, {"url": "/b", "response_time": 5}])
+    merged = merge_url_stats(first, second)
+    assert finalize_url_metrics(merged) == {
+        "/a": {"total": 2, "avg_time": 20.0},
+        "/b": {"total": 1, "avg_time": 5.0},
+    }
+
+
+def test_merge_url_stats_does_not_alias_source():
+    source = {"/a": UrlStats(1, 10)}
+    target = merge_url_stats({}, source)
+    target["/a"].add(20)
+    assert source["/a"] == UrlStats(1, 10)
+
+
+def test_url_stats_merge_is_associative():
+    a, b, c = UrlStats(1, 10), UrlStats(2, 30), UrlStats(3, 5)
+    left = UrlStats().merge(a).merge(b).merge(c)
+    right = UrlStats().merge(a).merge(UrlStats().merge(b).merge(c))
+    assert left == right == UrlStats(6, 45)
+    assert left.avg == pytest.approx(7.5)
+
+
+def _float_stats(values):
+    stats = UrlStats()
+    for value in values:
+        stats.add(value)
+    return stats
+
+
+def test_url_stats_merge_is_associative_with_floats():
+    rng = random.Random(7)
+    values = [round(rng.expovariate(10), 3) for _ in range(1000)] + [1e16, 0.1, -1e16]
+    a, b, c = _float_stats(values[:300]), _float_stats(values[300:650]), _float_stats(values[650:])
+    left = UrlStats().merge(a).merge(b).merge(c)
+    right = UrlStats().merge(c).merge(UrlStats().merge(b).merge(a))
+    shuffled = values[:]
+    rng.shuffle(shuffled)
+    assert left.total == right.total == _float_stats(shuffled).total == math.fsum(values)
+    assert left == right
+    assert sum(values) != math.fsum(values)
+
+    restored = UrlStats.from_dict(json.loads(json.dumps(a.to_dict())))
+    assert restored.merge(b).merge(c).total == math.fsum(values)
+
+
+def test_url_stats_keeps_exact_sum_without_raw_values():
+    rng = random.Random(3)
+    values = [round(rng.expovariate(10) * 10 ** rng.randint(0, 6), 3) for _ in range(20000)] + [1e16, 0.1, -1e16]
+    stats = _float_stats(values)
+    assert stats.total == math.fsum(values)
+    assert len(stats.sum_tail or ()) <= 3
+    assert UrlStats.from_dict(json.loads(json.dumps(stats.to_dict()))).total == math.fsum(values)
+
+
+def test_url_stats_keeps_integer_and_non_finite_totals():
+    assert _float_stats([1, 2, 3]).total == 6 and type(_float_stats([1, 2, 3]).total) is int
+    assert type(_float_stats([1, 2.0]).total) is float
+    assert math.isnan(_float_stats([1.5, float('nan'), 2.5]).total)
+    assert _float_stats([1.5, float('inf')] * 40).total == float('inf')
+    assert math.isnan(UrlStats().merge(_float_stats([float('inf')])).merge(_float_stats([float('-inf')])).total)
+    assert _float_stats([0.5, -0.5]).total == 0.0 and _float_stats([0.0] * 40).total == 0.0
+    assert UrlStats().merge(_float_stats([0.1, 0.2])).merge(_float_stats([-0.1, -0.2])).total == 0.0
+
+
+def test_url_stats_uses_slots():
+    stats = UrlStats()
+    assert not hasattr(stats, '__dict__')
+    assert UrlStats().avg == 0
+
+
+def test_url_stats_serialization_round_trip(tmp_path):
+    url_stats = accumulate_url_metrics([
+        {"url": "/a", "response_time": 10},
+        {"url": "/б", "response_time": 2.5},
+    ])
+    assert restore_url_stats(dump_url_stats(url_stats)) == url_stats
+
+    path = tmp_path / "stats.json"
+    save_url_stats(url_stats, str(path))
+    assert load_url_stats(str(path)) == url_stats
+
+
+def test_restore_url_stats_rejects_unknown_version():
+    with pytest.raises(ValueError):
+        restore_url_stats({"version": 999, "urls": {}})
+
+
+def _exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+@pytest.mark.parametrize("accuracy", [0.01, 0.05])
+def test_latency_sketch_relative_accuracy(accuracy):
+    rng = random.Random(42)
+    values = [rng.lognormvariate(3, 1.5) for _ in range(20000)]
+    sketch = LatencySketch(accuracy)
+    for value in values:
+        sketch.add(value)
+    for q in (0.5, 0.9, 0.95, 0.99, 0.999):
+        exact = _exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - exact) <= accuracy * exact * 1.001
+
+
+def test_latency_sketch_merge_matches_single_pass():
+    rng = random.Random(1)
+    values = [rng.expovariate(0.01) for _ in range(5000)] + [0, 0, 0]
+    whole, first, second = LatencySketch(), LatencySketch(), LatencySketch()
+    for i, value in enumerate(values):
+        whole.add(value)
+        (first if i % 2 else second).add(value)
+    assert first.merge(second) == whole
+    assert whole.quantile(0.0) == 0.0
+    assert LatencySketch().quantile(0.5) is None
+    with pytest.raises(ValueError):
+        LatencySketch(0.01).merge(LatencySketch(0.02))
+
+
+def test_latency_sketch_memory_is_bounded():
+    sketch = LatencySketch(0.01, max_bins=64)
+    for exponent in range(-20, 40):
+        for step in range(10):
+            sketch.add(2.0 ** exponent * (1 + step / 10))
+    assert len(sketch.bins) <= 64
+    assert sketch.count == 600
+    assert sketch.quantile(1.0) == pytest.approx(2.0 ** 39 * 1.9, rel=0.02)
+
+
+def test_latency_sketch_serialization_round_trip():
+    sketch = LatencySketch(0.02)
+    for value in (0, 1, 2.5, 100, 1000):
+        sketch.add(value)
+    restored = LatencySketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert restored == sketch
+    assert restored.count == sketch.count
+
+
+def test_latency_sketch_skips_non_finite_values():
+    sketch = LatencySketch()
+    for value in (float('nan'), float('inf'), float('-inf'), 0.5):
+        sketch.add(value)
+    assert sketch.count == 1
+    assert sketch.quantile(0.5) == pytest.approx(0.5, rel=0.01)
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_percentiles_with_non_finite_json_values(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text('{"url": "/a", "response_time": NaN}\n{"url": "/a", "response_time": 0.5}\n'
+                        '{"url": "/b", "response_time": Infinity}\n')
+    mock_parse_args.return_value = make_args(files=[str(log_file)], decoder="json", percentiles=True)
+    main()
+    mock_sys_exit.assert_not_called()
+    output = capsys.readouterr().out
+    assert re.search(r"/a\s+2\s+nan\s", output) is not None
+    assert re.search(r"/b\s+1\s+inf\s", output) is not None
+
+
+def test_url_stats_percentiles_and_extremes():
+    stats = MetricsOptions(0.01).new_stats()
+    for value in range(1, 101):
+        stats.add(value)
+    assert (stats.min, stats.max) == (1, 100)
+    assert stats.percentile(0.5) == pytest.approx(50, rel=0.02)
+    assert stats.percentile(1.0) == 100
+    assert UrlStats().percentile(0.5) is None
+
+    restored = UrlStats.from_dict(json.loads(json.dumps(stats.to_dict())))
+    assert restored == stats
+    assert UrlStats.from_dict({'count': 1, 'total': 5}) == UrlStats(1, 5)
+
+
+def test_finalize_url_metrics_with_percentiles():
+    decoder = make_record_decoder('json')
+    records = [{"url": "/a", "response_time": value} for value in range(1, 101)]
+    url_stats = accumulate_url_records(records, decoder, options=MetricsOptions(0.01))
+    metrics = finalize_url_metrics(url_stats, percentiles=True)["/a"]
+    assert metrics['total'] == 100
+    assert metrics['p50'] == pytest.approx(50, rel=0.02)
+    assert metrics['p95'] == pytest.approx(95, rel=0.02)
+    assert metrics['p99'] == pytest.approx(99, rel=0.02)
+    assert metrics['max'] == 100
+    assert set(finalize_url_metrics(url_stats)["/a"]) == {'total', 'avg_time'}
+
+
 def test_analyze_url_metrics_zero_response_time():
     logs = [
         {"url": "/api/test", "response_time": 0},
@@ -268,6 +1198,18 @@ def test_print_url_metrics_table_multiple_entries_and_sorting(capsys):
     assert captured.err == ""
 
 
+def test_print_url_metrics_table_percentile_columns(capsys):
+    metrics_data = {
+        "/api/test": {"total": 3, "avg_time": 20.0, "p50": 19.9, "p95": 30.1, "p99": 30.1, "max": 30},
+        "/api/empty": {"total": 1, "avg_time": 5.0, "p50": None, "p95": None, "p99": None, "max": 5},
+    }
+    print_url_metrics_table(metrics_data)
+    captured = capsys.readouterr()
+    assert re.search(r"handler\s+total\s+avg_response_time\s+p50\s+p95\s+p99\s+max", captured.out) is not None
+    assert re.search(r"^\s*0\s+/api/test\s+3\s+20(\.000)?\s+19\.9(00)?\s+30\.1(00)?\s+30\.1(00)?\s+30(\.000)?$",
+                     captured.out, re.MULTILINE) is not None
+
+
 def test_print_url_metrics_table_url_truncation(capsys):
     metrics_data = {
         "/api/this/is/a/very/long/url/that/should/be/truncated": {"total": 1, "avg_time": 100.0},
@@ -285,7 +1227,7 @@ def test_print_url_metrics_table_url_truncation(capsys):
 @patch('sys.exit')
 @patch('argparse.ArgumentParser.parse_args')
 def test_main_no_files_exits(mock_parse_args, mock_sys_exit, capsys):
-    mock_parse_args.return_value = argparse.Namespace(
+    mock_parse_args.return_value = make_args(
         files=None,
         report="TestReport",
         date=None,
@@ -300,7 +1242,7 @@ def test_main_no_files_exits(mock_parse_args, mock_sys_exit, capsys):
 @patch('sys.exit')
 @patch('argparse.ArgumentParser.parse_args')
 def test_main_invalid_date_exits(mock_parse_args, mock_sys_exit, capsys):
-    mock_parse_args.return_value = argparse.Namespace(
+    mock_parse_args.return_value = make_args(
         files=["dummy.log"],
         report="TestReport",
         date="bad-date-format",
@@ -318,7 +1260,7 @@ def test_main_no_valid_logs_exits(mock_parse_args, mock_sys_exit, mocker, capsys
     log_file = tmp_path / "empty.log"
     log_file.write_text("")
 
-    mock_parse_args.return_value = argparse.Namespace(
+    mock_parse_args.return_value = make_args(
         files=[str(log_file)],
         report="TestReport",
         date=None,
@@ -339,7 +1281,7 @@ def test_main_no_matching_date_exits_gracefully(mock_parse_args, mock_sys_exit,
     log_file = tmp_path / "test.log"
     log_file.write_text('{"url": "/a", "response_time": 100, "@timestamp": "2023-01-01T10:00:00Z"}\n')
 
-    mock_parse_args.return_value = argparse.Namespace(
+    mock_parse_args.return_value = make_args(
         files=[str(log_file)],
         report="TestReport",
         date="2023-01-02",
@@ -362,7 +1304,7 @@ def test_main_successful_run_console_output(mock_parse_args, mock_sys_exit, mock
                         '{"url": "/b", "response_time": 200, "@timestamp": "2023-01-01T10:00:00Z"}\n'
                         '{"url": "/a", "response_time": 150, "@timestamp": "2023-01-01T10:00:00Z"}\n')
 
-    mock_parse_args.return_value = argparse.Namespace(
+    mock_parse_args.return_value = make_args(
         files=[str(log_file)],
         report="MyReport",
         date="2023-01-01",
@@ -385,38 +1327,1633 @@ def test_main_successful_run_console_output(mock_parse_args, mock_sys_exit, mock
 
 @patch('sys.exit')
 @patch('argparse.ArgumentParser.parse_args')
-def test_main_createfile_successful(mock_parse_args, mock_sys_exit, mocker, capsys, tmp_path):
+def test_main_createfile_successful(mock_parse_args, mock_sys_exit, mocker, capsys, tmp_path, monkeypatch):
     log_file_path = tmp_path / "test.log"
     log_file_path.write_text('{"url": "/x", "response_time": 50, "@timestamp": "2023-01-01T10:00:00Z"}\n')
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "OutputReport_2023-01-01.txt").write_text("old report")
 
-    mock_parse_args.return_value = argparse.Namespace(
+    mock_parse_args.return_value = make_args(
         files=[str(log_file_path)],
         report="OutputReport",
         date="2023-01-01",
-        createfile=True
+        createfile=True,
+        decoder="json"
     )
 
     expected_parsed_logs = [{"url": "/x", "response_time": 50, "@timestamp": "2023-01-01T10:00:00Z"}]
-    mocker.patch('main.parse_log_files', return_value=expected_parsed_logs)
-
-    mocker.patch('main.os.path.exists', side_effect=[True, False])
-
-    mock_open_func = mocker.patch('builtins.open', mocker.mock_open())
+    mocker.patch('main.iter_log_entries', return_value=iter(expected_parsed_logs))
 
     main()
     mock_sys_exit.assert_not_called()
 
     captured = capsys.readouterr()
     expected_filename_in_output = f"OutputReport_2023-01-01_1.txt"
-    assert f"Вывод успешно записан в файл: {expected_filename_in_output}" in captured.out
-
-    file_open_arg = mock_open_func.call_args[0][0]
-    assert file_open_arg.endswith(expected_filename_in_output)
+    assert captured.out == f"Вывод успешно записан в файл: {expected_filename_in_output}\n"
+    assert (tmp_path / "OutputReport_2023-01-01.txt").read_text() == "old report"
 
-    mock_open_func().write.assert_called_once()
-    written_content = mock_open_func().write.call_args[0][0]
+    written_content = (tmp_path / expected_filename_in_output).read_text(encoding='utf-8')
     assert "handler" in written_content
     assert "/x" in written_content
     assert "50" in written_content
+    assert not list(tmp_path.glob("*.tmp"))
     assert captured.err == ""
 
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_createfile_discards_partial_report(mock_parse_args, mock_sys_exit, mocker, capsys, tmp_path,
+                                                 monkeypatch):
+    log_file_path = tmp_path / "test.log"
+    log_file_path.write_text('{"url": "/x", "response_time": 50}\n')
+    monkeypatch.chdir(tmp_path)
+    mock_parse_args.return_value = make_args(files=[str(log_file_path)], report="OutputReport", createfile=True)
+    mocker.patch('main.write_fixed_width_table', side_effect=OSError("No space left on device"))
+
+    main()
+    captured = capsys.readouterr()
+    assert "No space left on device" in captured.err
+    assert captured.out == ""
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["test.log"]
+
+
+@pytest.mark.parametrize("error", [KeyboardInterrupt, ValueError("bad metric")])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_createfile_discards_report_on_any_error(mock_parse_args, mock_sys_exit, mocker, tmp_path, monkeypatch,
+                                                      error):
+    log_file_path = tmp_path / "test.log"
+    log_file_path.write_text('{"url": "/x", "response_time": 50}\n')
+    monkeypatch.chdir(tmp_path)
+    mock_parse_args.return_value = make_args(files=[str(log_file_path)], report="OutputReport", createfile=True)
+    mocker.patch('main.write_fixed_width_table', side_effect=error)
+
+    with pytest.raises((KeyboardInterrupt, ValueError)):
+        main()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["test.log"]
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_streams_without_materializing(mock_parse_args, mock_sys_exit, mocker, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text('{"url": "/a", "response_time": 100, "@timestamp": "2023-01-01T10:00:00Z"}\n')
+
+    mock_parse_args.return_value = make_args(
+        files=[str(log_file)],
+        report="MyReport",
+        date=None,
+        createfile=False
+    )
+    mock_parse = mocker.patch('main.parse_log_files')
+    mock_filter = mocker.patch('main.filter_log_entries_by_date')
+
+    main()
+    mock_sys_exit.assert_not_called()
+    mock_parse.assert_not_called()
+    mock_filter.assert_not_called()
+
+    captured = capsys.readouterr()
+    assert re.search(r"^\s*0\s+/a\s+1\s+100(\.000)?$", captured.out, re.MULTILINE) is not None
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_parallel_workers(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text('{"url": "/a", "response_time": 100, "@timestamp": "2023-01-01T10:00:00Z"}\n'
+                        '{"url": "/b", "response_time": 200, "@timestamp": "2023-01-01T10:00:00Z"}\n'
+                        '{"url": "/a", "response_time": 150, "@timestamp": "2023-01-01T10:00:00Z"}\n')
+
+    mock_parse_args.return_value = make_args(
+        files=[str(log_file)],
+        report="MyReport",
+        date="2023-01-01",
+        workers=2
+    )
+
+    main()
+    mock_sys_exit.assert_not_called()
+
+    captured = capsys.readouterr()
+    assert re.search(r"^\s*0\s+/a\s+2\s+125(\.000)?$", captured.out, re.MULTILINE) is not None
+    assert re.search(r"^\s*1\s+/b\s+1\s+200(\.000)?$", captured.out, re.MULTILINE) is not None
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_invalid_workers_exits(mock_parse_args, mock_sys_exit, capsys):
+    mock_parse_args.return_value = make_args(files=["dummy.log"], workers=0)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "Количество процессов должно быть положительным" in capsys.readouterr().err
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_save_and_load_stats(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    first_hour = tmp_path / "first.log"
+    second_hour = tmp_path / "second.log"
+    first_hour.write_text('{"url": "/a", "response_time": 100}\n{"url": "/b", "response_time": 200}\n')
+    second_hour.write_text('{"url": "/a", "response_time": 150}\n')
+    first_stats = tmp_path / "first.json"
+    second_stats = tmp_path / "second.json"
+
+    mock_parse_args.return_value = make_args(files=[str(first_hour)], save_stats=str(first_stats))
+    main()
+    mock_parse_args.return_value = make_args(files=[str(second_hour)], save_stats=str(second_stats))
+    main()
+    capsys.readouterr()
+
+    mock_parse_args.return_value = make_args(load_stats=[str(first_stats), str(second_stats)])
+    main()
+    mock_sys_exit.assert_not_called()
+
+    captured = capsys.readouterr()
+    assert re.search(r"^\s*0\s+/a\s+2\s+125(\.000)?$", captured.out, re.MULTILINE) is not None
+    assert re.search(r"^\s*1\s+/b\s+1\s+200(\.000)?$", captured.out, re.MULTILINE) is not None
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_load_stats_invalid_file_exits(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    bad_stats = tmp_path / "bad.json"
+    bad_stats.write_text("not json")
+    mock_parse_args.return_value = make_args(load_stats=[str(bad_stats)])
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "Ошибка при чтении агрегатов из файла" in capsys.readouterr().err
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_date_range(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text('{"url": "/a", "response_time": 100, "@timestamp": "2023-01-01T10:00:00Z"}\n'
+                        '{"url": "/a", "response_time": 200, "@timestamp": "2023-01-02T10:00:00Z"}\n'
+                        '{"url": "/b", "response_time": 300, "@timestamp": "2023-01-03T10:00:00Z"}\n')
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date_from="2023-01-02", date_to="2023-01-03")
+    main()
+    mock_sys_exit.assert_not_called()
+
+    captured = capsys.readouterr()
+    assert re.search(r"^\s*\d\s+/a\s+1\s+200(\.000)?$", captured.out, re.MULTILINE) is not None
+    assert re.search(r"^\s*\d\s+/b\s+1\s+300(\.000)?$", captured.out, re.MULTILINE) is not None
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_date_range_no_match(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text('{"url": "/a", "response_time": 100, "@timestamp": "2023-01-01T10:00:00Z"}\n')
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date_from="2023-02-01")
+    main()
+    mock_sys_exit.assert_called_once_with(0)
+    assert "Нет записей лога, соответствующих диапазону дат с 2023-02-01." in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"date": "2023-01-01", "date_from": "2023-01-01"}, "--date нельзя использовать вместе"),
+    ({"date_from": "2023-01-05", "date_to": "2023-01-01"}, "позже конца"),
+    ({"date_to": "01.01.2023"}, "Неверный формат даты '01.01.2023'"),
+])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_invalid_date_range_exits(mock_parse_args, mock_sys_exit, capsys, overrides, message):
+    mock_parse_args.return_value = make_args(files=["dummy.log"], **overrides)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert message in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("decoder", AVAILABLE_DECODERS)
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_decoders_produce_same_report(mock_parse_args, mock_sys_exit, capsys, tmp_path, decoder):
+    log_file = tmp_path / "test.log"
+    log_file.write_text('{"url": "/a", "response_time": 100, "@timestamp": "2023-01-01T10:00:00Z", "ua": "x"}\n'
+                        '{"url": "/a", "response_time": 150, "@timestamp": "2023-01-01T10:00:00Z"}\n')
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], decoder=decoder)
+    main()
+    mock_sys_exit.assert_not_called()
+    assert re.search(r"^\s*0\s+/a\s+2\s+125(\.000)?$", capsys.readouterr().out, re.MULTILINE) is not None
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_unavailable_decoder_exits(mock_parse_args, mock_sys_exit, mocker, capsys):
+    mocker.patch('main.msgspec', None)
+    mock_parse_args.return_value = make_args(files=["dummy.log"], decoder="msgspec")
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "Декодер 'msgspec' недоступен" in capsys.readouterr().err
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_mixed_plain_and_compressed_files(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    plain = tmp_path / "current.log"
+    plain.write_text('{"url": "/a", "response_time": 100}\n')
+    packed = tmp_path / "rotated.log.gz"
+    packed.write_bytes(gzip.compress(b'{"url": "/a", "response_time": 150}\n{"url": "/b", "response_time": 200}\n'))
+
+    for workers in (1, 2):
+        mock_parse_args.return_value = make_args(files=[str(plain), str(packed)], workers=workers)
+        main()
+        captured = capsys.readouterr()
+        assert re.search(r"^\s*0\s+/a\s+2\s+125(\.000)?$", captured.out, re.MULTILINE) is not None
+        assert re.search(r"^\s*1\s+/b\s+1\s+200(\.000)?$", captured.out, re.MULTILINE) is not None
+    mock_sys_exit.assert_not_called()
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_incremental(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "access.log"
+    state_file = tmp_path / "state.json"
+    log_file.write_text('{"url": "/a", "response_time": 100}\n')
+    mock_parse_args.return_value = make_args(files=[str(log_file)], incremental=True, state_file=str(state_file))
+
+    main()
+    assert re.search(r"^\s*0\s+/a\s+1\s+100(\.000)?$", capsys.readouterr().out, re.MULTILINE) is not None
+
+    main()
+    assert re.search(r"^\s*0\s+/a\s+1\s+100(\.000)?$", capsys.readouterr().out, re.MULTILINE) is not None
+
+    with open(log_file, 'a') as f:
+        f.write('{"url": "/a", "response_time": 200}\n')
+    main()
+    assert re.search(r"^\s*0\s+/a\s+2\s+150(\.000)?$", capsys.readouterr().out, re.MULTILINE) is not None
+    mock_sys_exit.assert_not_called()
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_incremental_corrupt_state_exits(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    state_file = tmp_path / "state.json"
+    state_file.write_text("{")
+    mock_parse_args.return_value = make_args(files=["dummy.log"], incremental=True, state_file=str(state_file))
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "Ошибка при чтении файла состояния" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"createfile": True}, "--follow нельзя использовать вместе с --createfile"),
+    ({"interval": 0}, "Интервал обновления должен быть положительным"),
+])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_follow_invalid_options_exit(mock_parse_args, mock_sys_exit, capsys, overrides, message):
+    mock_parse_args.return_value = make_args(files=["dummy.log"], follow=True, **overrides)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert message in capsys.readouterr().err
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_follow_stops_on_keyboard_interrupt(mock_parse_args, mock_sys_exit, mocker, tmp_path):
+    mock_parse_args.return_value = make_args(files=[str(tmp_path / "access.log")], follow=True, interval=5)
+    mock_follow = mocker.patch('main.follow_log_files', side_effect=KeyboardInterrupt)
+    main()
+    mock_sys_exit.assert_not_called()
+    assert mock_follow.call_args[0][3] == 5
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_percentiles_serial_and_parallel(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text("".join(f'{{"url": "/a", "response_time": {value}}}\n' for value in range(1, 101)))
+
+    outputs = []
+    for workers in (1, 2):
+        mock_parse_args.return_value = make_args(files=[str(log_file)], percentiles=True, workers=workers)
+        main()
+        outputs.append(capsys.readouterr().out)
+    mock_sys_exit.assert_not_called()
+
+    assert outputs[0] == outputs[1]
+    assert re.search(r"^\s*0\s+/a\s+100\s+50\.5(00)?\s+[\d.]+\s+[\d.]+\s+[\d.]+\s+100(\.000)?$",
+                     outputs[0], re.MULTILINE) is not None
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_invalid_percentile_accuracy_exits(mock_parse_args, mock_sys_exit, capsys):
+    mock_parse_args.return_value = make_args(files=["dummy.log"], percentiles=True, percentile_accuracy=1.5)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "Точность перцентилей должна быть в интервале" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("text, expected", [("30s", 30), ("1m", 60), ("15m", 900), ("1h", 3600), ("1d", 86400),
+                                            ("45", 45)])
+def test_parse_bucket_duration(text, expected):
+    assert parse_bucket_duration(text) == expected
+
+
+@pytest.mark.parametrize("text", ["", "0m", "1w", "m", "-1h", "1.5h"])
+def test_parse_bucket_duration_invalid(text):
+    with pytest.raises(ValueError):
+        parse_bucket_duration(text)
+
+
+def _bucket_rows(table):
+    return sorted((bucket * table.bucket_seconds, url, count, avg) for bucket, url, count, avg in table.rows())
+
+
+BUCKET_RECORDS = [
+    {"@timestamp": "2025-06-22T10:00:05+00:00", "url": "/a", "response_time": 1},
+    {"@timestamp": "2025-06-22T10:00:59Z", "url": "/a", "response_time": 3},
+    {"@timestamp": "2025-06-22T13:01:00+03:00", "url": "/a", "response_time": 5},
+    {"@timestamp": "2025-06-22T10:01:30", "url": "/b", "response_time": 2},
+    {"@timestamp": "2025-06-22T10:00:05+00:00", "url": "/b", "response_time": 4},
+    {"@timestamp": "not a date", "url": "/a", "response_time": 100},
+    {"url": "/a", "response_time": 100},
+    {"@timestamp": "2025-06-22T10:00:05+00:00", "url": "/a"},
+]
+
+
+def test_accumulate_bucketed_records_per_minute():
+    decoder = make_record_decoder('json')
+    table = accumulate_bucketed_records(BUCKET_RECORDS, decoder, 60)
+    minute = int(datetime.datetime(2025, 6, 22, 10, 0, tzinfo=datetime.timezone.utc).timestamp())
+    assert _bucket_rows(table) == [
+        (minute, "/a", 2, 2.0),
+        (minute, "/b", 1, 4.0),
+        (minute + 60, "/a", 1, 5.0),
+        (minute + 60, "/b", 1, 2.0),
+    ]
+    assert table.urls == ["/a", "/b"]
+    assert len(table.counts) == len(table.sums) == len(table.errors) == len(table) == 4
+    assert (table.counts.typecode, table.sums.typecode, table.errors.typecode, table.tails) == ('q', 'd', 'd', {})
+
+
+def test_bucketed_stats_merge_matches_single_pass():
+    decoder = make_record_decoder('json')
+    whole = accumulate_bucketed_records(BUCKET_RECORDS, decoder, 3600)
+    first = accumulate_bucketed_records(BUCKET_RECORDS[3:], decoder, 3600)
+    second = accumulate_bucketed_records(BUCKET_RECORDS[:3], decoder, 3600)
+    assert _bucket_rows(first.merge(second)) == _bucket_rows(whole)
+    assert first.urls == ["/b", "/a"]
+    with pytest.raises(ValueError):
+        BucketedStats(60).merge(BucketedStats(3600))
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_bucket_serial_and_parallel(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text("".join(json.dumps(record) + "\n" for record in BUCKET_RECORDS[:5] * 50))
+
+    outputs = []
+    for workers in (1, 2):
+        mock_parse_args.return_value = make_args(files=[str(log_file)], bucket="1m", workers=workers)
+        main()
+        outputs.append(capsys.readouterr().out)
+    mock_sys_exit.assert_not_called()
+
+    assert outputs[0] == outputs[1]
+    rows = [line.split()[:5] + [float(line.split()[5])] for line in outputs[0].splitlines()[2:]]
+    assert rows == [
+        ["0", "2025-06-22", "10:00", "/a", "100", 2.0],
+        ["1", "2025-06-22", "10:00", "/b", "50", 4.0],
+        ["2", "2025-06-22", "10:01", "/a", "50", 5.0],
+        ["3", "2025-06-22", "10:01", "/b", "50", 2.0],
+    ]
+    assert re.search(r"bucket\s+handler\s+total\s+avg_response_time", outputs[0]) is not None
+
+
+def test_bucketed_stats_sums_are_exact_in_any_merge_order():
+    decoder = make_record_decoder('json')
+    rng = random.Random(5)
+    records = [{"@timestamp": f"2025-06-22T10:0{i % 2}:00+00:00", "url": f"/u{i % 3}",
+                "response_time": rng.choice([1e16, -1e16, 0.1, round(rng.random(), 3)])} for i in range(300)]
+    parts = [accumulate_bucketed_records(records[start:start + 50], decoder, 60) for start in range(0, 300, 50)]
+    forward = accumulate_bucketed_records([], decoder, 60)
+    for part in parts:
+        forward.merge(part)
+    backward = accumulate_bucketed_records([], decoder, 60)
+    for part in reversed(parts):
+        backward.merge(part)
+    expected = {}
+    for record in records:
+        expected.setdefault((record["@timestamp"][14:16], record["url"]), []).append(record["response_time"])
+    assert _bucket_rows(forward) == _bucket_rows(backward) == \
+        _bucket_rows(accumulate_bucketed_records(records, decoder, 60))
+    assert sorted((url, count, avg) for _, url, count, avg in _bucket_rows(forward)) == \
+        sorted((url, len(values), math.fsum(values) / len(values)) for (_, url), values in expected.items())
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_bucket_workers_match_serial_with_floats(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    _write_sharded_log(log_file, _float_log_lines()[0])
+    outputs = []
+    for workers in (1, 3, 4):
+        mock_parse_args.return_value = make_args(files=[str(log_file)], bucket="1h", format="jsonl", workers=workers)
+        main()
+        outputs.append(capsys.readouterr().out)
+    mock_sys_exit.assert_not_called()
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"bucket": "5x"}, "неверный формат интервала"),
+    ({"bucket": "1m", "percentiles": True}, "--bucket нельзя использовать вместе с --percentiles"),
+    ({"bucket": "1m", "incremental": True}, "--bucket нельзя использовать вместе с --incremental"),
+    ({"bucket": "1m", "top_by": "avg"}, "--bucket нельзя использовать вместе с --top-by"),
+])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_bucket_invalid_options_exit(mock_parse_args, mock_sys_exit, capsys, overrides, message):
+    mock_parse_args.return_value = make_args(files=["dummy.log"], **overrides)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert message in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("normalizer, url, expected", [
+    (UrlNormalizer(strip_query=True), "/api/users?page=2#top", "/api/users"),
+    (UrlNormalizer(collapse_ids=True), "/api/users/123/orders/45", "/api/users/{id}/orders/{id}"),
+    (UrlNormalizer(collapse_ids=True), "/api/items/3f2b8c1e-9d4a-4e6b-8a7c-0123456789ab", "/api/items/{id}"),
+    (UrlNormalizer(collapse_ids=True), "/api/v2/users/abc123", "/api/v2/users/abc123"),
+    (UrlNormalizer(collapse_ids=True), "/api/users/123?page=2", "/api/users/{id}?page=2"),
+    (UrlNormalizer(True, True), "/api/users/123?page=2", "/api/users/{id}"),
+    (UrlNormalizer(True, True, [(r"^/shop/[^/]+/cart", "/shop/{shop}/cart")]), "/shop/acme/cart/7",
+     "/shop/{shop}/cart/7"),
+    (UrlNormalizer(templates=[(r"^/files/(\w+)/.*", r"/files/\1/*")]), "/files/pub/a/b.txt", "/files/pub/*"),
+])
+def test_url_normalizer_rules(normalizer, url, expected):
+    assert normalizer.normalize(url) == expected
+
+
+def test_url_normalizer_caches_and_pickles():
+    normalizer = UrlNormalizer(True, True, [("^/x", "/y")])
+    for _ in range(3):
+        assert normalizer.normalize("/api/users/1") == "/api/users/{id}"
+    assert normalizer.normalize.cache_info()[:2] == (2, 1)
+    assert normalizer.normalize(7) == 7
+
+    restored = pickle.loads(pickle.dumps(normalizer))
+    assert restored.key() == normalizer.key()
+    assert restored.normalize("/x/1") == "/y/1"
+
+    with pytest.raises(ValueError):
+        UrlNormalizer(templates=[("(", "x")])
+    with pytest.raises(ValueError):
+        UrlNormalizer(templates=[("/a", r"\1")])
+
+
+def test_accumulate_url_records_with_normalizer():
+    decoder = make_record_decoder('json')
+    records = [{"url": f"/api/users/{user_id}?v=1", "response_time": user_id} for user_id in range(1, 5)]
+    options = MetricsOptions(url_normalizer=UrlNormalizer(True, True))
+    url_stats = accumulate_url_records(records, decoder, options=options)
+    assert url_stats == {"/api/users/{id}": UrlStats(4, 10, 1, 4)}
+
+    restored = normalize_url_stats({"/a/1": UrlStats(1, 2, 2, 2), "/a/2": UrlStats(1, 4, 4, 4)},
+                                   options.normalize_url)
+    assert restored == {"/a/{id}": UrlStats(2, 6, 2, 4)}
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_normalized_urls_and_state_reset(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text("".join(f'{{"url": "/api/users/{n}?q={n}", "response_time": 1}}\n' for n in range(10)))
+    state_file = tmp_path / "state.json"
+
+    for workers in (1, 2):
+        mock_parse_args.return_value = make_args(files=[str(log_file)], workers=workers, strip_query=True,
+                                                 collapse_ids=True)
+        main()
+        out = capsys.readouterr().out
+        assert re.search(r"^\s*0\s+/api/users/\{id\}\s+10\s+1(\.000)?$", out, re.MULTILINE) is not None
+        assert len(out.strip().splitlines()) == 3
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], incremental=True, state_file=str(state_file))
+    main()
+    capsys.readouterr()
+    mock_parse_args.return_value = make_args(files=[str(log_file)], incremental=True, state_file=str(state_file),
+                                             collapse_ids=True)
+    main()
+    captured = capsys.readouterr()
+    assert "изменились с момента прошлого запуска" in captured.err
+    assert re.search(r"/api/users/\{id\}\?q=3\s+1\s", captured.out) is not None
+    mock_sys_exit.assert_not_called()
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_invalid_url_template_exits(mock_parse_args, mock_sys_exit, capsys):
+    mock_parse_args.return_value = make_args(files=["dummy.log"], url_template=[["(", "x"]])
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "неверное правило шаблона URL" in capsys.readouterr().err
+
+
+def test_select_top_url_stats_by_metric():
+    url_stats = {
+        "/a": UrlStats(5, 10, 1, 3),
+        "/b": UrlStats(3, 30, 5, 20),
+        "/c": UrlStats(4, 8, 2, 2),
+        "/d": UrlStats(1, 50, 50, 50),
+    }
+    assert list(select_top_url_stats(url_stats, 2)) == ["/a", "/c"]
+    assert list(select_top_url_stats(url_stats, 2, 'avg')) == ["/d", "/b"]
+    assert list(select_top_url_stats(url_stats, 3, 'max')) == ["/d", "/b", "/a"]
+    assert list(select_top_url_stats(url_stats, 10, 'p99')) == ["/a", "/b", "/c", "/d"]
+
+
+def _heavy_hitter_stream():
+    rng = random.Random(7)
+    urls = [f"/hot/{n}" for n in range(5) for _ in range(200 * (5 - n))]
+    urls += [f"/cold/{n}" for n in range(2000)]
+    rng.shuffle(urls)
+    return [{"url": url, "response_time": 1} for url in urls]
+
+
+def test_space_saving_finds_heavy_hitters_with_bounded_memory():
+    records = _heavy_hitter_stream()
+    summary = accumulate_heavy_hitters(records, make_record_decoder('json'),
+                                       options=MetricsOptions(heavy_hitters=20))
+    assert len(summary) == len(summary.heap) == 20
+
+    true_counts = collections.Counter(record["url"] for record in records)
+    top = summary.top(5)
+    assert [url for url, _, _ in top] == [f"/hot/{n}" for n in range(5)]
+    for url, stats, estimate in top:
+        assert stats.count <= true_counts[url] <= estimate
+        assert estimate - true_counts[url] <= summary.errors[url]
+
+
+def test_space_saving_merge_keeps_heavy_hitters():
+    records = _heavy_hitter_stream()
+    decoder = make_record_decoder('json')
+    options = MetricsOptions(heavy_hitters=20)
+    merged = accumulate_heavy_hitters(records[::2], decoder, options=options)
+    merged.merge(accumulate_heavy_hitters(records[1::2], decoder, options=options))
+    assert len(merged) == len(merged.heap) == 20
+
+    true_counts = collections.Counter(record["url"] for record in records)
+    top = merged.top(5)
+    assert [url for url, _, _ in top] == [f"/hot/{n}" for n in range(5)]
+    for url, _, estimate in top:
+        assert true_counts[url] <= estimate
+
+    exact = SpaceSaving(10)
+    for url in ("/a", "/a", "/b"):
+        (exact.entries.get(url) or exact.admit(url)).add(1)
+    assert exact.floor() == 0
+    assert [(url, estimate) for url, _, estimate in exact.top(1)] == [("/a", 2)]
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_top_exact_and_approximate(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "test.log"
+    log_file.write_text("".join(json.dumps(record) + "\n" for record in _heavy_hitter_stream()))
+
+    outputs = []
+    for overrides in ({}, {"approx_top": True}, {"approx_top": True, "workers": 2}):
+        mock_parse_args.return_value = make_args(files=[str(log_file)], top=3, **overrides)
+        main()
+        captured = capsys.readouterr()
+        outputs.append([line.split()[1:3] for line in captured.out.splitlines()[2:]])
+    mock_sys_exit.assert_not_called()
+
+    assert outputs == [[["/hot/0", "1000"], ["/hot/1", "800"], ["/hot/2", "600"]]] * 3
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], top=2, top_by='avg')
+    main()
+    assert len(capsys.readouterr().out.splitlines()) == 4
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"top": 0}, "Значение --top должно быть положительным"),
+    ({"top": 5, "top_by": "p95"}, "Сортировка по p95 требует --percentiles"),
+    ({"top": 5, "top_by": "max"}, "Сортировка по max требует --percentiles"),
+    ({"approx_top": True}, "--approx-top работает только вместе с --top"),
+    ({"top": 5, "approx_top": True, "incremental": True}, "--approx-top нельзя использовать вместе с --incremental"),
+])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_top_invalid_options_exit(mock_parse_args, mock_sys_exit, capsys, overrides, message):
+    mock_parse_args.return_value = make_args(files=["dummy.log"], **overrides)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert message in capsys.readouterr().err
+
+
+INDEXED_DAYS = ("2025-06-21", "2025-06-22", "2025-06-23")
+
+
+def _indexed_log_lines(days=INDEXED_DAYS, per_day=4):
+    lines = []
+    for day in days:
+        for n in range(per_day):
+            lines.append(json.dumps({"@timestamp": f"{day}T{10 + n:02d}:00:00+00:00",
+                                     "url": f"/{day[-2:]}/{n % 2}", "response_time": n + 1}))
+    return lines
+
+
+def test_log_index_build_extend_and_rebuild(tmp_path, capsys):
+    log_file = tmp_path / "app.log"
+    lines = _indexed_log_lines()
+    _write_sharded_log(log_file, lines[:4] + ['{"url": "/undated", "response_time": 1}', 'not json'] + lines[4:])
+    data = log_file.read_bytes()
+
+    index = update_log_index(str(log_file))
+    assert index['end'] == len(data)
+    assert index['undated'] == 1
+    assert sorted(index['days']) == list(INDEXED_DAYS)
+    day = index['days']["2025-06-22"]
+    assert data[day['start']:day['end']].decode().splitlines() == lines[4:8]
+    assert day['lines'] == 4
+    assert day['urls'] == {"/22/0": UrlStats(2, 4, 1, 3), "/22/1": UrlStats(2, 6, 2, 4)}
+    assert "Не удалось распарсить строку" in capsys.readouterr().err
+
+    save_log_index(str(log_file), index)
+    assert load_log_index(str(log_file)) == index
+
+    with open(log_file, 'a') as f:
+        f.write("\n".join(_indexed_log_lines(("2025-06-23", "2025-06-24"), per_day=1)) + "\n" + '{"partial')
+    extended = update_log_index(str(log_file), load_log_index(str(log_file)))
+    assert extended['end'] == log_file.stat().st_size - len('{"partial')
+    assert extended['days']["2025-06-23"]['lines'] == 5
+    assert extended['days']["2025-06-24"]['lines'] == 1
+    assert extended['days']["2025-06-21"] == index['days']["2025-06-21"]
+
+    _write_sharded_log(log_file, _indexed_log_lines(("2025-07-01",)) * 3)
+    rebuilt = update_log_index(str(log_file), extended)
+    assert list(rebuilt['days']) == ["2025-07-01"]
+    assert rebuilt['days']["2025-07-01"]['lines'] == 12
+    assert "индекс строится заново" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("extra", [{}, {"percentiles": True}, {"workers": 2}, {"top": 1}])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_date_report_with_index_matches_full_scan(mock_parse_args, mock_sys_exit, capsys, tmp_path, extra):
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, _indexed_log_lines())
+    other_file = tmp_path / "other.log"
+    _write_sharded_log(other_file, _indexed_log_lines(("2025-06-22",), per_day=2))
+    args = make_args(files=[str(log_file), str(other_file)], date_from="2025-06-22", date_to="2025-06-23", **extra)
+
+    mock_parse_args.return_value = args
+    main()
+    expected = capsys.readouterr().out
+
+    save_log_index(str(log_file), update_log_index(str(log_file)))
+
+    mock_parse_args.return_value = args
+    main()
+    captured = capsys.readouterr()
+    mock_sys_exit.assert_not_called()
+    assert captured.out == expected
+    assert captured.err == ""
+
+
+@pytest.mark.parametrize("extra", [{}, {"format": "jsonl"}, {"top": 3}, {"top": 2, "top_by": "avg"}])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_index_summaries_match_full_scan_of_unordered_log(mock_parse_args, mock_sys_exit, capsys, tmp_path,
+                                                                extra):
+    rng = random.Random(7)
+    # Все URL встречаются одинаково часто, так что порядок строк в выводе решают только равные total.
+    lines = [json.dumps({"@timestamp": f"{day}T10:00:00+00:00", "url": f"/u{i % 6}",
+                         "response_time": rng.choice([0.1, 0.2, 0.3, 1e16, -1e16])})
+             for day in INDEXED_DAYS for i in range(60)]
+    rng.shuffle(lines)
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, lines)
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date_from="2025-06-22", date_to="2025-06-23",
+                                             **extra)
+    main()
+    expected = capsys.readouterr().out
+
+    save_log_index(str(log_file), update_log_index(str(log_file)))
+    main()
+    mock_sys_exit.assert_not_called()
+    assert capsys.readouterr().out == expected
+
+
+@pytest.mark.parametrize("indexed", [0, 1])
+@pytest.mark.parametrize("extra", [{}, {"workers": 2}])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_index_summaries_keep_file_order(mock_parse_args, mock_sys_exit, capsys, tmp_path, indexed, extra):
+    log_files = []
+    for name, urls in (("a.log", ("/b", "/a")), ("b.log", ("/d", "/c", "/a"))):
+        log_file = tmp_path / name
+        _write_sharded_log(log_file, [json.dumps({"@timestamp": f"{day}T10:00:00+00:00", "url": url,
+                                                  "response_time": 1})
+                                      for day in INDEXED_DAYS for url in urls])
+        log_files.append(str(log_file))
+    mock_parse_args.return_value = make_args(files=log_files, date_from="2025-06-22", date_to="2025-06-23",
+                                             format="jsonl", **extra)
+    main()
+    expected = capsys.readouterr().out
+
+    save_log_index(log_files[indexed], update_log_index(log_files[indexed]))
+    main()
+    mock_sys_exit.assert_not_called()
+    assert capsys.readouterr().out == expected
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_date_report_skips_index_of_other_timestamp_field(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, [json.dumps({"@timestamp": f"{day}T10:00:00+00:00", "time": "2025-06-22T10:00:00Z",
+                                              "url": f"/{day}", "response_time": 1}) for day in INDEXED_DAYS])
+    save_log_index(str(log_file), update_log_index(str(log_file)))
+    index_bytes = (tmp_path / "app.log.idx").read_bytes()
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date="2025-06-22", timestamp_field="time",
+                                             format="jsonl")
+    main()
+    captured = capsys.readouterr()
+    mock_sys_exit.assert_not_called()
+    assert [json.loads(line)["url"] for line in captured.out.splitlines()] == [f"/{day}" for day in INDEXED_DAYS]
+    assert "не используется" in captured.err
+    assert (tmp_path / "app.log.idx").read_bytes() == index_bytes
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_date_report_reads_only_indexed_days(mock_parse_args, mock_sys_exit, mocker, capsys, tmp_path):
+    log_file = tmp_path / "app.log"
+    lines = _indexed_log_lines()
+    _write_sharded_log(log_file, lines)
+    save_log_index(str(log_file), update_log_index(str(log_file)))
+    day = load_log_index(str(log_file))['days']["2025-06-22"]
+    spy = mocker.spy(log_sorter, 'iter_file_lines')
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date="2025-06-22")
+    main()
+    spy.assert_not_called()
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date="2025-06-22", percentiles=True)
+    main()
+    spy.assert_called_once_with(str(log_file), day['start'], day['end'])
+
+    spy.reset_mock()
+    with open(log_file, 'a') as f:
+        f.write("\n".join(_indexed_log_lines(("2025-06-22",), per_day=2)) + "\n")
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date="2025-06-22")
+    main()
+    spy.assert_not_called()
+    assert load_log_index(str(log_file))['days']["2025-06-22"]['lines'] == 6
+    captured = capsys.readouterr()
+    assert re.search(r"^\s*0\s+/22/0\s+3\s+1\.667$", captured.out, re.MULTILINE) is not None
+    mock_sys_exit.assert_not_called()
+
+
+@patch('sys.exit')
+def test_index_command(mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, _indexed_log_lines())
+    main(["index", "--files", str(log_file), str(tmp_path / "missing.log")])
+    captured = capsys.readouterr()
+    assert f"Индекс {log_index_path(str(log_file))}: дней 3" in captured.out
+    assert "не найден" in captured.err
+    assert load_log_index(str(log_file)) == update_log_index(str(log_file))
+
+    (tmp_path / "app.log.idx").write_text("{broken")
+    main(["index", "--files", str(log_file)])
+    assert "повреждён" in capsys.readouterr().err
+    assert load_log_index(str(log_file))['end'] == log_file.stat().st_size
+    mock_sys_exit.assert_not_called()
+
+
+@patch('sys.exit')
+def test_index_command_rejects_compressed_files(mock_sys_exit, capsys, tmp_path):
+    file_path = tmp_path / "app.log.gz"
+    _write_gzip_members(file_path, COMPRESSED_LINES)
+    main(["index", "--files", str(file_path)])
+    mock_sys_exit.assert_called_once_with(1)
+    assert "сжатые файлы не индексируются" in capsys.readouterr().err
+    assert not os.path.exists(log_index_path(str(file_path)))
+
+
+def test_columnar_conversion_round_trip(tmp_path, capsys):
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, [
+        '{"@timestamp": "2025-06-22T10:00:30+03:00", "url": "/a", "response_time": 5}',
+        '{"@timestamp": "2025-06-22T10:00:30+03:00", "url": "/b", "response_time": 1.5}',
+        '{"url": "/a", "response_time": 2}',
+        '{"@timestamp": "2025-06-23", "url": "/a"}',
+        'not json',
+    ])
+    columns = convert_to_columnar([str(log_file)])
+    assert "Не удалось распарсить строку" in capsys.readouterr().err
+    assert columns.urls == ["/a", "/b"]
+    day = datetime.date(2025, 6, 22).toordinal()
+    epoch = int(datetime.datetime(2025, 6, 22, 7, 0, 30, tzinfo=datetime.timezone.utc).timestamp())
+    assert list(columns.days) == [day, day, 0, day + 1]
+    assert list(columns.timestamps)[:2] == [epoch, epoch]
+    assert list(columns.url_ids) == [0, 1, 0, 0]
+    assert list(columns.response_times)[:3] == [5.0, 1.5, 2.0]
+    assert math.isnan(columns.response_times[3])
+    assert not columns.integral
+
+    output = tmp_path / "app.lsc"
+    save_columnar_log(str(output), columns)
+    assert is_columnar_log(str(output)) and not is_columnar_log(str(log_file))
+    restored = load_columnar_log(str(output))
+    assert restored.urls == columns.urls
+    assert restored.sources == columns.sources
+    for name in ("days", "timestamps", "url_ids"):
+        assert getattr(restored, name) == getattr(columns, name)
+    assert restored.response_times[:3] == columns.response_times[:3]
+    assert not restored.integral
+
+    output.write_bytes(output.read_bytes()[:-8])
+    with pytest.raises(ValueError):
+        load_columnar_log(str(output))
+
+
+@pytest.mark.parametrize("backend", ["python", "numpy"])
+def test_columnar_log_keeps_integer_response_times(tmp_path, backend):
+    if backend == "numpy":
+        pytest.importorskip("numpy")
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, _indexed_log_lines() + ['{"url": "/21/0"}'])
+    output = tmp_path / "app.lsc"
+    save_columnar_log(str(output), convert_to_columnar([str(log_file)]))
+    restored = load_columnar_log(str(output))
+    assert restored.integral
+
+    url_stats = accumulate_columnar_log(restored, {}, options=MetricsOptions(backend=backend))
+    stats = url_stats["/21/1"]
+    assert (stats.count, stats.total, stats.min, stats.max) == (2, 6, 2, 4)
+    assert all(type(value) is int for value in (stats.total, stats.min, stats.max))
+
+
+@pytest.mark.parametrize("extra", [
+    {},
+    {"date": "2025-06-22"},
+    {"date_from": "2025-06-22", "percentiles": True},
+    {"bucket": "1h"},
+    {"top": 2, "approx_top": True},
+    {"strip_query": True, "collapse_ids": True, "workers": 2},
+    {"percentiles": True, "format": "jsonl"},
+    {"percentiles": True, "format": "csv", "date": "2025-06-22"},
+])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_columnar_file_matches_text_report(mock_parse_args, mock_sys_exit, capsys, tmp_path, extra):
+    log_file = tmp_path / "app.log"
+    lines = _indexed_log_lines(per_day=6)
+    lines.append('{"@timestamp": "2025-06-22T12:00:00Z", "url": "/22/1?x=1", "response_time": 7}')
+    _write_sharded_log(log_file, lines)
+    converted = tmp_path / "app.lsc"
+    save_columnar_log(str(converted), convert_to_columnar([str(log_file)]))
+
+    outputs = []
+    for path in (log_file, converted):
+        mock_parse_args.return_value = make_args(files=[str(path)], **extra)
+        main()
+        captured = capsys.readouterr()
+        assert captured.err == ""
+        outputs.append(captured.out)
+    mock_sys_exit.assert_not_called()
+    assert outputs[0] == outputs[1]
+
+
+@patch('sys.exit')
+def test_convert_command_and_stale_sources(mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, _indexed_log_lines())
+    output = tmp_path / "app.lsc"
+    main(["convert", "--files", str(log_file), "--output", str(output)])
+    assert f"Записано строк: 12, уникальных URL: 6 в файл {output}." in capsys.readouterr().out
+
+    with open(log_file, 'a') as f:
+        f.write('{"url": "/late", "response_time": 1}\n')
+    with patch('argparse.ArgumentParser.parse_args', return_value=make_args(files=[str(output)])):
+        main()
+    captured = capsys.readouterr()
+    assert "изменился после конвертации" in captured.err
+    assert "/late" not in captured.out
+    mock_sys_exit.assert_not_called()
+
+    main(["convert", "--files", str(tmp_path / "missing.log"), "--output", str(tmp_path / "none.lsc")])
+    mock_sys_exit.assert_called_once_with(1)
+    assert not (tmp_path / "none.lsc").exists()
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_columnar_file_errors(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    converted = tmp_path / "app.lsc"
+    save_columnar_log(str(converted), convert_to_columnar([]))
+    mock_parse_args.return_value = make_args(files=[str(converted)], incremental=True)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "Колоночные файлы нельзя использовать вместе с --incremental" in capsys.readouterr().err
+
+    mock_sys_exit.reset_mock()
+    converted.write_bytes(converted.read_bytes()[:12])
+    mock_parse_args.return_value = make_args(files=[str(converted)])
+    main()
+    assert f"Ошибка при чтении файла '{converted}'" in capsys.readouterr().err
+    mock_sys_exit.assert_called_once_with(1)
+
+
+def _mixed_records(count=500, seed=3):
+    rng = random.Random(seed)
+    values = [1, 2.5, 0, 7, 0.1, True, None, "12", {"v": 1}, 1e-3, 40]
+    urls = ["/a", "/b?x=1", "/c/12", "/c/13", "", None, "/d"]
+    return [{"url": rng.choice(urls), "response_time": rng.choice(values)} for _ in range(count)]
+
+
+def _stats_snapshot(url_stats):
+    return [(url, stats.count, stats.total, type(stats.total), stats.min, stats.max) for url, stats in url_stats.items()]
+
+
+@pytest.mark.parametrize("normalizer", [None, UrlNormalizer(True, True)])
+@pytest.mark.parametrize("chunk_size", [7, 65536])
+def test_numpy_backend_matches_python_loop(normalizer, chunk_size):
+    pytest.importorskip("numpy")
+    decoder = make_record_decoder('json')
+    records = _mixed_records()
+    float_records = [{"url": f"/f/{n % 13}", "response_time": random.Random(n).random() * 100} for n in range(3000)]
+    for batch in (records, float_records, [{"url": "/a", "response_time": 3}] * 10):
+        options = MetricsOptions(url_normalizer=normalizer)
+        expected = accumulate_url_records(batch, decoder, options=options)
+        actual = accumulate_url_records_numpy(batch, decoder, options=options, chunk_size=chunk_size)
+        assert _stats_snapshot(actual) == _stats_snapshot(expected)
+
+    existing = {"/a": UrlStats(2, 5, 1, 4), "/zzz": UrlStats(1, 0.5, 0.5, 0.5)}
+    expected = accumulate_url_records(records, decoder, copy.deepcopy(existing))
+    actual = accumulate_url_records_numpy(records, decoder, copy.deepcopy(existing), chunk_size=chunk_size)
+    assert _stats_snapshot(actual) == _stats_snapshot(expected)
+
+
+def test_resolve_aggregation_backend(monkeypatch):
+    monkeypatch.setattr(log_sorter, 'numpy', None)
+    assert resolve_aggregation_backend('auto') == 'python'
+    with pytest.raises(ValueError):
+        resolve_aggregation_backend('numpy')
+    assert not MetricsOptions(backend='numpy', percentile_accuracy=0.01).use_numpy
+
+
+@pytest.mark.parametrize("extra", [{}, {"date": "2025-06-22"}, {"collapse_ids": True, "top": 2}])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_backends_produce_identical_reports(mock_parse_args, mock_sys_exit, capsys, tmp_path, extra):
+    pytest.importorskip("numpy")
+    log_file = tmp_path / "app.log"
+    lines = _indexed_log_lines(per_day=5) + [json.dumps(record) for record in _mixed_records(200)]
+    _write_sharded_log(log_file, lines)
+    converted = tmp_path / "app.lsc"
+    save_columnar_log(str(converted), convert_to_columnar([str(log_file)]))
+
+    outputs = []
+    for backend in ("python", "numpy"):
+        for path in (log_file, converted):
+            mock_parse_args.return_value = make_args(files=[str(path)], backend=backend, **extra)
+            main()
+            outputs.append(capsys.readouterr().out)
+    mock_sys_exit.assert_not_called()
+    assert outputs[0] == outputs[2]
+    assert outputs[1] == outputs[3]
+
+
+def _write_pod_logs(root, pods=12, per_pod=6):
+    paths = []
+    for pod in range(pods):
+        directory = root / f"pod-{pod:02d}"
+        directory.mkdir()
+        lines = [json.dumps({"url": f"/api/{(pod + i) % 5}", "response_time": pod * 10 + i,
+                             "@timestamp": f"2025-06-{21 + i % 3}T10:00:00+00:00"}) for i in range(per_pod)]
+        path = directory / "0.log"
+        _write_sharded_log(path, lines)
+        paths.append(str(path))
+    return paths
+
+
+def test_expand_log_paths(tmp_path, capsys):
+    paths = _write_pod_logs(tmp_path, pods=3)
+    (tmp_path / "pod-00" / ".hidden").write_text("x\n")
+    (tmp_path / "pod-01" / "0.log.idx").write_text("{}")
+    single = tmp_path / "single.log"
+    single.write_text("")
+
+    assert expand_log_paths([str(tmp_path / "pod-*" / "*.log")]) == paths
+    assert expand_log_paths([str(tmp_path)]) == [str(single)] + paths
+    assert expand_log_paths([str(tmp_path / "**" / "0.log"), paths[0], "missing.log"]) == paths + ["missing.log"]
+    assert capsys.readouterr().err == ""
+    assert expand_log_paths([str(tmp_path / "*.gz")]) == []
+    assert "*.gz" in capsys.readouterr().err
+
+    bracketed = tmp_path / "pod[1].log"
+    bracketed.write_text("")
+    assert expand_log_paths([str(bracketed)]) == [str(bracketed)]
+    assert capsys.readouterr().err == ""
+
+
+@pytest.mark.parametrize("max_bytes", [16 * 1024 * 1024, 0])
+def test_iter_log_entries_concurrent_matches_serial(tmp_path, capsys, max_bytes):
+    paths = _write_pod_logs(tmp_path)
+    broken = tmp_path / "broken.log"
+    broken.write_text('{"url": "/b", "response_time": 1}\nInvalid JSON\n')
+    packed = tmp_path / "packed.log.gz"
+    _write_gzip_members(packed, COMPRESSED_LINES)
+    paths[3:3] = [str(broken), str(tmp_path / "missing.log"), str(packed), str(tmp_path)]
+    window = DateWindow(datetime.date(2025, 6, 21), datetime.date(2025, 6, 22))
+
+    serial_counters = {'date_skipped': 0}
+    serial = list(iter_log_entries(paths, window, counters=serial_counters))
+    serial_err = capsys.readouterr().err
+    counters = {'date_skipped': 0}
+    concurrent = list(iter_log_entries_concurrent(paths, 4, window, counters, max_bytes=max_bytes))
+    assert concurrent == serial
+    assert counters == serial_counters
+    assert capsys.readouterr().err == serial_err
+
+
+def test_read_log_file_contents_streams_compressed_files(tmp_path):
+    plain = tmp_path / "small.log"
+    plain.write_bytes(b"line\n")
+    packed = tmp_path / "small.log.gz"
+    _write_gzip_members(packed, COMPRESSED_LINES)
+    assert log_sorter.read_log_file_contents(str(plain)) == (b"line\n", None)
+    assert log_sorter.read_log_file_contents(str(packed)) == (None, None)
+    assert log_sorter.read_log_file_contents(str(plain), max_bytes=1) == (None, None)
+
+
+def test_iter_log_entries_concurrent_stops_reader_threads(tmp_path):
+    paths = _write_pod_logs(tmp_path, pods=40)
+    entries = iter_log_entries_concurrent(paths, 8)
+    assert next(entries)["url"] == "/api/0"
+    entries.close()
+    assert not [thread for thread in threading.enumerate()
+                if thread.name.startswith('log-reader')]
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_io_concurrency_with_directory(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    paths = _write_pod_logs(tmp_path)
+    mock_parse_args.return_value = make_args(files=paths, date_from="2025-06-22")
+    main()
+    expected = capsys.readouterr().out
+
+    mock_parse_args.return_value = make_args(files=[str(tmp_path)], date_from="2025-06-22", io_concurrency=8)
+    main()
+    assert capsys.readouterr().out == expected
+    mock_sys_exit.assert_not_called()
+
+    mock_parse_args.return_value = make_args(files=[str(tmp_path)], io_concurrency=8, workers=2)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "--workers" in capsys.readouterr().err
+
+
+def test_bench_suite_writes_and_compares_json(tmp_path, capsys):
+    import bench
+
+    log_file = tmp_path / "synthetic.log"
+    bench.generate_log_file(str(log_file), 0.05, urls=30, days=3, malformed_ratio=0.1)
+    lines = log_file.read_text().splitlines()
+    assert len({json.loads(line)["url"] for line in lines if line.endswith("}")}) <= 30
+
+    result_file = tmp_path / "bench.json"
+    argv = ["--file", str(log_file), "--date", "2025-06-02", "--aggregation-rows", "1000", "--skip-readers"]
+    bench.main(argv + ["--json", str(result_file), "--label", "base"])
+    results = json.loads(result_file.read_text())
+    assert results["label"] == "base"
+    assert [stage["stage"] for stage in results["stages"]] == list(bench.STAGES)
+    parse, filtering = results["stages"][:2]
+    assert parse["lines"] == len(lines)
+    assert 0 < parse["malformed"] < len(lines) and parse["mb_per_s"] > 0
+    assert 0 < results["stages"][2]["lines"] < filtering["lines"] == len(lines) - parse["malformed"]
+    if bench.resource is not None:
+        peaks = [stage["cumulative_peak_rss_mb"] for stage in results["stages"]]
+        assert peaks == sorted(peaks)
+        assert all(stage["peak_rss_growth_mb"] >= 0 for stage in results["stages"])
+
+    for stage in results["stages"]:
+        stage["seconds"] = 1e-9
+    result_file.write_text(json.dumps(results))
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        bench.main(argv + ["--compare", str(result_file)])
+    assert "РЕГРЕССИЯ" in capsys.readouterr().out
+
+
+def test_run_stats_attributes_exclusive_time_per_stage():
+    reports = []
+    stats = RunStats(hooks=[reports.append])
+
+    def slow(items, delay):
+        for item in items:
+            time.sleep(delay)
+            yield item
+
+    lines = [b'{"a": 1}\n'] * 20
+    with stats.stage('aggregate'):
+        raw = stats.iterate('read', slow(lines, 0.002), chunk_size=8, count_bytes=True)
+        decoded = stats.iterate('decode', slow(raw, 0.001), chunk_size=8)
+        assert len(list(decoded)) == 20
+    report = stats.finish({'parsed': 20, 'matched': 5, 'malformed': 1}, windowed=True, missing_fields=2)
+
+    assert reports == [report]
+    stages = {stage['stage']: stage for stage in report['stages']}
+    assert list(stages) == ['read', 'decode', 'aggregate']
+    assert stages['read']['items'] == stages['decode']['items'] == 20
+    assert 0.035 < stages['read']['wall'] < 0.2
+    assert 0.015 < stages['decode']['wall'] < stages['read']['wall']
+    assert stages['aggregate']['wall'] < 0.015
+    assert report['bytes_read'] == 20 * len(lines[0])
+    assert report['lines_read'] == 21
+    assert report['lines_skipped'] == {'empty': 0, 'malformed': 1, 'date_filtered': 15, 'missing_fields': 2}
+
+    disabled = RunStats(enabled=False)
+    assert disabled.iterate('read', lines) is lines
+    with disabled.stage('render'):
+        pass
+    assert disabled.wall == {}
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_stats_reports_stages_and_skipped_lines(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "app.log"
+    lines = _indexed_log_lines(per_day=5)
+    lines[1:1] = ["", "Invalid JSON", '{"url": "/no-time", "@timestamp": "2025-06-22T10:00:00+00:00"}']
+    _write_sharded_log(log_file, lines)
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date="2025-06-22")
+    main()
+    expected = capsys.readouterr().out
+
+    reports = []
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date="2025-06-22", stats="json")
+    main(stats=RunStats(hooks=[reports.append]))
+    captured = capsys.readouterr()
+    mock_sys_exit.assert_not_called()
+    assert captured.out == expected
+    report = json.loads(captured.err.strip().splitlines()[-1])
+    assert reports == [report]
+    assert report['lines_read'] == len(lines) == sum(1 for _ in open(log_file))
+    assert report['bytes_read'] == log_file.stat().st_size
+    assert report['lines_skipped']['empty'] == 1
+    assert report['lines_skipped']['malformed'] == 1
+    assert report['lines_skipped']['missing_fields'] == 1
+    assert report['lines_skipped']['date_filtered'] == len(lines) - 3 - 5
+    assert [stage['stage'] for stage in report['stages']] == ['index', 'read', 'decode', 'filter', 'aggregate',
+                                                              'render']
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], stats="text", workers=2)
+    main()
+    err = capsys.readouterr().err
+    assert "Статистика выполнения" in err and "aggregate" in err
+    assert "с ошибкой JSON 1" in err
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_profile_and_trace_memory(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    import pstats
+
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, _indexed_log_lines())
+    profile = tmp_path / "report.prof"
+    mock_parse_args.return_value = make_args(files=[str(log_file)], profile=str(profile), trace_memory=True)
+    main()
+    mock_sys_exit.assert_not_called()
+    assert "accumulate_url_records" in str(pstats.Stats(str(profile)).stats)
+    assert "tracemalloc" in capsys.readouterr().err
+
+
+def test_fixed_width_tables_match_tabulate(capsys):
+    tabulate = pytest.importorskip("tabulate")
+    rng = random.Random(7)
+    metrics = {}
+    for i in range(60):
+        count = rng.randint(1, 10 ** rng.randint(0, 6))
+        avg = rng.choice([0.0, 0.0004, 1.0, 12.3456, rng.random() * 10 ** rng.randint(0, 8)])
+        row = {"total": count, "avg_time": avg}
+        if i % 2:
+            row.update(p50=None if i % 3 else avg, p95=avg * 1.5, p99=None, max=count)
+        metrics[f"/api/{'x' * rng.randint(0, 40)}/{i}"] = row
+    plain = {url: {"total": row["total"], "avg_time": row["avg_time"]} for url, row in metrics.items()}
+    with_percentiles = {url: {"p50": None, "p95": None, "p99": None, "max": None, **row}
+                        for url, row in metrics.items()}
+
+    def expected(data, with_columns):
+        rows = sorted(data.items(), reverse=True, key=lambda item: item[1]["total"])
+        columns = ["p50", "p95", "p99", "max"] if with_columns else []
+        table = [[shorten_url(url), row["total"], f"{row['avg_time']:.3f}"]
+                 + ["" if row[name] is None else f"{row[name]:.3f}" for name in columns] for url, row in rows]
+        return tabulate.tabulate(table, headers=["handler", "total", "avg_response_time"] + columns,
+                                 tablefmt="simple", showindex=True, numalign="right", stralign="left") + "\n"
+
+    for data, with_columns in ((plain, False), (with_percentiles, True)):
+        print_url_metrics_table(data)
+        assert capsys.readouterr().out == expected(data, with_columns)
+
+    table = BucketedStats(60)
+    for i in range(40):
+        index = table.cell(29000000 + rng.randrange(5), table.intern_url(f"/bucket/{rng.randrange(8)}" * rng.randint(1, 4)))
+        table.add(index, rng.random() * 100)
+    print_bucketed_metrics_table(table)
+    rows = sorted(table.rows(), key=lambda row: (row[0], -row[2], row[1]))
+    assert capsys.readouterr().out == tabulate.tabulate(
+        [[format_bucket_start(bucket, 60), shorten_url(url), count, f"{avg:.3f}"] for bucket, url, count, avg in rows],
+        headers=["bucket", "handler", "total", "avg_response_time"], tablefmt="simple", showindex=True,
+        numalign="right", stralign="left") + "\n"
+
+
+FORMAT_METRICS = {
+    '/a?q="x"': {"total": 2, "avg_time": 0.16172835000000002, "p50": 0.1236, "p95": None, "p99": None, "max": 0.2},
+    "/b": {"total": 5, "avg_time": 1 / 3, "p50": 3, "p95": 3, "p99": 3, "max": 3},
+}
+
+
+def test_write_url_metrics_csv_and_jsonl_keep_full_precision(capsys):
+    write_url_metrics(FORMAT_METRICS, 'csv')
+    rows = list(csv.DictReader(io.StringIO(capsys.readouterr().out)))
+    assert [row["url"] for row in rows] == ["/b", '/a?q="x"']
+    assert float(rows[0]["avg_time"]) == 1 / 3
+    assert rows[1]["p95"] == "" and float(rows[1]["avg_time"]) == 0.16172835000000002
+
+    write_url_metrics(FORMAT_METRICS, 'jsonl', sort_by='avg')
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records == [{"url": url, **FORMAT_METRICS[url]} for url in ("/b", '/a?q="x"')]
+
+    write_url_metrics({url: {"total": m["total"], "avg_time": m["avg_time"]} for url, m in FORMAT_METRICS.items()},
+                      'csv')
+    assert capsys.readouterr().out.splitlines()[0] == "url,total,avg_time"
+
+
+def test_write_url_metrics_prometheus(capsys):
+    write_url_metrics(FORMAT_METRICS, 'prom')
+    lines = capsys.readouterr().out.splitlines()
+    samples = dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+    assert samples['log_sorter_requests{handler="/a?q=\\"x\\""}'] == "2"
+    assert float(samples['log_sorter_response_time_avg{handler="/b"}']) == 1 / 3
+    assert samples['log_sorter_response_time{handler="/b",quantile="0.95"}'] == "3"
+    assert 'log_sorter_response_time{handler="/a?q=\\"x\\"",quantile="0.95"}' not in samples
+    assert samples['log_sorter_response_time_count{handler="/b"}'] == "5"
+    assert float(samples['log_sorter_response_time_sum{handler="/b"}']) == pytest.approx(5 / 3)
+    assert float(samples['log_sorter_response_time_sum{handler="/a?q=\\"x\\""}']) == pytest.approx(0.3234567)
+    assert [line for line in lines if line.startswith("# TYPE")] == [
+        "# TYPE log_sorter_requests gauge", "# TYPE log_sorter_response_time_avg gauge",
+        "# TYPE log_sorter_response_time summary", "# TYPE log_sorter_response_time_max gauge"]
+
+
+def test_write_bucketed_metrics_machine_formats(capsys):
+    table = accumulate_bucketed_records(BUCKET_RECORDS, make_record_decoder('json'), 3600)
+    write_bucketed_metrics(table, 'jsonl')
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(records) == len(table)
+    assert all(record["bucket"].endswith(":00:00Z") for record in records)
+    write_bucketed_metrics(table, 'csv')
+    rows = list(csv.DictReader(io.StringIO(capsys.readouterr().out)))
+    assert [(row["bucket"], row["url"], int(row["total"])) for row in rows] == \
+        [(record["bucket"], record["url"], record["total"]) for record in records]
+    with pytest.raises(ValueError):
+        write_bucketed_metrics(table, 'prom')
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_format_with_createfile(mock_parse_args, mock_sys_exit, capsys, tmp_path, monkeypatch):
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, _indexed_log_lines())
+    monkeypatch.chdir(tmp_path)
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], format="jsonl", top=2)
+    main()
+    streamed = capsys.readouterr().out
+    assert len(streamed.splitlines()) == 2
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], format="jsonl", top=2, createfile=True)
+    main()
+    assert "TestReport.jsonl" in capsys.readouterr().out
+    assert (tmp_path / "TestReport.jsonl").read_text(encoding='utf-8') == streamed
+    mock_sys_exit.assert_not_called()
+
+    mock_parse_args.return_value = make_args(files=[str(log_file)], format="prom", bucket="1h")
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert "--format prom" in capsys.readouterr().err
+
+
+GROUPED_LINES = [
+    {"time": "2025-06-22T10:00:00Z", "url": "/api/1", "http_method": "GET", "status": 200, "bytes": 100},
+    {"time": "2025-06-22T10:05:00Z", "url": "/api/2", "http_method": "GET", "status": 200, "bytes": 300},
+    {"time": "2025-06-22T10:10:00Z", "url": "/api/3", "http_method": "POST", "status": 500, "bytes": 50},
+    {"time": "2025-06-22T11:00:00Z", "url": "/api/1", "http_method": "GET", "status": 404, "bytes": 10},
+    {"time": "2025-06-23T09:00:00Z", "url": "/api/1", "http_method": "GET", "status": 200, "bytes": 900},
+    {"time": "2025-06-22T12:00:00Z", "url": "/api/4", "status": 200, "bytes": 5},
+    {"time": "2025-06-22T12:00:00Z", "url": "/api/5", "http_method": "", "status": 200, "bytes": 5},
+    {"time": "2025-06-22T12:00:00Z", "url": "/api/6", "http_method": "GET", "status": None, "bytes": 5},
+]
+
+
+def test_parse_group_by():
+    assert parse_group_by("url") == ("url",)
+    assert parse_group_by(" url, http_method ,status") == ("url", "http_method", "status")
+    for text in ("", "url,,status", "url,url"):
+        with pytest.raises(ValueError):
+            parse_group_by(text)
+
+
+@pytest.mark.parametrize("name", AVAILABLE_DECODERS)
+def test_record_decoder_group_key_and_metric(name):
+    decoder = make_record_decoder(name, 'time', ("http_method", "status"), 'bytes')
+    get_key, get_metric = decoder.getter('key'), decoder.getter('metric')
+    records = [decoder.decode(json.dumps(line).encode()) for line in GROUPED_LINES]
+    assert [get_key(record) for record in records] == \
+        [("GET", 200), ("GET", 200), ("POST", 500), ("GET", 404), ("GET", 200), None, None, None]
+    assert [get_metric(record) for record in records[:3]] == [100, 300, 50]
+    assert decoder.column('key')(records[:2]) == [("GET", 200), ("GET", 200)]
+    assert decoder.getter('timestamp')(records[0]) == "2025-06-22T10:00:00Z"
+    assert decoder.getter('url')(records[0]) == "/api/1"
+
+    single = make_record_decoder(name, group_by=("status",), metric='bytes')
+    assert single.getter('key')(single.decode(json.dumps(GROUPED_LINES[2]).encode())) == 500
+
+
+@pytest.mark.parametrize("backend", ["python", "numpy"])
+def test_accumulate_grouped_records_with_normalizer(backend):
+    if backend == "numpy":
+        pytest.importorskip("numpy")
+    decoder = make_record_decoder('json', 'time', ("url", "http_method"), 'bytes')
+    options = MetricsOptions(url_normalizer=UrlNormalizer(collapse_ids=True), backend=backend,
+                             group_by=("url", "http_method"), metric='bytes')
+    url_stats = accumulate_url_records(GROUPED_LINES, decoder, options=options)
+    assert {key: (stats.count, stats.total) for key, stats in url_stats.items()} == {
+        ("/api/{id}", "GET"): (5, 1315), ("/api/{id}", "POST"): (1, 50)}
+    assert MetricsOptions(url_normalizer=UrlNormalizer(True), group_by=("status",)).normalize_key is None
+    assert MetricsOptions(group_by=("url", "status"), metric="bytes").key()["group_by"] == ["url", "status"]
+    assert "group_by" not in MetricsOptions().key()
+
+
+def test_write_grouped_metrics(capsys):
+    metrics = {("/a", "GET", 200): {"total": 3, "avg_time": 2.5}, ("/a", "POST", 500): {"total": 1, "avg_time": 7}}
+    group_by = ("url", "http_method", "status")
+    write_url_metrics(metrics, 'csv', group_by=group_by, metric='bytes')
+    rows = list(csv.reader(io.StringIO(capsys.readouterr().out)))
+    assert rows == [["url", "http_method", "status", "total", "avg_time"],
+                    ["/a", "GET", "200", "3", "2.5"], ["/a", "POST", "500", "1", "7"]]
+
+    write_url_metrics(metrics, 'jsonl', group_by=group_by, metric='bytes')
+    assert json.loads(capsys.readouterr().out.splitlines()[1]) == \
+        {"url": "/a", "http_method": "POST", "status": 500, "total": 1, "avg_time": 7}
+
+    write_url_metrics(metrics, 'prom', group_by=group_by, metric='bytes')
+    lines = capsys.readouterr().out.splitlines()
+    assert 'log_sorter_bytes_avg{handler="/a",http_method="GET",status="200"} 2.5' in lines
+    assert "# TYPE log_sorter_requests gauge" in lines
+
+    write_url_metrics(metrics, group_by=group_by, metric='bytes')
+    header = capsys.readouterr().out.splitlines()[0].split()
+    assert header == ["url", "http_method", "status", "total", "avg_bytes"]
+
+
+@pytest.mark.parametrize("extra", [{}, {"workers": 2}, {"backend": "python"}, {"bucket": "1h"}])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_group_by_metric_and_timestamp_field(mock_parse_args, mock_sys_exit, capsys, tmp_path, extra):
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, [json.dumps(line) for line in GROUPED_LINES])
+    mock_parse_args.return_value = make_args(files=[str(log_file)], group_by="http_method,status", metric="bytes",
+                                             timestamp_field="time", date="2025-06-22", format="jsonl", **extra)
+    main()
+    mock_sys_exit.assert_not_called()
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    totals = collections.Counter()
+    for record in records:
+        totals[(record["http_method"], record["status"])] += record["total"]
+    assert totals == {("GET", 200): 2, ("POST", 500): 1, ("GET", 404): 1}
+    if not extra.get("bucket"):
+        assert records[0] == {"http_method": "GET", "status": 200, "total": 2, "avg_time": 200}
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"group_by": "url,,status"}, "полей группировки"),
+    ({"group_by": "url,status", "save_stats": "x.json"}, "--save-stats"),
+    ({"group_by": "status", "strip_query": True}, "url в --group-by"),
+])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_group_by_invalid_options_exit(mock_parse_args, mock_sys_exit, capsys, tmp_path, overrides, message):
+    log_file = tmp_path / "app.log"
+    log_file.write_text(json.dumps(GROUPED_LINES[0]) + "\n")
+    mock_parse_args.return_value = make_args(files=[str(log_file)], **overrides)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert message in capsys.readouterr().err
+
+
+def _rollup_records(lines, decoder, options=None):
+    return accumulate_daily_rollups((decoder.decode(line.encode()) for line in lines), decoder, options=options)
+
+
+def test_daily_rollups_round_trip(tmp_path):
+    decoder = make_record_decoder('json')
+    options = MetricsOptions(percentile_accuracy=0.01)
+    lines = _indexed_log_lines() + ['{"url": "/undated", "response_time": 1}',
+                                    '{"@timestamp": "2025-06-22T12:00:00Z", "url": "/22/0", "response_time": 0.5}']
+    rollups = _rollup_records(lines, decoder, options)
+    assert sorted(rollups) == list(INDEXED_DAYS)
+    assert rollups["2025-06-22"][0] == 5
+
+    db_path = str(tmp_path / "rollups.sqlite")
+    save_daily_rollups(db_path, rollups)
+    window = DateWindow(datetime.date(2025, 6, 22), datetime.date(2025, 6, 23))
+    url_stats, days, _ = query_rollups(db_path, window, options)
+    assert days == {"2025-06-22": 5, "2025-06-23": 4}
+    expected = accumulate_url_records(
+        iter_records_in_window((decoder.decode(line.encode()) for line in lines), window, decoder), decoder,
+        options=options)
+    assert url_stats == expected
+    assert type(url_stats["/22/1"].max) is int
+
+    plain_stats, _, _ = query_rollups(db_path, window)
+    assert {url: stats.count for url, stats in plain_stats.items()} == \
+        {url: stats.count for url, stats in expected.items()}
+    assert all(stats.sketch is None for stats in plain_stats.values())
+
+    save_daily_rollups(db_path, _rollup_records(lines[4:6], decoder, options))
+    url_stats, days, _ = query_rollups(db_path, window, options)
+    assert days["2025-06-22"] == 2
+    assert url_stats["/22/0"].count == 1
+
+    with pytest.raises(ValueError, match="точностью"):
+        query_rollups(db_path, window, MetricsOptions(percentile_accuracy=0.02))
+    with pytest.raises(ValueError, match="event_time"):
+        query_rollups(db_path, window, timestamp_field_name='event_time')
+    with pytest.raises(ValueError):
+        save_daily_rollups(db_path, rollups, percentile_accuracy=0.05)
+    with pytest.raises(IOError):
+        query_rollups(str(tmp_path / "missing.sqlite"), window)
+
+
+@pytest.mark.parametrize("extra", [{}, {"percentiles": True}, {"workers": 2}, {"top": 1, "collapse_ids": True}])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_rollup_db_matches_raw_report(mock_parse_args, mock_sys_exit, capsys, tmp_path, extra):
+    log_file = tmp_path / "app.log"
+    lines = _indexed_log_lines(per_day=6)
+    _write_sharded_log(log_file, lines)
+    args = make_args(files=[str(log_file)], date_from="2025-06-21", date_to="2025-06-23", format="jsonl", **extra)
+    mock_parse_args.return_value = args
+    main()
+    expected = capsys.readouterr().out
+
+    db_path = str(tmp_path / "rollups.sqlite")
+    decoder = make_record_decoder('json')
+    save_daily_rollups(db_path, _rollup_records(lines[:12], decoder, MetricsOptions(percentile_accuracy=0.01)))
+    mock_parse_args.return_value = make_args(**{**vars(args), "rollup_db": db_path})
+    main()
+    captured = capsys.readouterr()
+    mock_sys_exit.assert_not_called()
+    assert captured.out == expected
+    assert captured.err == ""
+
+    # Дни из сводок не читаются из логов: без строк за 23 число в отчёте остаются только свёрнутые дни.
+    _write_sharded_log(log_file, lines[:12])
+    mock_parse_args.return_value = make_args(**{**vars(args), "files": None, "rollup_db": db_path})
+    main()
+    assert captured.out != capsys.readouterr().out
+    mock_sys_exit.assert_not_called()
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_rollup_db_matches_raw_report_with_floats(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    rng = random.Random(3)
+    lines = [json.dumps({"@timestamp": f"{day}T10:00:00+00:00", "url": f"/u{i % 3}",
+                         "response_time": rng.choice([0.1, 0.3, 0.7, 1e16])})
+             for day in INDEXED_DAYS for i in range(90)]
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, lines)
+    args = make_args(files=[str(log_file)], date_from="2025-06-21", date_to="2025-06-23", format="jsonl")
+    mock_parse_args.return_value = args
+    main()
+    expected = capsys.readouterr().out
+
+    db_path = str(tmp_path / "rollups.sqlite")
+    decoder = make_record_decoder('json')
+    for day_lines in (lines[:90], lines[90:180], lines[180:]):
+        save_daily_rollups(db_path, _rollup_records(day_lines, decoder))
+    url_stats, _, _ = query_rollups(db_path, DateWindow(None, None))
+    values = {}
+    for line in lines:
+        record = json.loads(line)
+        values.setdefault(record["url"], []).append(record["response_time"])
+    assert {url: stats.total for url, stats in url_stats.items()} == \
+        {url: math.fsum(url_values) for url, url_values in values.items()}
+
+    mock_parse_args.return_value = make_args(**{**vars(args), "files": None, "rollup_db": db_path})
+    main()
+    mock_sys_exit.assert_not_called()
+    assert capsys.readouterr().out == expected
+
+
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_rollup_db_stats_count_each_line_once(mock_parse_args, mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "app.log"
+    lines = _indexed_log_lines(per_day=6)
+    _write_sharded_log(log_file, lines)
+    db_path = str(tmp_path / "rollups.sqlite")
+    save_daily_rollups(db_path, _rollup_records(lines[:12], make_record_decoder('json')))
+    mock_parse_args.return_value = make_args(files=[str(log_file)], date_from="2025-06-21", date_to="2025-06-23",
+                                             rollup_db=db_path, stats="json")
+    main()
+    mock_sys_exit.assert_not_called()
+    report = json.loads(capsys.readouterr().err.strip().splitlines()[-1])
+    assert report['lines_read'] == len(lines)
+    assert report['lines_summarized'] == 12
+    assert report['records_parsed'] == 6
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({}, "--date"),
+    ({"date": "2025-06-22", "bucket": "1h"}, "--bucket"),
+    ({"date": "2025-06-22", "group_by": "url,status"}, "--group-by"),
+    ({"date": "2025-06-22", "percentiles": True, "percentile_accuracy": 0.05}, "точностью"),
+])
+@patch('sys.exit')
+@patch('argparse.ArgumentParser.parse_args')
+def test_main_rollup_db_invalid_options_exit(mock_parse_args, mock_sys_exit, capsys, tmp_path, overrides, message):
+    db_path = str(tmp_path / "rollups.sqlite")
+    save_daily_rollups(db_path, _rollup_records(_indexed_log_lines(), make_record_decoder('json')))
+    mock_parse_args.return_value = make_args(rollup_db=db_path, **overrides)
+    main()
+    mock_sys_exit.assert_called_once_with(1)
+    assert message in capsys.readouterr().err
+
+
+@patch('sys.exit')
+def test_rollup_command(mock_sys_exit, capsys, tmp_path):
+    log_file = tmp_path / "app.log"
+    _write_sharded_log(log_file, _indexed_log_lines())
+    db_path = str(tmp_path / "rollups.sqlite")
+    main(["rollup", "--files", str(log_file), "--db", db_path, "--date-to", "2025-06-22"])
+    assert "дней 2, с 2025-06-21 по 2025-06-22" in capsys.readouterr().out
+    _, days, covered = query_rollups(db_path, DateWindow(None, None), filepaths=[str(log_file)])
+    assert days == {"2025-06-21": 4, "2025-06-22": 4}
+    assert covered == []
+    window = DateWindow(datetime.date(2025, 6, 21), datetime.date(2025, 6, 22))
+    assert query_rollups(db_path, window, filepaths=[str(log_file)])[2] == [str(log_file)]
+    mock_sys_exit.assert_not_called()
+
+    with open(log_file, 'a') as f:
+        f.write(_indexed_log_lines(("2025-06-22",), per_day=1)[0] + "\n")
+    assert query_rollups(db_path, window, filepaths=[str(log_file)])[2] == []
+
+    main(["rollup", "--files", str(log_file), "--db", db_path, "--percentile-accuracy", "0.05"])
+    mock_sys_exit.assert_called_once_with(1)
+    assert "percentile_accuracy" in capsys.readouterr().err
+
+
+# Медленные необязательные модули не должны загружаться на путях, которым они не нужны.
+STARTUP_DEFERRED_MODULES = ('numpy', 'msgspec', 'orjson', 'zstandard', 'inotify_simple', 'concurrent.futures',
+                            'sqlite3', 'csv', 'gzip', 'hashlib', 'cProfile', 'tracemalloc')
+STARTUP_IMPORT_BUDGET_US = 100000
+
+
+def test_startup_imports_stay_light():
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(project_root, 'main.py'),
+                             '--report', 'x'], capture_output=True, text=True, cwd=project_root)
+    assert result.returncode == 1
+    assert "--files" in result.stderr
+    imported = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit():
+            imported[name.strip()] = (len(name) - len(name.lstrip()), int(cumulative))
+    assert imported
+    assert not set(STARTUP_DEFERRED_MODULES) & set(imported)
+    top_level = min(depth for depth, _ in imported.values())
+    total = sum(cumulative for depth, cumulative in imported.values() if depth == top_level)
+    assert total < STARTUP_IMPORT_BUDGET_US
+
+
+def test_optional_modules_resolve_lazily(monkeypatch):
+    monkeypatch.delitem(vars(log_sorter), 'numpy', raising=False)
+    expected = 'numpy' if log_sorter.importlib.util.find_spec('numpy') is not None else 'python'
+    assert log_sorter.resolve_aggregation_backend('auto') == expected
+    assert 'numpy' not in vars(log_sorter)
+    assert (log_sorter.numpy is not None) == (expected == 'numpy')
+    monkeypatch.setattr(log_sorter, 'numpy', None)
+    assert log_sorter.resolve_aggregation_backend('auto') == 'python'